@@ -0,0 +1,369 @@
+"""ais_db.py - Schema, migrations and bulk loading for the AIS SQLite database
+
+The schema version is kept in PRAGMA user_version. connect() brings any database up to date by running the
+statements in migrations that it has not seen yet, so older databases are upgraded in place the first time they are
+opened.
+
+ais_data is a WITHOUT ROWID table clustered on (mmsi, utc_timestamp_ms), so the rows for one vessel over a time range
+are stored together and a point can only be loaded once. file_id has its own index for the per-file lookups. The
+projected coordinates of each point are stored in easting and northing as it is loaded, see projection.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import os
+import pathlib
+import sqlite3
+from typing import Iterable
+
+from instrumentation import span
+import projection
+from vessel_mmsi import mmsi_from_name
+
+ais_database = os.path.join(os.getcwd(), 'Matsu_AIS.sqlite')
+
+# The columns of ais_data, in table order
+ais_data_columns = ['utc_timestamp_ms', 'status', 'cargo', 'longitude', 'latitude', 'sog', 'cog', 'heading', 'draft',
+                    'file_id', 'mmsi']
+# The projected coordinates added to ais_data by migration 7, in projection.project_crs feet
+projected_columns = ['easting', 'northing']
+
+AIS_DATA_TABLE_SQL = """create table if not exists ais_data(utc_timestamp_ms integer not null,
+                                                            status           integer,
+                                                            cargo            integer,
+                                                            longitude        REAL,
+                                                            latitude         REAL,
+                                                            sog              REAL,
+                                                            cog              REAL,
+                                                            heading          REAL,
+                                                            draft            REAL,
+                                                            file_id          integer,
+                                                            mmsi             integer not null
+                                                           );"""
+
+AIS_DATA_CLUSTERED_TABLE_SQL = """create table ais_data_clustered(utc_timestamp_ms integer not null,
+                                                                  status           integer,
+                                                                  cargo            integer,
+                                                                  longitude        REAL,
+                                                                  latitude         REAL,
+                                                                  sog              REAL,
+                                                                  cog              REAL,
+                                                                  heading          REAL,
+                                                                  draft            REAL,
+                                                                  file_id          integer,
+                                                                  mmsi             integer not null,
+                                                                  constraint ais_data_pk
+                                                                  primary key (mmsi, utc_timestamp_ms)
+                                                                 ) without rowid;"""
+
+UPLOADED_FILES_TABLE_SQL = """create table if not exists uploaded_files(filename    TEXT,
+                                                                        upload_date TEXT,
+                                                                        file_id     INTEGER not null
+                                                                                    constraint uploaded_files_pk
+                                                                                    primary key
+                                                                       );"""
+
+VESSEL_DATA_TABLE_SQL = """create table if not exists vessel_data(mmsi        INTEGER not null
+                                                                              constraint vessel_data_pk
+                                                                              primary key,
+                                                                  vessel_name TEXT
+                                                                 );"""
+
+AIS_CLASSIFIED_TABLE_SQL = """create table if not exists ais_classified(mmsi             integer not null,
+                                                                        utc_timestamp_ms integer not null,
+                                                                        section          TEXT,
+                                                                        rolling_speed    REAL,
+                                                                        activity         TEXT,
+                                                                        constraint ais_classified_pk
+                                                                        primary key (mmsi, utc_timestamp_ms)
+                                                                       ) without rowid;"""
+
+CLASSIFICATION_STATE_TABLE_SQL = """create table if not exists classification_state(mmsi          INTEGER not null
+                                                                                              constraint
+                                                                                              classification_state_pk
+                                                                                              primary key,
+                                                                                watermark_ms  INTEGER,
+                                                                                geometry_hash TEXT,
+                                                                                updated       TEXT
+                                                                               );"""
+
+LOADS_TABLE_SQL = """create table if not exists loads(mmsi            integer not null,
+                                                      start_ms        integer not null,
+                                                      end_ms          integer not null,
+                                                      complete        integer not null,
+                                                      points          integer,
+                                                      dig_s           REAL,
+                                                      sail_s          REAL,
+                                                      disp_s          REAL,
+                                                      delay_s         REAL,
+                                                      dig_dist_nm     REAL,
+                                                      sail_dist_nm    REAL,
+                                                      disp_dist_nm    REAL,
+                                                      delay_dist_nm   REAL,
+                                                      constraint loads_pk
+                                                      primary key (mmsi, start_ms)
+                                                     ) without rowid;"""
+
+TRACK_PYRAMID_TABLE_SQL = """create table if not exists track_pyramid(mmsi          integer not null,
+                                                                      day_ms        integer not null,
+                                                                      level         integer not null,
+                                                                      source_points integer not null,
+                                                                      num_points    integer not null,
+                                                                      ts            BLOB,
+                                                                      lon           BLOB,
+                                                                      lat           BLOB,
+                                                                      sog           BLOB,
+                                                                      constraint track_pyramid_pk
+                                                                      primary key (mmsi, day_ms, level)
+                                                                     );"""
+
+ACTIVITY_ROLLUPS_TABLE_SQL = """create table if not exists activity_rollups(mmsi        integer not null,
+                                                                            hour_ms     integer not null,
+                                                                            section     TEXT not null,
+                                                                            activity    TEXT not null,
+                                                                            points      integer,
+                                                                            duration_s  REAL,
+                                                                            distance_nm REAL,
+                                                                            sog_sum     REAL,
+                                                                            sog_max     REAL,
+                                                                            constraint activity_rollups_pk
+                                                                            primary key (mmsi, hour_ms, section,
+                                                                                         activity)
+                                                                           ) without rowid;"""
+
+# Secondary indexes, dropped during bulk loads and rebuilt afterwards
+secondary_indexes = {'ais_data_file_id_index': 'create index if not exists ais_data_file_id_index '
+                                               'on ais_data(file_id);'}
+
+# Each entry upgrades the schema by one version, entry i takes user_version i to i+1
+migrations = [
+    # 1: The original tables
+    [AIS_DATA_TABLE_SQL,
+     UPLOADED_FILES_TABLE_SQL,
+     VESSEL_DATA_TABLE_SQL],
+    # 2: Cluster ais_data on (mmsi, utc_timestamp_ms), dropping duplicate points, and index file_id
+    [AIS_DATA_CLUSTERED_TABLE_SQL,
+     f"""insert or ignore into ais_data_clustered({', '.join(ais_data_columns)})
+                select {', '.join(ais_data_columns)} from ais_data order by mmsi, utc_timestamp_ms;""",
+     'drop table ais_data;',
+     'alter table ais_data_clustered rename to ais_data;',
+     secondary_indexes['ais_data_file_id_index'],
+     'create unique index if not exists uploaded_files_filename_uindex on uploaded_files(filename);'],
+    # 3: Record the number of rows loaded from each file, NULL marks a file whose load is in progress or never
+    # completed. Files already recorded get the rows they have, 0 for an empty file
+    ['alter table uploaded_files add column row_count INTEGER;',
+     """update uploaded_files set row_count = (select count(*) from ais_data
+                                              where ais_data.file_id = uploaded_files.file_id);"""],
+    # 4: Persisted point classification, with the last classified timestamp per vessel
+    [AIS_CLASSIFIED_TABLE_SQL,
+     CLASSIFICATION_STATE_TABLE_SQL],
+    # 5: One row per load, see classify_loads.LoadSegmenter
+    [LOADS_TABLE_SQL],
+    # 6: Simplified daily tracks for the map, see track_lod
+    [TRACK_PYRAMID_TABLE_SQL],
+    # 7: Projected coordinates, filled for the existing rows by fill_projected
+    ['alter table ais_data add column easting REAL;',
+     'alter table ais_data add column northing REAL;'],
+    # 8: Hourly activity and section totals, see classify_loads.update_rollups
+    [ACTIVITY_ROLLUPS_TABLE_SQL],
+]
+projected_version = 7  # The schema version that added projected_columns
+
+# The tables built from ais_data, emptied with it by clear_ais_data. vessel_data holds names kept by hand, and is not
+derived_tables = ['ais_classified', 'classification_state', 'loads', 'track_pyramid', 'activity_rollups']
+
+# Pragmas for every connection, WAL lets the dashboard read while a load is running
+connection_pragmas = ['PRAGMA journal_mode=WAL',
+                      'PRAGMA synchronous=NORMAL',
+                      'PRAGMA temp_store=MEMORY',
+                      'PRAGMA cache_size=-65536',  # 64 MB
+                      'PRAGMA mmap_size=268435456']  # 256 MB
+# Pragmas while bulk loading. synchronous stays NORMAL, which under WAL only syncs at checkpoints, so a crash or power
+# loss during a load can lose the last transactions but not corrupt the database
+bulk_load_pragmas = ['PRAGMA synchronous=NORMAL',
+                     'PRAGMA cache_size=-262144']  # 256 MB
+
+
+def connect(db_path: str = ais_database, read_only: bool = False,
+            check_same_thread: bool = True) -> sqlite3.Connection:
+    """Open the AIS database, setting the pragmas and bringing the schema up to date
+
+    db_path: The database file
+    read_only: Open the database read only, the schema is not migrated. Read only connections can be used from any
+               thread
+    check_same_thread: Set False to share a writable connection between threads, the caller must serialize its use
+
+    returns: The connection
+    """
+    if read_only:
+        conn = sqlite3.connect(pathlib.Path(db_path).absolute().as_uri() + '?mode=ro', uri=True,
+                               check_same_thread=False)
+        for pragma in connection_pragmas[2:]:
+            conn.execute(pragma)
+        return conn
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    for pragma in connection_pragmas:
+        conn.execute(pragma)
+    migrate(conn)
+    return conn
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    """Return the schema version of the database"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """Apply any migrations the database has not seen yet, each in its own transaction"""
+    conn.commit()
+    version = schema_version(conn)
+    for new_version, statements in enumerate(migrations[version:], start=version + 1):
+        print(f'ais_db: migrating the database schema to version {new_version}')
+        conn.executescript('BEGIN;\n' +
+                           '\n'.join(statements) +
+                           f'\nPRAGMA user_version={new_version};\nCOMMIT;')
+    if version < len(migrations):
+        conn.executemany('INSERT OR IGNORE INTO vessel_data (mmsi, vessel_name) VALUES (?, ?)',
+                         [(mmsi, name) for name, mmsi in mmsi_from_name.items()])
+        conn.commit()
+    if version < projected_version:  # Baseline databases are at version 0 and may already have rows
+        fill_projected(conn)
+
+
+def fill_projected(conn: sqlite3.Connection, chunk_rows: int = projection.project_chunk_rows) -> int:
+    """Set the easting and northing of the points loaded before they were stored, a chunk at a time in key order
+
+    returns: The number of points updated
+    """
+    updated = 0
+    last_key = (-2**63, -2**63)
+    while rows := conn.execute('SELECT mmsi, utc_timestamp_ms, longitude, latitude FROM ais_data '
+                               'WHERE (mmsi, utc_timestamp_ms) > (?, ?) AND easting IS NULL '
+                               'AND longitude IS NOT NULL AND latitude IS NOT NULL '
+                               'ORDER BY mmsi, utc_timestamp_ms LIMIT ?', (*last_key, chunk_rows)).fetchall():
+        mmsi, ts, lon, lat = zip(*rows)
+        easting, northing = projection.to_project(lon, lat)
+        conn.executemany('UPDATE ais_data SET easting=?, northing=? WHERE mmsi=? AND utc_timestamp_ms=?',
+                         zip(easting.tolist(), northing.tolist(), mmsi, ts))
+        conn.commit()
+        updated += len(rows)
+        last_key = rows[-1][:2]
+    if updated:
+        print(f'ais_db: added the projected coordinates of {updated} points')
+    return updated
+
+
+def clear_ais_data(conn: sqlite3.Connection) -> None:
+    """Delete the loaded AIS data, the record of the files it came from and the tables built from it, so everything
+    can be loaded again. The schema and vessel_data are kept"""
+    conn.executescript('BEGIN;\n' +
+                       ''.join(f'DELETE FROM {table};\n' for table in ['ais_data', 'uploaded_files'] + derived_tables) +
+                       'COMMIT;')
+
+
+def rebuild_indexes(conn: sqlite3.Connection) -> None:
+    """Recreate the secondary indexes dropped for a bulk load and refresh the query planner statistics"""
+    for create_sql in secondary_indexes.values():
+        conn.execute(create_sql)
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+@contextmanager
+def bulk_loading(conn: sqlite3.Connection):
+    """Context manager for large loads into ais_data
+
+    The secondary indexes are dropped and the ingestion pragmas set on entry. On exit the indexes are rebuilt, the
+    statistics refreshed and the normal pragmas restored.
+    """
+    conn.commit()
+    for pragma in bulk_load_pragmas:
+        conn.execute(pragma)
+    for index_name in secondary_indexes.keys():
+        conn.execute(f'DROP INDEX IF EXISTS {index_name}')
+    conn.commit()
+    try:
+        yield conn
+    finally:
+        conn.commit()
+        rebuild_indexes(conn)
+        for pragma in connection_pragmas[1:]:
+            conn.execute(pragma)
+
+
+def insert_ais_rows(conn: sqlite3.Connection, rows: Iterable[tuple], columns: list[str] | None = None) -> int:
+    """Insert rows into ais_data, skipping points already in the table
+
+    Does not commit, so the caller controls the transaction. If the rows have positions but no projected coordinates,
+    the easting and northing are added, see projection.project_rows.
+
+    conn: Connection to the AIS database
+    rows: Tuples of values in the order of columns
+    columns: The ais_data columns in each row, defaults to all of ais_data_columns
+
+    returns: The number of rows inserted
+    """
+    if columns is None:
+        columns = ais_data_columns
+    if 'longitude' in columns and 'latitude' in columns and 'easting' not in columns:
+        rows = projection.project_rows(rows, columns.index('longitude'), columns.index('latitude'))
+        columns = columns + projected_columns
+    before = conn.total_changes
+    conn.executemany(f"INSERT OR IGNORE INTO ais_data ({', '.join(columns)}) "
+                     f"VALUES ({', '.join(['?'] * len(columns))})", rows)
+    return conn.total_changes - before
+
+
+def get_uploaded_file(conn: sqlite3.Connection, filename: str) -> tuple | None:
+    """Return (upload_date, file_id, row_count) if the file was completely loaded, otherwise None"""
+    return conn.execute('SELECT upload_date, file_id, row_count FROM uploaded_files '
+                        'WHERE filename=? AND row_count IS NOT NULL', (filename, )).fetchone()
+
+
+def data_version(conn: sqlite3.Connection) -> tuple:
+    """Return a key that changes when a file is loaded into or removed from ais_data
+
+    Read from uploaded_files, which has a row per loaded file, so ais_data is not scanned.
+    """
+    return conn.execute('SELECT count(*), max(file_id), total(row_count) FROM uploaded_files').fetchone()
+
+
+def remove_incomplete_uploads(conn: sqlite3.Connection) -> list[str]:
+    """Remove files whose load did not complete, along with any of their rows, so they can be loaded again
+
+    returns: The filenames removed
+    """
+    rows = conn.execute('SELECT file_id, filename FROM uploaded_files WHERE row_count IS NULL').fetchall()
+    for file_id, filename in rows:
+        print(f'ais_db: removing incomplete load of {filename}')
+        conn.execute('DELETE FROM ais_data WHERE file_id=?', (file_id, ))
+        conn.execute('DELETE FROM uploaded_files WHERE file_id=?', (file_id, ))
+    conn.commit()
+    return [filename for _, filename in rows]
+
+
+def insert_uploaded_file(conn: sqlite3.Connection, filename: str, rows: Iterable[tuple],
+                         columns: list[str]) -> tuple[int, int]:
+    """Record a file in uploaded_files and insert its rows into ais_data in one transaction
+
+    Either the file and all its rows are committed, or nothing is. Points already in the DB are skipped.
+
+    conn: Connection to the AIS database
+    filename: The name the file is recorded under
+    rows: Tuples of values in the order of columns, without the file_id
+    columns: The ais_data columns in each row
+
+    returns: The file_id and the number of rows inserted
+    """
+    with span('db_write', file=filename) as s:
+        try:
+            cursor = conn.execute('INSERT INTO uploaded_files (filename, upload_date, file_id) VALUES (?, ?, ?)',
+                                  (filename, datetime.now(), None))
+            file_id = cursor.lastrowid
+            inserted = insert_ais_rows(conn, ((*r, file_id) for r in rows), columns + ['file_id'])
+            conn.execute('UPDATE uploaded_files SET row_count=? WHERE file_id=?', (inserted, file_id))
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        s.rows = inserted
+    return file_id, inserted
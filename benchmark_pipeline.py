@@ -0,0 +1,308 @@
+"""benchmark_pipeline.py - Time and memory benchmarks for each stage of the pipeline
+
+The benchmarks run in a scratch folder on synthetic data, see synthetic_ais, at each of bench_sizes days of dredge
+data:
+
+* download_ais_data - NOAA daily files, with background traffic, served by a local HTTP server
+* extract_vessel_ais - filtering the dredge out of the daily files (needs polars_streaming_csv_decompression)
+* convert_day_to_parquet - building the optional Parquet cache of one daily file
+* load_port_data_to_db - loading a Port Houston file into an empty DB
+* load_ais_data, set_location, classify_delays/classify_cycle - the classification steps
+* update_map - drawing the dredge track on the map, with cold and warm caches
+
+Each stage is timed bench_repeats times, then run once more under tracemalloc for the peak Python memory (memory
+allocated by polars and SQLite is not included). The polars stages are also run once in a fresh process for their
+peak resident memory, which does include it. The results are written as JSON with the versions and machine they
+were run on, and two result files can be compared:
+
+python benchmark_pipeline.py                      # Run, writing benchmark_results.json
+python benchmark_pipeline.py old.json new.json    # Compare, reporting stages more than regression_threshold slower
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from importlib import metadata
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+import pandas as pd
+
+from instrumentation import peak_rss_bytes
+import synthetic_ais
+
+bench_sizes = [1, 7, 28]  # Days of dredge data
+bench_repeats = 3
+bench_start = '2025-06-02'
+bench_mmsi = 368349000
+background_vessels = 20  # Other vessels in each NOAA daily file
+results_fname = 'benchmark_results.json'
+regression_threshold = 0.10  # Report stages this much slower than the baseline
+repo_loc = os.path.dirname(os.path.abspath(__file__))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Serves files without logging each request"""
+    def log_message(self, format, *args):
+        pass
+
+
+def start_file_server(folder: str, handler: type[SimpleHTTPRequestHandler] = QuietHandler) -> ThreadingHTTPServer:
+    """Serve a folder over HTTP on a free local port, in a background thread
+
+    handler: The request handler class, QuietHandler answers every GET with the whole file
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=folder))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(stage: str, size: int, rows: int, run: Callable[[], object],
+            setup: Callable[[], object] | None = None, repeats: int = bench_repeats) -> dict:
+    """Time a stage, then run it once more under tracemalloc for the peak Python memory
+
+    stage: The stage name
+    size: The size of the data, in days
+    rows: The number of AIS rows the stage handles
+    run: Runs the stage
+    setup: Called before each run and not timed, to reset any state the run changes
+
+    returns: The result record
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    record = {'stage': stage,
+              'size_days': size,
+              'rows': rows,
+              'repeats': repeats,
+              'seconds_min': min(times),
+              'seconds_median': statistics.median(times),
+              'rows_per_s': rows / min(times) if min(times) > 0 else None,
+              'peak_python_bytes': peak}
+    print(f'{stage:>24} {size:>4} days {rows:>9} rows {min(times):9.3f} s {peak / 2**20:9.1f} MB')
+    return record
+
+
+def run_for_peak_rss(run: Callable[[], object]) -> int | None:
+    """Run a stage and return the peak resident memory of this process, see instrumentation.peak_rss_bytes"""
+    run()
+    return peak_rss_bytes()
+
+
+def measure_peak_rss(record: dict, run: Callable[[], object]) -> dict:
+    """Run a stage once in a fresh process and add its peak resident memory to its record
+
+    Unlike tracemalloc this includes the memory allocated by polars and SQLite, and the imports of the process.
+    run must be picklable, such as a partial of a module level function.
+
+    returns: The record
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        record['peak_rss_bytes'] = pool.submit(run_for_peak_rss, run).result()
+    if record['peak_rss_bytes'] is not None:
+        print(f'{record["stage"]:>24} {record["size_days"]:>4} days peak resident memory '
+              f'{record["peak_rss_bytes"] / 2**20:9.1f} MB')
+    return record
+
+
+def environment() -> dict:
+    """Return the versions and machine the benchmarks run on"""
+    versions = {}
+    for package in ['numpy', 'pandas', 'geopandas', 'shapely', 'polars', 'plotly', 'urllib3']:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_loc, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'run_at': datetime.now(timezone.utc).isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'packages': versions}
+
+
+def run_benchmarks(sizes: list[int] = bench_sizes, out_fname: str = results_fname) -> dict:
+    """Run every stage at each size in a scratch folder, and write the results to out_fname
+
+    returns: The results, with the environment
+    """
+    out_fname = os.path.abspath(out_fname)
+    original_cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='ais_bench_')
+    # The pipeline modules place their data folders under the working directory when they are imported, and spawned
+    # workers start there, so they are only imported once in the scratch folder
+    os.chdir(workdir)
+    records = []
+    try:
+        import ais_db
+        import channel_def
+        import classify_loads
+        import get_data_from_noaa
+        import load_port_data_to_db
+        import map_app
+        import map_cache
+
+        synthetic_ais.write_project(channel_def.project_folder)
+        sections = channel_def.get_project().location_sections
+        server = start_file_server(os.path.join(workdir, 'noaa_server'))
+        get_data_from_noaa.base_url = f'http://127.0.0.1:{server.server_port}'
+        os.makedirs(load_port_data_to_db.port_data_loc, exist_ok=True)
+        start_dt = datetime.fromisoformat(bench_start)
+        start_ms = int(start_dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+        for size in sizes:
+            dredge = synthetic_ais.simulate_dredge(bench_mmsi, start_ms, size)
+            dates = [(start_dt + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(size)]
+            background = synthetic_ais.background_traffic(background_vessels, start_ms, size)
+            noaa_days = synthetic_ais.split_days(pd.concat([dredge, background], ignore_index=True))
+            for day_start_ms, day in noaa_days.items():
+                this_date = datetime.fromtimestamp(day_start_ms / 1000, timezone.utc).strftime('%Y-%m-%d')
+                synthetic_ais.write_noaa_day(day, os.path.join(workdir, 'noaa_server', this_date[:4],
+                                                               f'ais-{this_date}.csv.zst'),
+                                             {bench_mmsi: 'RB WEEKS'})
+            noaa_rows = dredge.shape[0] + background.shape[0]
+            port_fname = f'synthetic_{size}.csv'
+            synthetic_ais.write_port_data(dredge, os.path.join(load_port_data_to_db.port_data_loc, port_fname))
+
+            def remove_downloads():
+                for d in dates:
+                    if os.path.exists(get_data_from_noaa.get_storage_fname(d)):
+                        os.remove(get_data_from_noaa.get_storage_fname(d))
+
+            def download_all():
+                for d in dates:
+                    get_data_from_noaa.download_ais_data(d)
+
+            records.append(measure('download_ais_data', size, noaa_rows, download_all, remove_downloads))
+
+            try:
+                import get_vessel_ais_from_noaa
+                extract = partial(get_vessel_ais_from_noaa.extract_vessel_ais, bench_mmsi, dates[0], dates[-1],
+                                  use_cache=False)
+                records.append(measure_peak_rss(measure('extract_vessel_ais', size, noaa_rows, extract), extract))
+
+                # The cache sorts a whole day in memory, so its peak is checked against the streaming extraction
+                def remove_parquet():
+                    if os.path.exists(get_vessel_ais_from_noaa.get_parquet_fname(dates[0])):
+                        os.remove(get_vessel_ais_from_noaa.get_parquet_fname(dates[0]))
+
+                convert = partial(get_vessel_ais_from_noaa.convert_day_to_parquet, dates[0])
+                day_rows = noaa_days[min(noaa_days)].shape[0]
+                records.append(measure('convert_day_to_parquet', 1, day_rows, convert, remove_parquet))
+                remove_parquet()
+                records.append(measure_peak_rss(records.pop(), convert))
+            except ImportError as e:
+                print(f'Skipping extract_vessel_ais: {e}')
+                records.append({'stage': 'extract_vessel_ais', 'size_days': size, 'skipped': str(e)})
+
+            def fresh_db():
+                for suffix in ['', '-wal', '-shm']:
+                    if os.path.exists(ais_db.ais_database + suffix):
+                        os.remove(ais_db.ais_database + suffix)
+
+            def load_port():
+                conn = ais_db.connect(ais_db.ais_database)
+                load_port_data_to_db.load_port_data_to_db(port_fname, conn)
+                conn.close()
+
+            records.append(measure('load_port_data_to_db', size, dredge.shape[0], load_port, fresh_db))
+            fresh_db()
+            load_port()
+            conn = ais_db.connect(ais_db.ais_database)
+
+            records.append(measure('load_ais_data', size, dredge.shape[0],
+                                   lambda: classify_loads.load_ais_data(conn, bench_mmsi, -2**62, 2**62)))
+            df = classify_loads.load_ais_data(conn, bench_mmsi, -2**62, 2**62)
+            df['activity'] = None
+            df['duration'] = df.index.diff()
+            records.append(measure('set_location', size, df.shape[0],
+                                   lambda: classify_loads.set_location(df.copy(), sections)))
+            located = classify_loads.set_location(df.copy(), sections)
+            records.append(measure('classify_delays_cycle', size, df.shape[0],
+                                   lambda: classify_loads.classify_cycle(classify_loads.classify_delays(
+                                       located.copy()))))
+
+            map_cache.pool = map_cache.ConnectionPool(ais_db.ais_database)
+            map_start = datetime.fromtimestamp(start_ms / 1000).isoformat()
+            map_end = datetime.fromtimestamp((start_ms + size * synthetic_ais.day_ms) / 1000).isoformat()
+
+            def draw_map():
+                return map_app.update_map(bench_mmsi, map_start, map_end)
+
+            def clear_map_caches():
+                conn.execute('DELETE FROM track_pyramid')
+                conn.commit()
+                map_cache.track_chunks.clear()
+                map_cache.day_counts.clear()
+                map_cache.static_trace_cache.clear()
+
+            records.append(measure('update_map_cold', size, dredge.shape[0], draw_map, clear_map_caches))
+            records.append(measure('update_map_warm', size, dredge.shape[0], draw_map))
+            conn.close()
+        server.shutdown()
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {'environment': environment(), 'results': records}
+    with open(out_fname, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Wrote {out_fname}')
+    return results
+
+
+def compare_results(baseline_fname: str, new_fname: str, threshold: float = regression_threshold) -> list[dict]:
+    """Compare two result files stage by stage, printing the change in the best time
+
+    returns: The stages that are more than threshold slower than the baseline
+    """
+    with open(baseline_fname) as f:
+        baseline = {(r['stage'], r['size_days']): r for r in json.load(f)['results'] if 'seconds_min' in r}
+    with open(new_fname) as f:
+        new = {(r['stage'], r['size_days']): r for r in json.load(f)['results'] if 'seconds_min' in r}
+    regressions = []
+    for key in sorted(set(baseline) & set(new)):
+        ratio = new[key]['seconds_min'] / baseline[key]['seconds_min'] if baseline[key]['seconds_min'] else None
+        flag = ''
+        if ratio is not None and ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append({'stage': key[0], 'size_days': key[1], 'ratio': ratio})
+        ratio_str = f'{ratio:6.2f}x' if ratio is not None else '      -'
+        print(f'{key[0]:>24} {key[1]:>4} days {baseline[key]["seconds_min"]:9.3f} s -> '
+              f'{new[key]["seconds_min"]:9.3f} s {ratio_str}{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        compare_results(sys.argv[1], sys.argv[2])
+    else:
+        run_benchmarks()
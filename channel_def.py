@@ -1,25 +1,38 @@
 """
 channel_def.py - Define the channel shapes
+
+Nothing is read at import. The geometry of a project is parsed the first time it is used, through get_project(), and
+the parsed and reprojected sections are cached on disk in geometry_cache_loc, keyed on the names, sizes and
+modification times of the source files. Later runs, and worker processes, load the cache instead of parsing the CSVs
+again. The module level names of the old interface (project_sections, project_center, ...) still work, and load the
+default project on first access. geopandas and shapely are only imported when a project is loaded, so importing this
+module is cheap for CLI tools and worker processes.
 """
+from functools import cached_property
 from glob import glob
+import hashlib
 import os.path
+import pickle
+from typing import TYPE_CHECKING
 
-import geopandas
-import pandas
-from shapely.geometry import LineString
+if TYPE_CHECKING:
+    import geopandas
+    import shapely
 
-# The folder with project specific coordinate files
-# Includes csv files with N, E coordinates of channel centerlines ("cl_*.csv"), dig areas ("dig_*.csv"),
+# The folders with project specific coordinate files, by project name
+# Each includes csv files with N, E coordinates of channel centerlines ("cl_*.csv"), dig areas ("dig_*.csv"),
 # and disposal areas ("disp_*.csv")
-project_folder = os.path.join(os.getcwd(), 'W912HY24B0007')
+projects = {'W912HY24B0007': os.path.join(os.getcwd(), 'W912HY24B0007')}
+default_project = 'W912HY24B0007'
+project_folder = projects[default_project]
+
+geometry_cache_loc = os.path.join(os.getcwd(), 'geometry_cache')
+geometry_cache_version = 1  # Bump when the cached contents change
 
 # Temporarily put any dredge tracks (from Marine Traffic) that you want to show on the map in gray
 names_tracks = []  # ['Break of Dawn 20230509']
 coords_tracks = []  # ['Break_of_Dawn_positions_Export_2023-05-09.csv'
 
-names = []
-coord_files = []
-
 # The keys of the colors dict are the allowed shape types to display
 # Coord files must have 'key_' in the filename, or they will be ignored
 colors = {'cl': 'black',
@@ -28,72 +41,187 @@ colors = {'cl': 'black',
           'track': 'gray'}
 loc_types = ['dig', 'disp']  # These are the section types the dredge can be inside
 
-for fname in glob(os.path.join(project_folder, '*.csv')):
-    coord_files.append(fname)
-    names.append(os.path.splitext(os.path.basename(fname))[0])
-
-geo_inputs = {}
-for s in colors.keys():
-    geo_inputs[s] = {'name':       [],  # ['CL HSC',     'CL BSC',     'CL BCC'],
-                     'coord_file': [],  # ['cl_HSC.csv', 'cl_BSC.csv', 'cl_BCC.csv'],
-                     'geometry':   [],
-                     'color':      [],
-                     'stations':   [],
-                     }
-
-removed: list[tuple[str:str]] = []
-for name, fname in zip(names, coord_files):
-    if '.csv' in fname:
-        coords = pandas.read_csv(os.path.join(project_folder, fname))
-        geom = LineString(list(zip(coords.E, coords.N)))
-    elif '.dxf' in fname:
-        dxf_gdf = geopandas.read_file(os.path.join(project_folder, fname))
-        geom = dxf_gdf.geometry
-    else:
-        print(f'WARNING File type not recognized for file {fname}, removing from the project files')
-        removed.append((name, fname))
-        continue
-    ftype = os.path.basename(fname).split('_')[0]
-    if ftype not in colors.keys():
-        print(f'WARNING Feature type not recognized for file {fname}, removing from the project files')
-        removed.append((name, fname))
-        continue
-    geo_inputs[ftype]['name'].append(name)
-    geo_inputs[ftype]['coord_file'].append(fname)
-    geo_inputs[ftype]['geometry'].append(geom)
-    geo_inputs[ftype]['color'].append(colors[ftype])
-    if ftype == 'cl':
-        geo_inputs[ftype]['stations'].append(list(coords.Station))
-    else:
-        geo_inputs[ftype]['stations'].append(None)
-    # Keeping the following in case I need to know how to convert coord files that are in lat/long
-    # elif 'positions_Export' in fname:  # Marine Traffic position export
-    #     # Marine traffic gives lat/long, so we have to convert it to (E, N) for the agent creation
-    #     track = geopandas.geodataframe.GeoDataFrame(coords,
-    #                                                 geometry=geopandas.points_from_xy(coords.Longitude, coords.Latitude,
-    #                                                                                   crs="EPSG:4326"),
-    #                                                 crs="EPSG:4326")
-    #     track.to_crs(epsg=2278, inplace=True)
-    #     geo_input['geometry'].append(LineString(track.geometry.to_list()))
-    #     geo_input['stations'].append(None)
-    #     geo_input['color'].append('gray')  # Show tracks in gray
-
-for name, fname in removed:
-    names.pop(name)
-    coord_files.pop(fname)
-print('Loaded the following files:')
-for fname in coord_files:
-    print(fname)
-print()
-
-project_sections = {}
-combined_gdf = None
-for gtype in geo_inputs.keys():
-    project_sections[gtype] = geopandas.GeoDataFrame(geo_inputs[gtype], crs='epsg:2278').to_crs(epsg=4326)
-    if combined_gdf is None:
-        combined_gdf = project_sections[gtype]
-    else:
-        combined_gdf = pandas.concat([combined_gdf, project_sections[gtype]], ignore_index=True)
-
-project_center_NE = combined_gdf.to_crs(crs='epsg:2278').dissolve().centroid
-project_center = geopandas.GeoDataFrame(geometry=project_center_NE, crs='epsg:2278').to_crs(epsg=4326)
+
+class ProjectGeometry:
+    """The sections of one project, loaded on first access
+
+    name: The project name
+    folder: The folder with the coordinate files
+    """
+    def __init__(self, name: str, folder: str):
+        self.name = name
+        self.folder = folder
+        self.geofences = {}
+
+    def source_files(self) -> list[str]:
+        """Return the coordinate files in the project folder"""
+        return sorted(glob(os.path.join(self.folder, '*.csv')))
+
+    def cache_key(self) -> str:
+        """Return a hash of the source file names, sizes and modification times"""
+        h = hashlib.sha256(f'{geometry_cache_version}'.encode())
+        for fname in self.source_files():
+            st = os.stat(fname)
+            h.update(f'{os.path.basename(fname)}|{st.st_size}|{st.st_mtime_ns}'.encode())
+        return h.hexdigest()[:16]
+
+    def cache_fname(self) -> str:
+        """Return the cache filename including path"""
+        return os.path.join(geometry_cache_loc, f'{self.name}-{self.cache_key()}.pkl')
+
+    def parse(self) -> dict:
+        """Parse the coordinate files and reproject the sections
+
+        returns: dict with the coord_files, names, geo_inputs, project_sections and project_center
+        """
+        import geopandas
+        import pandas
+        from shapely.geometry import LineString
+
+        names = []
+        coord_files = []
+        geo_inputs = {}
+        for s in colors.keys():
+            geo_inputs[s] = {'name':       [],  # ['CL HSC',     'CL BSC',     'CL BCC'],
+                             'coord_file': [],  # ['cl_HSC.csv', 'cl_BSC.csv', 'cl_BCC.csv'],
+                             'geometry':   [],
+                             'color':      [],
+                             'stations':   [],
+                             }
+
+        for fname in self.source_files():
+            name = os.path.splitext(os.path.basename(fname))[0]
+            if '.csv' in fname:
+                coords = pandas.read_csv(fname)
+                geom = LineString(list(zip(coords.E, coords.N)))
+            elif '.dxf' in fname:
+                dxf_gdf = geopandas.read_file(fname)
+                geom = dxf_gdf.geometry
+            else:
+                print(f'WARNING File type not recognized for file {fname}, removing from the project files')
+                continue
+            ftype = os.path.basename(fname).split('_')[0]
+            if ftype not in colors.keys():
+                print(f'WARNING Feature type not recognized for file {fname}, removing from the project files')
+                continue
+            names.append(name)
+            coord_files.append(fname)
+            geo_inputs[ftype]['name'].append(name)
+            geo_inputs[ftype]['coord_file'].append(fname)
+            geo_inputs[ftype]['geometry'].append(geom)
+            geo_inputs[ftype]['color'].append(colors[ftype])
+            if ftype == 'cl':
+                geo_inputs[ftype]['stations'].append(list(coords.Station))
+            else:
+                geo_inputs[ftype]['stations'].append(None)
+            # Keeping the following in case I need to know how to convert coord files that are in lat/long
+            # elif 'positions_Export' in fname:  # Marine Traffic position export
+            #     # Marine traffic gives lat/long, so we have to convert it to (E, N) for the agent creation
+            #     track = geopandas.geodataframe.GeoDataFrame(coords,
+            #                                                 geometry=geopandas.points_from_xy(coords.Longitude,
+            #                                                                                   coords.Latitude,
+            #                                                                                   crs="EPSG:4326"),
+            #                                                 crs="EPSG:4326")
+            #     track.to_crs(epsg=2278, inplace=True)
+            #     geo_input['geometry'].append(LineString(track.geometry.to_list()))
+            #     geo_input['stations'].append(None)
+            #     geo_input['color'].append('gray')  # Show tracks in gray
+        print(f'Loaded the following files for project {self.name}:')
+        for fname in coord_files:
+            print(fname)
+        print()
+
+        # The center is found in the projected CRS, then every section is converted to lat/lon once
+        sections_ne = {gtype: geopandas.GeoDataFrame(geo_inputs[gtype], crs='epsg:2278') for gtype in geo_inputs}
+        combined_ne = pandas.concat(list(sections_ne.values()), ignore_index=True)
+        project_center_ne = combined_ne.dissolve().centroid
+        project_sections = {gtype: gdf.to_crs(epsg=4326) for gtype, gdf in sections_ne.items()}
+        project_center = geopandas.GeoDataFrame(geometry=project_center_ne, crs='epsg:2278').to_crs(epsg=4326)
+        return {'coord_files': coord_files,
+                'names': names,
+                'geo_inputs': geo_inputs,
+                'project_sections': project_sections,
+                'project_center_NE': project_center_ne,
+                'project_center': project_center}
+
+    @cached_property
+    def data(self) -> dict:
+        """The parsed project, from the disk cache if the source files have not changed"""
+        cache_fname = self.cache_fname()
+        if os.path.isfile(cache_fname):
+            with open(cache_fname, 'rb') as f:
+                return pickle.load(f)
+        data = self.parse()
+        os.makedirs(geometry_cache_loc, exist_ok=True)
+        for stale_fname in glob(os.path.join(geometry_cache_loc, f'{self.name}-*.pkl')):
+            os.remove(stale_fname)
+        with open(cache_fname + '.tmp', 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(cache_fname + '.tmp', cache_fname)
+        return data
+
+    @property
+    def project_sections(self) -> dict[str, 'geopandas.GeoDataFrame']:
+        """The sections by feature type, in EPSG:4326"""
+        return self.data['project_sections']
+
+    @property
+    def project_center(self) -> 'geopandas.GeoDataFrame':
+        """The centroid of all the sections, in EPSG:4326"""
+        return self.data['project_center']
+
+    @property
+    def location_sections(self) -> dict[str, 'geopandas.GeoDataFrame']:
+        """The sections the dredge can be inside, see loc_types"""
+        return dict([(k, v) for k, v in self.project_sections.items() if k in loc_types])
+
+    @cached_property
+    def combined_gdf(self) -> 'geopandas.GeoDataFrame':
+        """All the sections in one GeoDataFrame, in EPSG:4326"""
+        import pandas
+        return pandas.concat(list(self.project_sections.values()), ignore_index=True)
+
+    def geofence(self, buffer_ft: float) -> 'shapely.Geometry':
+        """The area within buffer_ft of any section, in EPSG:4326, for picking out the traffic around the project
+
+        The dig and disposal outlines are filled in, and the buffer is found in feet before converting to lat/lon.
+        The outline is simplified to a twentieth of the buffer, so point tests against it stay cheap.
+        """
+        if buffer_ft not in self.geofences:
+            import numpy
+            import shapely
+            import projection
+            from section_locator import section_polygon
+            shapes = [section_polygon(g) if ftype in loc_types else g
+                      for ftype, inputs in self.data['geo_inputs'].items() for g in inputs['geometry']]
+            area = shapely.union_all(shapes).buffer(buffer_ft).simplify(buffer_ft / 20)
+            self.geofences[buffer_ft] = shapely.transform(
+                area, lambda xy: numpy.column_stack(projection.to_latlon(xy[:, 0], xy[:, 1])))
+        return self.geofences[buffer_ft]
+
+    @cached_property
+    def locator(self):
+        """The prepared polygons of the location sections, see section_locator.SectionLocator"""
+        from section_locator import get_locator
+        return get_locator(self.location_sections)
+
+
+loaded_projects: dict[str, ProjectGeometry] = {}
+
+
+def get_project(name: str | None = None) -> ProjectGeometry:
+    """Return the geometry of the named project, or the default project. Nothing is read until it is used"""
+    if name is None:
+        name = default_project
+    if name not in loaded_projects:
+        loaded_projects[name] = ProjectGeometry(name, projects[name])
+    return loaded_projects[name]
+
+
+def __getattr__(name: str):
+    """Load the default project for the module level names of the old interface"""
+    if name in ('project_sections', 'project_center', 'project_center_NE', 'names', 'coord_files', 'geo_inputs'):
+        return get_project().data[name]
+    if name == 'combined_gdf':
+        return get_project().combined_gdf
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -7,96 +7,823 @@ loading - In dig area at <2.5 knots for at least 5 min
 sailing - Sustained speed > 2.5 knots
 discharge - In disposal area and speed < 2.5 knots for at least 5 min
 delay - speed <=0.5 knots for at least 5 min"""
-from datetime import datetime, timedelta
-import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import hashlib
+import multiprocessing
 import sqlite3
+from typing import Iterable, Iterator
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import shapely
 
-from channel_def import project_sections, loc_types
-
-ais_database = os.path.join(os.getcwd(), 'Matsu_AIS.sqlite')
+import ais_db
+from ais_db import ais_database
+from channel_def import get_project
+from instrumentation import span
+from section_locator import get_locator
+from track import Track, activities, activity_names, load_track, section_names
+from vessel_mmsi import mmsi_from_name
+
+
+# The columns load_ais_data reads by default, and the types they are loaded as. sog stays float64 so its rolling means
+# compare with the speed thresholds exactly
+ais_query_columns = ['utc_timestamp_ms', 'mmsi', 'longitude', 'latitude', 'sog', 'cog', 'heading', 'status']
+ais_query_dtypes = {'utc_timestamp_ms': 'int64',
+                    'mmsi': 'int32',
+                    'longitude': 'float64',
+                    'latitude': 'float64',
+                    'sog': 'float64',
+                    'cog': 'float32',
+                    'heading': 'float32',
+                    'status': 'Int16',
+                    'cargo': 'Int16',
+                    'draft': 'float32',
+                    'file_id': 'Int32',
+                    'easting': 'float64',
+                    'northing': 'float64'}
+
+earth_radius_nm = 3440.065
+
+# Reception gaps longer than gap_ms split a track into segments. Rolling windows do not reach across a gap, and the
+# point after a gap accounts for no time. Otherwise a point accounts for the time since the previous point, up to
+# max_point_duration_ms
+gap_ms = 15 * 60 * 1000
+max_point_duration_ms = 6 * 60 * 1000
+# The centered rolling window of the speed used by each rule, in ms
+rule_windows_ms = {'delay': 5 * 60 * 1000,
+                   'dig': 5 * 60 * 1000,
+                   'disp': 5 * 60 * 1000}
+# rolling_mean sums the values in integer units of 1 / rolling_scale. AIS speeds come in steps of 0.1 kn, so they are
+# held exactly, and a season of points at 100 kn stays far from the int64 limit
+rolling_scale = 10**6
+# The longest rolling window, incremental runs redo this much before the last classified point
+classify_window_ms = max(rule_windows_ms.values())
+stream_chunk_rows = 65536  # Rows read from the DB at a time by iter_classified_data
+fleet_chunk_ms = 7 * 24 * 60 * 60 * 1000  # The length of the time chunks classify_fleet hands to each worker
+# The activity rollups are stored per UTC hour, and get_rollups sums them into these buckets. UTC weeks start on
+# Monday, the epoch was a Thursday
+hour_ms = 60 * 60 * 1000
+rollup_buckets = {'hour': (hour_ms, 0),  # (length, offset from the epoch) in ms
+                  'day': (24 * hour_ms, 0),
+                  'week': (7 * 24 * hour_ms, 4 * 24 * hour_ms)}
+rollup_chunk_ms = 7 * 24 * hour_ms  # The classified data read at a time by update_rollups
 
 
 def set_location(ais_gdf: gpd.GeoDataFrame, sections_geo: dict[str: gpd.GeoDataFrame]) -> gpd.GeoDataFrame:
     """Determine where the dredge is in the project
 
-    ais_df : Geopandas dataframe with AIS positions
+    The points are classified in one pass by a SectionLocator, which is built once per set of sections
+
+    ais_df : Dataframe with longitude and latitude columns, or a geopandas dataframe with AIS positions
     sections_geo: dict of geodataframes with sections the dredge can enter
 
     returns: Dataframe with ais locations and an added column with dredge locations"""
-    if 'section' not in ais_gdf.columns:
-        ais_gdf['section'] = None
-    for sec_type in sections_geo.keys():
-        for g in sections_geo[sec_type].geometry:
-            p = shapely.geometry.Polygon(g.coords)
-            inters = ais_gdf.intersects(p)
-            ais_gdf.loc[inters, 'section'] = sec_type
+    with span('locate', rows=ais_gdf.shape[0]):
+        locator = get_locator(sections_geo)
+        if 'longitude' in ais_gdf.columns and 'latitude' in ais_gdf.columns:
+            x, y = ais_gdf['longitude'].to_numpy(), ais_gdf['latitude'].to_numpy()
+        else:
+            x, y = ais_gdf.geometry.x.to_numpy(), ais_gdf.geometry.y.to_numpy()
+        ais_gdf['section'] = locator.locate(x, y)
 
     return ais_gdf
 
 
-def classify_delays(ais_df, min_speed=0.5, min_time=5):
+def segment_starts(ts: np.ndarray, max_gap_ms: int | None = None) -> np.ndarray:
+    """Return a mask of the points that start a segment, the first point and each point after a gap
+
+    ts: The point timestamps in UTC ms, in time order
+    max_gap_ms: Gaps longer than this start a new segment, defaults to gap_ms
+    """
+    if max_gap_ms is None:
+        max_gap_ms = gap_ms
+    ts = np.asarray(ts, dtype=np.int64)
+    return np.concatenate([[True], np.diff(ts) > max_gap_ms]) if ts.shape[0] else np.zeros(0, dtype=bool)
+
+
+def point_durations_ms(ts: np.ndarray, prev_ts: int | None = None, max_gap_ms: int | None = None,
+                       max_duration_ms: int | None = None) -> np.ndarray:
+    """Return the time each point accounts for, the time since the previous point capped at max_duration_ms
+
+    The first point, and a point after a gap longer than max_gap_ms, account for no time.
+
+    ts: The point timestamps in UTC ms, in time order
+    prev_ts: The timestamp of the point before the first, if there is one
+    max_gap_ms: defaults to gap_ms
+    max_duration_ms: defaults to max_point_duration_ms
+    """
+    if max_gap_ms is None:
+        max_gap_ms = gap_ms
+    if max_duration_ms is None:
+        max_duration_ms = max_point_duration_ms
+    ts = np.asarray(ts, dtype=np.int64)
+    if ts.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    diff = np.diff(ts, prepend=ts[0] if prev_ts is None else prev_ts)
+    return np.where(diff > max_gap_ms, 0, np.minimum(diff, max_duration_ms))
+
+
+def rolling_mean(ts: np.ndarray, values: np.ndarray, window_ms: int, max_gap_ms: int | None = None) -> np.ndarray:
+    """Return the centered rolling mean of values over a time window, without reaching across gaps
+
+    For each point the mean is over the points of its segment within window_ms / 2 on either side, inclusive, as
+    pandas rolling(window, center=True, closed='both') does. NaN values are skipped. The window bounds are found by
+    binary search on the timestamps and the sums taken from cumulative sums, so the cost does not depend on the
+    window. The values are summed as integer multiples of 1 / rolling_scale, so the window sums are exact whatever
+    the length of the track or where it starts, and a mean that lands on a speed threshold compares equal to it.
+
+    ts: The point timestamps in UTC ms, in time order
+    values: The values to average
+    window_ms: The width of the window
+    max_gap_ms: Gaps longer than this split the track, see segment_starts
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    n = ts.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    # The first and one past the last index of each point's segment
+    starts = segment_starts(ts, max_gap_ms)
+    seg_id = np.cumsum(starts) - 1
+    seg_first = np.flatnonzero(starts)
+    seg_end = np.append(seg_first[1:], n)
+    lo = np.maximum(np.searchsorted(ts, ts - window_ms // 2, 'left'), seg_first[seg_id])
+    hi = np.minimum(np.searchsorted(ts, ts + window_ms // 2, 'right'), seg_end[seg_id])
+    valid = ~np.isnan(values)
+    scaled = np.round(np.where(valid, values, 0.0) * rolling_scale).astype(np.int64)
+    sums = np.concatenate([[0], np.cumsum(scaled)])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    count = counts[hi] - counts[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # One division of the exact sum, so the mean is the correctly rounded mean of the scaled values
+        return np.where(count > 0, (sums[hi] - sums[lo]) / (count * rolling_scale), np.nan)
+
+
+def rule_speed(ais_df: pd.DataFrame, rule: str) -> np.ndarray:
+    """Return the rolling speed for a rule's window, reusing the rolling_speed column if the window is the delay
+    window"""
+    if rule_windows_ms[rule] == rule_windows_ms['delay'] and 'rolling_speed' in ais_df.columns:
+        return ais_df['rolling_speed'].to_numpy(dtype=np.float64)
+    return rolling_mean(ais_df['utc_timestamp_ms'].to_numpy(), ais_df['sog'].to_numpy(), rule_windows_ms[rule])
+
+
+def classify_delays(ais_df, min_speed=0.5, min_time=None):
     """Classify the delay points in the ais data
 
     delay -> speed <=0.5 knots for at least 5 min
 
-    ais_df: Pandas or geopandas dataframe with ais data and a date field
+    The speed is averaged over a centered window within each segment of the track, see rolling_mean
+
+    ais_df: Pandas or geopandas dataframe with ais data, in time order, with a utc_timestamp_ms column
     min_speed: minimum speed in knots
-    min_time: minimum time in minutes
+    min_time: minimum time in minutes, defaults to the delay window in rule_windows_ms
 
     returns The df with a rolling speed column and delay rows classified
     """
-    time_window = timedelta(minutes=min_time)
-    ais_df['rolling_speed'] = ais_df['sog'].rolling(window=time_window,
-                                                    closed='both',
-                                                    center=True,
-                                                    min_periods=1).mean()
+    window_ms = rule_windows_ms['delay'] if min_time is None else int(min_time * 60 * 1000)
+    ais_df['rolling_speed'] = rolling_mean(ais_df['utc_timestamp_ms'].to_numpy(), ais_df['sog'].to_numpy(), window_ms)
 
     ais_df.loc[ais_df['rolling_speed'] <= min_speed, 'activity'] = 'delay'
     return ais_df
 
 
 def classify_cycle(ais_gdf, dig_speed=2.5, disp_speed=2.5):
-    """Classify the cycle elements in the ais data"""
+    """Classify the cycle elements in the ais data
+
+    The dig and disposal rules use the rolling speed over their windows in rule_windows_ms"""
     ais_gdf.loc[((ais_gdf['activity'].isnull()) &
-                 (ais_gdf['rolling_speed'] <= dig_speed) &
+                 (rule_speed(ais_gdf, 'dig') <= dig_speed) &
                  (ais_gdf['section'] == 'dig')), 'activity'] = 'dig'
     ais_gdf.loc[((ais_gdf['activity'].isnull()) &
-                 (ais_gdf['rolling_speed'] <= disp_speed) &
+                 (rule_speed(ais_gdf, 'disp') <= disp_speed) &
                  (ais_gdf['section'] == 'disp')), 'activity'] = 'disp'
     ais_gdf.loc[ais_gdf['activity'].isnull(), 'activity'] = 'sail'
     return ais_gdf
 
 
-def load_ais_data(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float) -> pd.DataFrame:
+def load_ais_data(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float,
+                  columns: list[str] | None = None) -> pd.DataFrame:
     """Load AIS data between the start and end timestamps
 
-    Adds a date column, sorts by date, and set date as index
+    The DB returns the rows in time order, and a timezone aware UTC date index is built from utc_timestamp_ms
 
     :param conn: Connection to the DB with AIS data
     :param mmsi: Vessel MMSI number
     :param start_ts: start timestamp in UTC ms
     :param end_ts: end timestamp in UTC ms
+    :param columns: The ais_data columns to load, defaults to ais_query_columns. utc_timestamp_ms is always loaded
 
     :return: Pandas dataframe with AIS data
     """
-    qry = f"""SELECT * FROM ais_data WHERE utc_timestamp_ms>={start_ts} AND
-                                           utc_timestamp_ms<={end_ts} AND
-                                           mmsi={mmsi};
+    if columns is None:
+        columns = ais_query_columns
+    columns = ['utc_timestamp_ms'] + [c for c in columns if c != 'utc_timestamp_ms']
+    unknown = set(columns) - set(ais_db.ais_data_columns + ais_db.projected_columns)
+    if unknown:
+        raise ValueError(f'load_ais_data: unknown ais_data columns {unknown}')
+    qry = f"""SELECT {', '.join(columns)} FROM ais_data
+              WHERE mmsi=? AND utc_timestamp_ms>=? AND utc_timestamp_ms<=?
+              ORDER BY utc_timestamp_ms;
            """
 
-    new_df = pd.read_sql(qry, conn)
-    new_df['date'] = new_df.apply(lambda row: datetime.fromtimestamp(row.utc_timestamp_ms / 1000), axis=1)
-    new_df.sort_values(by=['date'], ascending=True, inplace=True)
+    with span('query', mmsi=mmsi) as s:
+        new_df = pd.read_sql(qry, conn, params=(mmsi, start_ts, end_ts),
+                             dtype={c: t for c, t in ais_query_dtypes.items() if c in columns})
+        s.rows = new_df.shape[0]
+    new_df['date'] = pd.to_datetime(new_df['utc_timestamp_ms'], unit='ms', utc=True)
     new_df.set_index('date', inplace=True)
     return new_df
 
 
+def classify_track(track: Track, sections_geo: dict[str: gpd.GeoDataFrame], min_speed: float = 0.5,
+                   dig_speed: float = 2.5, disp_speed: float = 2.5) -> Track:
+    """Classify the points of a Track, as classify_delays, set_location and classify_cycle do for a dataframe
+
+    Sets the rolling_speed, section and activity columns of each vessel's points. Only the typed columns are used,
+    no dataframe or point geometry is built.
+
+    track: The points to classify, see track.Track
+    sections_geo: dict of geodataframes with sections the dredge can enter
+
+    returns: The track
+    """
+    with span('classify', rows=len(track)):
+        with span('locate', rows=len(track)):
+            track.locate(sections_geo)
+        rolling = np.full(len(track), np.nan)
+        rules = {rule: np.full(len(track), np.nan) for rule in ['dig', 'disp']}
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(track.mmsi)) + 1, [len(track)]])
+        for start, end in zip(bounds[:-1], bounds[1:]):  # Rolling windows do not reach across vessels
+            ts, sog = track.utc_timestamp_ms[start:end], track.sog[start:end]
+            rolling[start:end] = rolling_mean(ts, sog, rule_windows_ms['delay'])
+            for rule in rules:
+                rules[rule][start:end] = rolling[start:end] if rule_windows_ms[rule] == rule_windows_ms['delay'] \
+                    else rolling_mean(ts, sog, rule_windows_ms[rule])
+        act = np.full(len(track), -1, dtype=np.int8)
+        with np.errstate(invalid='ignore'):
+            act[rolling <= min_speed] = activity_names.index('delay')
+            for rule, speed in [('dig', dig_speed), ('disp', disp_speed)]:
+                act[(act == -1) & (rules[rule] <= speed) & (track.section == section_names.index(rule))] = \
+                    activity_names.index(rule)
+        act[act == -1] = activity_names.index('sail')
+        track.rolling_speed = rolling
+        track.activity = act
+    return track
+
+
+def sections_hash(sections_geo: dict[str: gpd.GeoDataFrame]) -> str:
+    """Return a hash of the section types and geometries, stored with the classification to detect changes"""
+    h = hashlib.sha256()
+    for sec_type in sections_geo.keys():
+        h.update(sec_type.encode())
+        for wkb in shapely.to_wkb(sections_geo[sec_type].geometry.values):
+            h.update(wkb)
+    return h.hexdigest()
+
+
+def save_classification(conn: sqlite3.Connection, track: Track, mmsi: int) -> None:
+    """Write the section, rolling_speed and activity of classified points to ais_classified, replacing earlier
+    results for the same points. Does not commit."""
+    rows = zip([mmsi] * len(track),
+               track.utc_timestamp_ms.tolist(),
+               track.section_names().tolist(),
+               track.rolling_speed.tolist(),
+               track.activity_names().tolist())
+    conn.executemany('INSERT OR REPLACE INTO ais_classified (mmsi, utc_timestamp_ms, section, rolling_speed, activity) '
+                     'VALUES (?, ?, ?, ?, ?)', rows)
+
+
+def classify_range(conn: sqlite3.Connection, mmsi: int, sections_geo: dict[str: gpd.GeoDataFrame],
+                   start_ts: float, end_ts: float) -> Track:
+    """Classify the AIS points of a vessel between the start and end timestamps
+
+    One rolling window of data on each side of the range is loaded for context, so the points in the range are
+    classified as they would be if all the data were classified at once.
+
+    returns: The classified points in the range as a Track, see classify_track
+    """
+    with span('query', mmsi=mmsi) as s:
+        track = load_track(conn, mmsi, start_ts - classify_window_ms, end_ts + classify_window_ms, classified=False)
+        s.rows = len(track)
+    return classify_track(track, sections_geo).between(start_ts, end_ts)
+
+
+def classify_incremental(conn: sqlite3.Connection, mmsi: int, sections_geo: dict[str: gpd.GeoDataFrame],
+                         end_ts: float | None = None, chunk_ms: int = fleet_chunk_ms) -> int:
+    """Classify the AIS data for a vessel that arrived since the last run, and store the results
+
+    Points from one rolling window before the stored watermark are classified again, since their centered window now
+    has data on both sides, and one more window before that is loaded for context. If the section geometry has
+    changed since the last run, all the stored results for the vessel, including its loads, are dropped and it is
+    classified from the start. The range is classified in time chunks of chunk_ms, as classify_fleet does, so a
+    vessel's whole history is never in memory at once. Each chunk is committed and moves the watermark, so an
+    interrupted run carries on from the last chunk. The activity rollups of the hours classified are rebuilt, see
+    update_rollups.
+
+    conn: Connection to the AIS database
+    mmsi: Vessel MMSI number
+    sections_geo: dict of geodataframes with sections the dredge can enter
+    end_ts: Classify up to this timestamp in UTC ms, defaults to all the data
+    chunk_ms: The length of the time chunks in ms
+
+    returns: The number of points classified
+    """
+    geometry_hash = sections_hash(sections_geo)
+    state = conn.execute('SELECT watermark_ms, geometry_hash FROM classification_state WHERE mmsi=?',
+                         (mmsi, )).fetchone()
+    if state is None or state[1] != geometry_hash:
+        if state is not None:
+            print(f'classify_incremental: section geometry changed, reclassifying {mmsi} from the start')
+        conn.execute('DELETE FROM ais_classified WHERE mmsi=?', (mmsi, ))
+        conn.execute('DELETE FROM activity_rollups WHERE mmsi=?', (mmsi, ))
+        conn.execute('DELETE FROM loads WHERE mmsi=?', (mmsi, ))
+        watermark = None
+    else:
+        watermark = state[0]
+        backfill_rollups(conn, mmsi)
+    first_ts, last_ts = conn.execute('SELECT min(utc_timestamp_ms), max(utc_timestamp_ms) FROM ais_data '
+                                     'WHERE mmsi=?', (mmsi, )).fetchone()
+    if first_ts is None:
+        return 0
+    end_ts = last_ts if end_ts is None else min(int(end_ts), last_ts)
+    if watermark is not None and end_ts <= watermark:
+        return 0
+
+    redo_from = first_ts if watermark is None else watermark - classify_window_ms
+    classified = 0
+    classified_from = classified_to = None
+    for chunk_start in range(int(redo_from), int(end_ts) + 1, chunk_ms):
+        track = classify_range(conn, mmsi, sections_geo, chunk_start, min(chunk_start + chunk_ms - 1, int(end_ts)))
+        if len(track) == 0:
+            continue
+        save_classification(conn, track, mmsi)
+        classified_to = int(track.utc_timestamp_ms.max())
+        if classified_from is None:
+            classified_from = int(track.utc_timestamp_ms.min())
+        conn.execute('INSERT OR REPLACE INTO classification_state (mmsi, watermark_ms, geometry_hash, updated) '
+                     'VALUES (?, ?, ?, ?)', (mmsi, classified_to, geometry_hash, datetime.now()))
+        conn.commit()
+        classified += len(track)
+    if classified:
+        update_rollups(conn, mmsi, classified_from, classified_to)
+    return classified
+
+
+def classify_chunk(db_path: str, project_name: str | None, mmsi: int, start_ts: int, end_ts: int) -> Track:
+    """Classify one time chunk of a vessel's data in a worker process, see classify_fleet
+
+    returns: The classified points as a Track, see classify_range
+    """
+    conn = ais_db.connect(db_path, read_only=True)
+    try:
+        return classify_range(conn, mmsi, get_project(project_name).location_sections, start_ts, end_ts)
+    finally:
+        conn.close()
+
+
+def classify_fleet(conn: sqlite3.Connection, mmsi_list: list[int] | None = None, start_ts: float | None = None,
+                   end_ts: float | None = None, project_name: str | None = None, chunk_ms: int = fleet_chunk_ms,
+                   workers: int = 4, db_path: str = ais_database) -> dict[int, int]:
+    """Classify the AIS data of several vessels in a pool of worker processes, and store the results
+
+    Each vessel is classified from its stored watermark as in classify_incremental, or from start_ts if that is
+    earlier, and the range is split into chunks of chunk_ms that are classified in parallel. Each chunk loads one
+    rolling window of context on either side, so the results are the same as classifying the whole range at once.
+    This process writes each chunk's results as they arrive, and moves a vessel's watermark and updates its activity
+    rollups once all its chunks are written, so an interrupted run is redone from the old watermark.
+
+    conn: Writable connection to the AIS database
+    mmsi_list: The vessels to classify, defaults to every vessel in ais_data
+    start_ts: Reclassify from at least this timestamp in UTC ms
+    end_ts: Classify up to this timestamp in UTC ms, defaults to all the data
+    project_name: The project whose sections are used, see channel_def.get_project
+    chunk_ms: The length of the time chunks in ms
+    workers: The number of classifying processes
+    db_path: The database file the workers read from, the same database as conn
+
+    returns: The number of points classified for each vessel
+    """
+    if mmsi_list is None:
+        mmsi_list = [r[0] for r in conn.execute('SELECT DISTINCT mmsi FROM ais_data').fetchall()]
+    geometry_hash = sections_hash(get_project(project_name).location_sections)
+
+    # Plan the chunks, and drop the stored results of vessels classified with other sections
+    chunks = []
+    ranges = {}
+    for mmsi in mmsi_list:
+        first_ts, last_ts = conn.execute('SELECT min(utc_timestamp_ms), max(utc_timestamp_ms) FROM ais_data '
+                                         'WHERE mmsi=?', (mmsi, )).fetchone()
+        if first_ts is None:
+            continue
+        redo_to = last_ts if end_ts is None else min(int(end_ts), last_ts)
+        state = conn.execute('SELECT watermark_ms, geometry_hash FROM classification_state WHERE mmsi=?',
+                             (mmsi, )).fetchone()
+        if state is None or state[1] != geometry_hash:
+            if state is not None:
+                print(f'classify_fleet: section geometry changed, reclassifying {mmsi} from the start')
+            conn.execute('DELETE FROM ais_classified WHERE mmsi=?', (mmsi, ))
+            conn.execute('DELETE FROM classification_state WHERE mmsi=?', (mmsi, ))
+            conn.execute('DELETE FROM activity_rollups WHERE mmsi=?', (mmsi, ))
+            conn.execute('DELETE FROM loads WHERE mmsi=?', (mmsi, ))
+            redo_from = first_ts
+        elif redo_to <= state[0] and (start_ts is None or start_ts >= state[0]):
+            backfill_rollups(conn, mmsi)
+            continue  # No new data, and no earlier range to redo
+        else:
+            backfill_rollups(conn, mmsi)
+            redo_from = state[0] - classify_window_ms
+            if start_ts is not None:
+                redo_from = min(redo_from, start_ts)
+        if redo_to < redo_from:
+            continue
+        ranges[mmsi] = (int(redo_from), int(redo_to))
+        for chunk_start in range(int(redo_from), int(redo_to) + 1, chunk_ms):
+            chunks.append((mmsi, chunk_start, min(chunk_start + chunk_ms - 1, int(redo_to))))
+    conn.commit()
+    print(f'classify_fleet: {len(chunks)} chunks for {len(ranges)} vessels')
+
+    classified = {mmsi: 0 for mmsi in ranges}
+    remaining = {mmsi: 0 for mmsi in ranges}
+    watermarks = {mmsi: None for mmsi in ranges}
+    for mmsi, _, _ in chunks:
+        remaining[mmsi] += 1
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(classify_chunk, db_path, project_name, *chunk): chunk for chunk in chunks}
+        for fut in as_completed(futures):
+            mmsi, _, _ = futures[fut]
+            result = fut.result()
+            if len(result):
+                save_classification(conn, result, mmsi)
+                classified[mmsi] += len(result)
+                chunk_max = int(result.utc_timestamp_ms.max())
+                watermarks[mmsi] = chunk_max if watermarks[mmsi] is None else max(watermarks[mmsi], chunk_max)
+            remaining[mmsi] -= 1
+            if remaining[mmsi] == 0 and watermarks[mmsi] is not None:
+                old = conn.execute('SELECT watermark_ms FROM classification_state WHERE mmsi=?', (mmsi, )).fetchone()
+                watermark = watermarks[mmsi] if old is None else max(watermarks[mmsi], old[0])
+                conn.execute('INSERT OR REPLACE INTO classification_state (mmsi, watermark_ms, geometry_hash, updated) '
+                             'VALUES (?, ?, ?, ?)', (mmsi, watermark, geometry_hash, datetime.now()))
+            conn.commit()
+            if remaining[mmsi] == 0:
+                update_rollups(conn, mmsi, *ranges[mmsi])
+    return classified
+
+
+def point_distances_nm(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """Return the great circle distance in nautical miles from the previous point to each point, 0 for the first"""
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    dist = np.zeros(lon.shape[0])
+    a = (np.sin(np.diff(lat) / 2) ** 2 +
+         np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2)
+    dist[1:] = 2 * earth_radius_nm * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return dist
+
+
+def update_loads(conn: sqlite3.Connection, mmsi: int) -> pd.DataFrame:
+    """Update the stored loads for a vessel from its stored classification
+
+    The last stored load may have been incomplete, so it and everything after it is segmented again
+
+    conn: Connection to the AIS database
+    mmsi: Vessel MMSI number
+
+    returns: The loads that were written
+    """
+    last_start = conn.execute('SELECT max(start_ms) FROM loads WHERE mmsi=?', (mmsi, )).fetchone()[0]
+    first_ts = -2**62 if last_start is None else last_start
+    conn.execute('DELETE FROM loads WHERE mmsi=? AND start_ms>=?', (mmsi, first_ts))
+    written = []
+    # The classified points are read and segmented a chunk at a time, see iter_loads
+    for loads in iter_loads(iter_classified_data(conn, mmsi, first_ts - classify_window_ms, 2**62), first_ts):
+        columns = ['mmsi'] + list(loads.columns)
+        conn.executemany(f"INSERT INTO loads ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+                         [(mmsi, *row) for row in loads.itertuples(index=False, name=None)])
+        written.append(loads)
+    conn.commit()
+    return pd.concat(written, ignore_index=True) if written else LoadSegmenter().empty()
+
+
+def get_loads(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float) -> pd.DataFrame:
+    """Return the stored loads for a vessel that start between the start and end timestamps in UTC ms"""
+    loads = pd.read_sql('SELECT * FROM loads WHERE mmsi=? AND start_ms>=? AND start_ms<=? ORDER BY start_ms',
+                        conn, params=(mmsi, start_ts, end_ts))
+    loads['complete'] = loads['complete'].astype(bool)
+    return loads
+
+
+def rollup_points(track: Track, first_ts: float | None = None) -> pd.DataFrame:
+    """Total the classified points by UTC hour, section and activity
+
+    Each point's duration (see point_durations_ms) and distance from the previous point count towards its hour. As
+    with the duration, no distance is counted across a gap in reception of more than gap_ms.
+
+    track: One vessel's classified points, see track.load_track
+    first_ts: Points before this timestamp in UTC ms are only used for the duration and distance of the first point
+
+    returns: One row per hour, section and activity with the number of points, duration in seconds, distance in nm,
+             and the sum and maximum of the sog. Points outside the sections or not classified are under ''
+    """
+    ts = track.utc_timestamp_ms
+    dist_nm = point_distances_nm(track.longitude, track.latitude)
+    dist_nm[1:][np.diff(ts) > gap_ms] = 0
+    section = track.section_names()
+    section[track.section < 0] = ''
+    activity = track.activity_names()
+    activity[track.activity < 0] = ''
+    totals = pd.DataFrame({'hour_ms': ts // hour_ms * hour_ms,
+                           'section': section,
+                           'activity': activity,
+                           'points': 1,
+                           'duration_s': point_durations_ms(ts) / 1000,
+                           'distance_nm': dist_nm,
+                           'sog_sum': track.sog.astype(np.float64),
+                           'sog_max': track.sog.astype(np.float64)})
+    if first_ts is not None:
+        totals = totals[ts >= first_ts]
+    return totals.groupby(['hour_ms', 'section', 'activity'], as_index=False).agg(
+        {'points': 'sum', 'duration_s': 'sum', 'distance_nm': 'sum', 'sog_sum': 'sum', 'sog_max': 'max'})
+
+
+def update_rollups(conn: sqlite3.Connection, mmsi: int, start_ts: float | None = None,
+                   end_ts: float | None = None, chunk_ms: int = rollup_chunk_ms) -> int:
+    """Rebuild the stored activity rollups of a vessel for the hours between the start and end timestamps
+
+    The classify functions call this for the range they have just classified, so the rollups follow the stored
+    classification. Whole hours are rebuilt from ais_classified, a chunk_ms at a time.
+
+    conn: Connection to the AIS database
+    mmsi: Vessel MMSI number
+    start_ts: Rebuild from the hour with this timestamp in UTC ms, defaults to the first classified point
+    end_ts: Rebuild to the hour with this timestamp in UTC ms, defaults to the last classified point
+
+    returns: The number of rollup rows written
+    """
+    first_ts, last_ts = conn.execute('SELECT min(utc_timestamp_ms), max(utc_timestamp_ms) FROM ais_classified '
+                                     'WHERE mmsi=?', (mmsi, )).fetchone()
+    if first_ts is None:
+        conn.execute('DELETE FROM activity_rollups WHERE mmsi=?', (mmsi, ))
+        conn.commit()
+        return 0
+    start_hour = int(max(first_ts, -2**62 if start_ts is None else start_ts)) // hour_ms * hour_ms
+    end_hour = int(min(last_ts, 2**62 if end_ts is None else end_ts)) // hour_ms * hour_ms
+    chunk_ms = max(chunk_ms // hour_ms, 1) * hour_ms
+    written = 0
+    with span('rollup', mmsi=mmsi) as s:
+        conn.execute('DELETE FROM activity_rollups WHERE mmsi=? AND hour_ms>=? AND hour_ms<=?',
+                     (mmsi, start_hour, end_hour))
+        for chunk_start in range(start_hour, end_hour + 1, chunk_ms):
+            chunk_end = min(chunk_start + chunk_ms, end_hour + hour_ms) - 1
+            track = load_track(conn, mmsi, chunk_start - gap_ms, chunk_end, only_classified=True)
+            totals = rollup_points(track, chunk_start)
+            columns = ['mmsi'] + list(totals.columns)
+            conn.executemany(f"INSERT INTO activity_rollups ({', '.join(columns)}) "
+                             f"VALUES ({', '.join(['?'] * len(columns))})",
+                             [(mmsi, *row) for row in totals.itertuples(index=False, name=None)])
+            written += totals.shape[0]
+        conn.commit()
+        s.rows = written
+    return written
+
+
+def backfill_rollups(conn: sqlite3.Connection, mmsi: int) -> int:
+    """Build the rollups of a vessel classified before they were stored, see update_rollups
+
+    returns: The number of rollup rows written, 0 if the vessel already has rollups or no classification
+    """
+    if conn.execute('SELECT 1 FROM activity_rollups WHERE mmsi=? LIMIT 1', (mmsi, )).fetchone() is not None or \
+            conn.execute('SELECT 1 FROM ais_classified WHERE mmsi=? LIMIT 1', (mmsi, )).fetchone() is None:
+        return 0
+    print(f'backfill_rollups: building the activity rollups for {mmsi}')
+    return update_rollups(conn, mmsi)
+
+
+def get_rollups(conn: sqlite3.Connection, mmsi: int | list[int] | None, start_ts: float, end_ts: float,
+                bucket: str | None = 'day', by: tuple[str, ...] = ('activity', )) -> pd.DataFrame:
+    """Return the activity totals of vessels from the stored rollups, see update_rollups
+
+    Reads a few rows per vessel and hour, so a season for the whole fleet takes milliseconds, without loading or
+    classifying any points.
+
+    conn: Connection to the AIS database
+    mmsi: Vessel MMSI number, a list of them, or None for every vessel
+    start_ts: start timestamp in UTC ms, the hour it falls in is included
+    end_ts: end timestamp in UTC ms, the hour it falls in is included
+    bucket: Total by 'hour', 'day' or 'week' (starting Monday) in UTC, or None for the whole range
+    by: Also total by 'section', 'activity', both or neither
+
+    returns: One row per vessel, bucket and the columns in by, with the bucket start in UTC ms (bucket_ms), the
+             number of points, duration in seconds, distance in nm, and the mean and maximum sog. Points outside the
+             sections have no section
+    """
+    if bucket is not None and bucket not in rollup_buckets:
+        raise ValueError(f'get_rollups: unknown bucket {bucket}, expected one of {list(rollup_buckets)} or None')
+    unknown = set(by) - {'section', 'activity'}
+    if unknown:
+        raise ValueError(f'get_rollups: can only total by section and activity, not {unknown}')
+    group = ['mmsi'] + list(by)
+    select = ['mmsi']
+    if bucket is not None:
+        length, offset = rollup_buckets[bucket]
+        select.append(f'(hour_ms - {offset}) / {length} * {length} + {offset} AS bucket_ms')
+        group.insert(1, 'bucket_ms')
+    select.extend(by)
+    params = [int(start_ts) // hour_ms * hour_ms, int(end_ts)]
+    where = 'hour_ms>=? AND hour_ms<=?'
+    if mmsi is not None:
+        mmsi_list = [mmsi] if isinstance(mmsi, int) else list(mmsi)
+        where += f" AND mmsi IN ({', '.join(['?'] * len(mmsi_list))})"
+        params.extend(mmsi_list)
+    qry = f"""SELECT {', '.join(select)}, sum(points) AS points, sum(duration_s) AS duration_s,
+                     sum(distance_nm) AS distance_nm, sum(sog_sum) / sum(points) AS mean_sog, max(sog_max) AS max_sog
+              FROM activity_rollups
+              WHERE {where}
+              GROUP BY {', '.join(group)}
+              ORDER BY {', '.join(group)};
+           """
+    with span('query', rollups=bucket):
+        rollups = pd.read_sql(qry, conn, params=params)
+    for column in by:
+        rollups[column] = rollups[column].replace('', None)
+    return rollups
+
+
+def iter_classified_data(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float,
+                         chunk_rows: int = stream_chunk_rows) -> Iterator[pd.DataFrame]:
+    """Read AIS data with its stored classification in time ordered chunks through a cursor
+
+    Only points that have been classified are returned, see classify_incremental. Each chunk is a dataframe as
+    load_ais_data returns, with the easting and northing stored when the points were loaded (see projection), the
+    section, rolling_speed and activity columns, and the duration column. The durations are carried across the
+    chunks, so only one chunk of rows is in memory at a time.
+
+    :param conn: Connection to the DB with AIS data
+    :param mmsi: Vessel MMSI number
+    :param start_ts: start timestamp in UTC ms
+    :param end_ts: end timestamp in UTC ms
+    :param chunk_rows: The number of rows in each chunk
+    """
+    columns = ais_query_columns + ais_db.projected_columns
+    cursor = conn.execute(f"""SELECT {', '.join('a.' + c for c in columns)}, c.section, c.rolling_speed, c.activity
+                              FROM ais_data a JOIN ais_classified c
+                                   ON a.mmsi=c.mmsi AND a.utc_timestamp_ms=c.utc_timestamp_ms
+                              WHERE a.mmsi=? AND a.utc_timestamp_ms>=? AND a.utc_timestamp_ms<=?
+                              ORDER BY a.utc_timestamp_ms;""", (mmsi, start_ts, end_ts))
+    dtypes = {c: t for c, t in ais_query_dtypes.items() if c in columns}
+    prev_ts = None
+    while rows := cursor.fetchmany(chunk_rows):
+        chunk = pd.DataFrame.from_records(rows, columns=columns + ['section', 'rolling_speed', 'activity'])
+        chunk = chunk.astype(dtypes)
+        chunk['date'] = pd.to_datetime(chunk['utc_timestamp_ms'], unit='ms', utc=True)
+        chunk.set_index('date', inplace=True)
+        ts = chunk['utc_timestamp_ms'].to_numpy()
+        chunk['duration'] = pd.to_timedelta(point_durations_ms(ts, prev_ts=prev_ts), unit='ms')
+        prev_ts = ts[-1]
+        yield chunk
+
+
+class LoadSegmenter:
+    """Segment a stream of classified points into loads
+
+    A load starts at the first point of a run of 'dig' points, if the dredge has been in 'disp' since the start of
+    the previous dig run, and ends at the start of the next load. Each point's duration (see point_durations_ms) and
+    distance from the previous point count towards the point's activity. The load in progress and the last point are
+    carried between chunks, so the memory used does not depend on the length of a load.
+
+    first_ts: Points before this timestamp in UTC ms are only used for the duration and distance of the next point
+    """
+    def __init__(self, first_ts: float | None = None):
+        self.first_ts = first_ts
+        self.prev = None  # (ts, lon, lat) of the last point seen
+        self.prev_dig = False
+        self.disp_since_run = False  # Disposal since the start of the last dig run
+        self.open = None  # The load in progress, start_ms, end_ms, points, durations and distances by activity
+
+    def add(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Add a chunk of classified points, in time order and after the points already added
+
+        returns: The loads completed by the chunk, see frame
+        """
+        ts = df['utc_timestamp_ms'].to_numpy(dtype=np.int64)
+        lon = df['longitude'].to_numpy(dtype=np.float64)
+        lat = df['latitude'].to_numpy(dtype=np.float64)
+        act = df['activity'].to_numpy(dtype=object)
+        if ts.shape[0] == 0:
+            return self.empty()
+        if self.prev is None:
+            duration_s = point_durations_ms(ts) / 1000
+            dist_nm = point_distances_nm(lon, lat)
+        else:
+            duration_s = point_durations_ms(ts, prev_ts=self.prev[0]) / 1000
+            dist_nm = point_distances_nm(np.append(self.prev[1], lon), np.append(self.prev[2], lat))[1:]
+        self.prev = (ts[-1], lon[-1], lat[-1])
+        if self.first_ts is not None:
+            keep = ts >= self.first_ts
+            ts, duration_s, dist_nm, act = ts[keep], duration_s[keep], dist_nm[keep], act[keep]
+            if ts.shape[0] == 0:
+                return self.empty()
+
+        is_dig = act == 'dig'
+        run_starts = np.flatnonzero(is_dig & ~np.concatenate([[self.prev_dig], is_dig[:-1]]))
+        disp_count = np.cumsum(act == 'disp')
+        if run_starts.size:
+            first_starts = self.open is None or self.disp_since_run or disp_count[run_starts[0]] > 0
+            load_starts = run_starts[np.concatenate([[first_starts],
+                                                     disp_count[run_starts[1:]] > disp_count[run_starts[:-1]]])]
+            self.disp_since_run = bool(disp_count[-1] > disp_count[run_starts[-1]])
+        else:
+            load_starts = run_starts
+            self.disp_since_run = self.disp_since_run or bool(disp_count[-1] > 0)
+        self.prev_dig = bool(is_dig[-1])
+
+        # Points before the first new load belong to the load in progress, id -1
+        starts = np.zeros(ts.shape[0], dtype=np.int64)
+        starts[load_starts] = 1
+        load_id = np.cumsum(starts) - 1
+        act_code = np.full(ts.shape[0], len(activities), dtype=np.int64)
+        for code, a in enumerate(activities):
+            act_code[act == a] = code
+        num_loads = load_starts.size + 1  # The load in progress, then the new loads
+        cell = (load_id + 1) * (len(activities) + 1) + act_code
+        size = num_loads * (len(activities) + 1)
+        durations = np.bincount(cell, weights=duration_s, minlength=size).reshape(num_loads, -1)[:, :len(activities)]
+        distances = np.bincount(cell, weights=dist_nm, minlength=size).reshape(num_loads, -1)[:, :len(activities)]
+        points = np.bincount(load_id + 1, minlength=num_loads)
+
+        loads = [self.open]
+        if self.open is not None:
+            self.open['points'] += points[0]
+            self.open['durations'] += durations[0]
+            self.open['distances'] += distances[0]
+            self.open['end_ms'] = ts[-1]
+        for i, start in enumerate(load_starts):
+            loads.append({'start_ms': ts[start], 'end_ms': ts[-1], 'points': points[i + 1],
+                          'durations': durations[i + 1], 'distances': distances[i + 1]})
+        if len(loads) > 1:
+            for prev_load, next_load in zip(loads[:-1], loads[1:]):
+                if prev_load is not None:
+                    prev_load['end_ms'] = next_load['start_ms']
+        completed = [load for load in loads[:-1] if load is not None]
+        self.open = loads[-1]
+        return self.frame(completed, complete=True)
+
+    def finish(self) -> pd.DataFrame:
+        """Return the load in progress, as an incomplete load, or no rows if no load has started"""
+        return self.frame([] if self.open is None else [self.open], complete=False)
+
+    def empty(self) -> pd.DataFrame:
+        """Return a frame of loads with no rows"""
+        return self.frame([], complete=True)
+
+    def frame(self, loads: list[dict], complete: bool) -> pd.DataFrame:
+        """Return the loads as rows with the start and end timestamps, the number of points, whether the load is
+        complete (the next load has started), and the duration in seconds and distance in nm for each activity"""
+        columns = ['start_ms', 'end_ms', 'complete', 'points'] + [f'{a}_s' for a in activities] + \
+                  [f'{a}_dist_nm' for a in activities]
+        if not loads:
+            return pd.DataFrame(columns=columns)
+        frame = pd.DataFrame({'start_ms': np.array([load['start_ms'] for load in loads], dtype=np.int64),
+                              'end_ms': np.array([load['end_ms'] for load in loads], dtype=np.int64),
+                              'complete': np.full(len(loads), complete),
+                              'points': np.array([load['points'] for load in loads], dtype=np.int64)})
+        for code, a in enumerate(activities):
+            frame[f'{a}_s'] = [load['durations'][code] for load in loads]
+        for code, a in enumerate(activities):
+            frame[f'{a}_dist_nm'] = [load['distances'][code] for load in loads]
+        return frame
+
+
+def iter_loads(classified: Iterable[pd.DataFrame], first_ts: float | None = None) -> Iterator[pd.DataFrame]:
+    """Segment a stream of classified chunks into loads, see LoadSegmenter
+
+    Yields the loads completed by each chunk, and finally the load in progress
+    """
+    segmenter = LoadSegmenter(first_ts)
+    for chunk in classified:
+        if (loads := segmenter.add(chunk)).shape[0]:
+            yield loads
+    if (loads := segmenter.finish()).shape[0]:
+        yield loads
+
+
+def stream_to_csv(chunks: Iterable[pd.DataFrame], fname: str) -> int:
+    """Write a stream of dataframes to one csv file, appending each chunk as it arrives
+
+    returns: The number of rows written
+    """
+    rows = 0
+    with open(fname, 'w', newline='') as f:
+        for chunk in chunks:
+            chunk.to_csv(f, header=rows == 0)
+            rows += chunk.shape[0]
+    return rows
+
+
 if __name__ == "__main__":
-    connection = sqlite3.connect(ais_database)
+    connection = ais_db.connect(ais_database)
     cursor = connection.cursor()
 
     vessel_mmsi = 368349000
@@ -106,30 +833,30 @@ if __name__ == "__main__":
     end_date = datetime(2025, 10, 22, 23, 59, 59)
     end_timestamp = end_date.timestamp() * 1000
 
-    df = load_ais_data(connection, vessel_mmsi, start_timestamp, end_timestamp)
-    df['activity'] = None
-    df['duration'] = df.index.diff()
-
-    gdf_latlon = gpd.GeoDataFrame(df,
-                                  geometry=gpd.points_from_xy(df.longitude, df.latitude), crs="EPSG:4326")
-    gdf_latlon = classify_delays(gdf_latlon)
-    gdf_latlon = set_location(gdf_latlon,
-                              dict([(k, v) for k, v in project_sections.items() if k in loc_types]))
-    gdf_latlon = classify_cycle(gdf_latlon)
-    gdf_NE = gdf_latlon.to_crs(epsg=2278)
-    xy = gdf_NE.get_coordinates()
-    gdf_latlon['E'] = xy.x
-    gdf_latlon['N'] = xy.y
-
-    print(f'Data between {start_timestamp} and {end_timestamp} is {gdf_latlon.shape[0]} rows')
-    print(f'There are {gdf_latlon[gdf_latlon["activity"] == "delay"]["duration"].sum()} delays')
+    num_classified = classify_fleet(connection, list(mmsi_from_name.values()), end_ts=end_timestamp)
+    for m, n in num_classified.items():
+        print(f'Classified {n} new points for {m}')
+    # Write the stored classification a chunk at a time, so the range does not have to fit in memory
+    classified_chunks = iter_classified_data(connection, vessel_mmsi, start_timestamp, end_timestamp)
+    num_rows = stream_to_csv((c.rename(columns={'easting': 'E', 'northing': 'N'}) for c in classified_chunks),
+                             'ais_data.csv')
+
+    print(f'Data between {start_timestamp} and {end_timestamp} is {num_rows} rows')
+    activity_totals = get_rollups(connection, vessel_mmsi, start_timestamp, end_timestamp, bucket=None)
+    activity_time = pd.to_timedelta(activity_totals.set_index('activity')['duration_s'], unit='s')
+    section_totals = get_rollups(connection, vessel_mmsi, start_timestamp, end_timestamp, bucket=None,
+                                 by=('section', ))
+    section_time = pd.to_timedelta(section_totals.dropna(subset=['section']).set_index('section')['duration_s'],
+                                   unit='s')
+    print(f'There are {activity_time.get("delay", pd.Timedelta(0))} delays')
     for sec_type in ['dig', 'disp', 'sail']:
         action = {"dig": "digging",
                   "disp": "dumping",
                   "sail": "sailing"}[sec_type]
-        print(f'The dredge spent {gdf_latlon[gdf_latlon["section"] == sec_type]["duration"].sum()} in the {sec_type} area')
-        print(f'The dredge spent {gdf_latlon[gdf_latlon["activity"] == sec_type]["duration"].sum()} '
+        print(f'The dredge spent {section_time.get(sec_type, pd.Timedelta(0))} in the {sec_type} area')
+        print(f'The dredge spent {activity_time.get(sec_type, pd.Timedelta(0))} '
               f'{action}')
-    print(gdf_latlon.head())
-
-    gdf_latlon.to_csv('ais_data.csv')
+    update_loads(connection, vessel_mmsi)
+    loads_df = get_loads(connection, vessel_mmsi, start_timestamp, end_timestamp)
+    print(f'There are {loads_df.shape[0]} loads, averaging '
+          f'{loads_df[[f"{a}_s" for a in activities]].mean().div(60).round(1).to_dict()} minutes')
@@ -1,7 +1,17 @@
-"""Get AIS data from the NOAA website"""
+"""Get AIS data from the NOAA website
+
+Downloads go to a '.part' file next to the final file and are renamed into place only after the length and the zstd
+frames have been checked, so an interrupted transfer never looks like a complete file. An interrupted download is
+resumed with an HTTP Range request on the next attempt. Set base_url to point the downloader at a local server for
+testing."""
+from concurrent.futures import ThreadPoolExecutor
 import os
+import shutil
 
 import urllib3
+import zstandard
+
+from instrumentation import span
 
 
 base_url = 'https://coast.noaa.gov/htdata/CMSP/AISDataHandler'
@@ -10,6 +20,21 @@ if not os.path.exists(ais_storage_loc):
     print(f'{ais_storage_loc} not found, creating directory')
     os.makedirs(ais_storage_loc)
 
+chunk_size = 65536
+max_attempts = 5  # Attempts at a download before giving up, each attempt resumes where the last one stopped
+
+# Shared connection pool, sized for the concurrent downloads in get_vessel_ais_from_noaa.read_days_pipelined
+# Connection errors and server errors are retried with exponential backoff
+http = urllib3.PoolManager(maxsize=8, block=True,
+                           retries=urllib3.Retry(total=5, backoff_factor=1.0,
+                                                 status_forcelist=[429, 500, 502, 503, 504]),
+                           timeout=urllib3.Timeout(connect=10.0, read=60.0),
+                           headers={'User-Agent': 'Customer User Agent If Needed'})
+
+
+class DownloadError(IOError):
+    """A download that could not be completed or did not pass verification"""
+
 
 def get_ais_url(date: str) -> str:
     """Generate the AIS data url for the given date
@@ -29,34 +54,168 @@ def get_storage_fname(date: str) -> str:
     return os.path.join(ais_storage_loc, f'ais-{date}.csv.zst')
 
 
-def download_ais_data(date: str) -> None:
-    """Download the AIS data file for the given date
+def verify_zstd(fname: str) -> bool:
+    """Check that a file is made of complete, valid zstd frames
 
-    from: https://stackoverflow.com/a/77577568/1072246"""
-    ais_url = get_ais_url(date)
-    resp = urllib3.request('GET', ais_url, preload_content=False,
-                           headers={'User-Agent': 'Customer User Agent If Needed'})
-    chunk_size = 65536
+    The file is decompressed in chunks and the output discarded. A truncated file ends partway through a frame, a
+    corrupted one fails to decompress.
+
+    fname: The file to check
+
+    returns: True if the file is valid
+    """
+    with span('verify_zstd', file=os.path.basename(fname)) as s:
+        s.bytes = os.path.getsize(fname)
+        dctx = zstandard.ZstdDecompressor()
+        dobj = dctx.decompressobj()
+        in_frame = False
+        num_frames = 0
+        try:
+            with open(fname, 'rb') as f:
+                while chunk := f.read(chunk_size * 16):
+                    while chunk:
+                        in_frame = True
+                        dobj.decompress(chunk)
+                        if dobj.eof:
+                            num_frames += 1
+                            in_frame = False
+                            chunk = dobj.unused_data
+                            dobj = dctx.decompressobj()
+                        else:
+                            chunk = b''
+        except zstandard.ZstdError:
+            return False
+        return num_frames > 0 and not in_frame
+
+
+def get_remote_size(url: str) -> tuple[int, bool]:
+    """Return the size of the remote file and whether the server accepts range requests"""
+    resp = http.request('HEAD', url)
+    if resp.status != 200:
+        raise DownloadError(f'HEAD {url} returned status {resp.status}')
     size = int(resp.headers['Content-Length'])
-    total_chunks = int(size / chunk_size)
-    fname = get_storage_fname(date)
-    if os.path.isfile(fname):
-        print(f'--- AIS data already downloaded from {ais_url}')
-    else:
-        print(f'>>> Downloading {size} of AIS data from {ais_url} to {fname}')
-        with open(fname, 'wb') as f:
+    accepts_ranges = resp.headers.get('Accept-Ranges', '') == 'bytes'
+    return size, accepts_ranges
+
+
+def download_range(url: str, part_fname: str, start: int, end: int, progress: bool = False) -> None:
+    """Download bytes start to end-1 of url into part_fname, resuming from whatever is already in part_fname
+
+    Stops with an exception when the connection fails, the bytes already written are kept for the next attempt.
+
+    url: The file to download
+    part_fname: The partial file to append to
+    start: The first byte of the range
+    end: One past the last byte of the range
+    progress: Print a countdown as the download proceeds
+    """
+    have = os.path.getsize(part_fname) if os.path.isfile(part_fname) else 0
+    if have > end - start:  # Left over from a different range or file, start over
+        os.remove(part_fname)
+        have = 0
+    if have == end - start:
+        return
+    resp = http.request('GET', url, preload_content=False,
+                        headers={'Range': f'bytes={start + have}-{end - 1}'})
+    try:
+        if resp.status == 200 and start == 0:  # Whole file, the server ignored or did not need the range
+            mode = 'wb'
+        elif resp.status == 206:
+            mode = 'ab'
+        else:
+            raise DownloadError(f'GET {url} bytes {start + have}-{end - 1} returned status {resp.status}')
+        total_chunks = max(int((end - start - have) / chunk_size), 1)
+        with open(part_fname, mode) as f:
             numchunks = 0
             i = 9
             for chunk in resp.stream(chunk_size):
                 f.write(chunk)
                 numchunks += 1
-                if numchunks >= total_chunks/10:
+                if progress and numchunks >= total_chunks/10:
                     print(i, end='', flush=True)
                     numchunks = 0
                     i -= 1
-
+    finally:
         resp.release_conn()
-        print(f'\n||| Downloaded AIS data from {ais_url} to {fname}')
+
+
+def download_file(url: str, fname: str, parallel_ranges: int = 1, min_range_size: int = 32 * 1024 * 1024) -> None:
+    """Download url to fname, resuming and verifying the transfer
+
+    The data is written to fname + '.part' and renamed to fname only once the length matches Content-Length and the
+    zstd frames are complete. Failed attempts are resumed with range requests, up to max_attempts. Large files can be
+    split into parallel_ranges byte ranges downloaded at the same time.
+
+    url: The file to download
+    fname: The final filename including path
+    parallel_ranges: The number of byte ranges to download at the same time
+    min_range_size: Files are not split into ranges smaller than this
+    """
+    size, accepts_ranges = get_remote_size(url)
+    part_fname = fname + '.part'
+    num_ranges = min(parallel_ranges, max(size // min_range_size, 1)) if accepts_ranges else 1
+    if os.path.isfile(part_fname):  # Resume an earlier single range download as it was started
+        num_ranges = 1
+    bounds = [size * k // num_ranges for k in range(num_ranges + 1)]
+    range_fnames = [part_fname] if num_ranges == 1 else [f'{part_fname}{k}' for k in range(num_ranges)]
+    if not accepts_ranges and os.path.isfile(part_fname):
+        os.remove(part_fname)
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            if num_ranges == 1:
+                download_range(url, part_fname, 0, size, progress=True)
+            else:
+                with ThreadPoolExecutor(max_workers=num_ranges) as pool:
+                    futures = [pool.submit(download_range, url, range_fname, start, end)
+                               for range_fname, start, end in zip(range_fnames, bounds[:-1], bounds[1:])]
+                    for fut in futures:
+                        fut.result()
+            break
+        except DownloadError:
+            raise  # A status the server will give again, such as 404, is not worth retrying
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            if attempt == max_attempts:
+                raise DownloadError(f'Download of {url} failed after {attempt} attempts: {e}') from e
+            print(f'\n!!! Download of {url} interrupted ({e}), resuming (attempt {attempt + 1} of {max_attempts})')
+
+    if num_ranges > 1:
+        with open(part_fname, 'wb') as f:
+            for range_fname in range_fnames:
+                with open(range_fname, 'rb') as r:
+                    shutil.copyfileobj(r, f, chunk_size * 16)
+        for range_fname in range_fnames:
+            os.remove(range_fname)
+
+    if (have := os.path.getsize(part_fname)) != size:
+        raise DownloadError(f'Downloaded {have} bytes from {url}, expected Content-Length {size}')
+    if not verify_zstd(part_fname):
+        os.remove(part_fname)
+        raise DownloadError(f'Downloaded file from {url} is not valid zstd data, removed it')
+    os.replace(part_fname, fname)
+
+
+def download_ais_data(date: str, parallel_ranges: int = 1, verify_existing: bool = False) -> None:
+    """Download the AIS data file for the given date
+
+    date: A date in ISO format ('2025-06-26')
+    parallel_ranges: The number of byte ranges to download at the same time
+    verify_existing: Check the zstd frames of an already downloaded file, and download it again if they are bad
+
+    from: https://stackoverflow.com/a/77577568/1072246"""
+    ais_url = get_ais_url(date)
+    fname = get_storage_fname(date)
+    if os.path.isfile(fname):
+        if not verify_existing or verify_zstd(fname):
+            print(f'--- AIS data already downloaded from {ais_url}')
+            return
+        print(f'!!! {fname} is not valid zstd data, downloading it again')
+        os.remove(fname)
+    print(f'>>> Downloading AIS data from {ais_url} to {fname}')
+    with span('download', url=ais_url) as s:
+        download_file(ais_url, fname, parallel_ranges=parallel_ranges)
+        s.bytes = os.path.getsize(fname)
+    print(f'\n||| Downloaded AIS data from {ais_url} to {fname}')
 
 
 if __name__ == '__main__':
@@ -1,10 +1,31 @@
-"""Extract the AIS data for a given vessel"""
+"""Extract the AIS data for a given vessel
+
+Each daily NOAA file can be converted once into a typed Parquet file under ais_parquet/date=YYYY-MM-DD/, sorted by
+mmsi and time. Later extractions read those instead of the zstd CSV, and only touch the row groups and columns of the
+vessels asked for.
+
+The first time a day is read a manifest is written under ais_manifest/date=YYYY-MM-DD/: one row per vessel in the file
+with its row count, first and last times, bounding box, and where its rows start in the Parquet file. Days without
+any of the vessels asked for are then skipped without opening the data, the vessels' rows are read straight from
+their offsets, and vessel_days answers which days vessels were seen from the manifests alone.
+
+Instead of, or as well as, a list of vessels, the rows can be limited to a region, such as the area around the project
+(see channel_def.ProjectGeometry.geofence). The region is checked as the file is read, see region_filter, so all the
+traffic near the project can be pulled from the national daily files without holding them in memory."""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from glob import glob
+import multiprocessing
 import os
 
-import pandas as pd
+import numpy as np
+import polars as pl
+from polars_streaming_csv_decompression import streaming_csv
+import shapely
 
+from channel_def import get_project
 from get_data_from_noaa import get_storage_fname, download_ais_data
+from instrumentation import span
 from vessel_mmsi import name_from_mmsi, mmsi_from_name
 
 vessel_ais_storage_loc = os.path.join(os.getcwd(), 'vessel_ais_data')
@@ -12,14 +33,405 @@ if not os.path.exists(vessel_ais_storage_loc):
     print(f'{vessel_ais_storage_loc} not found. Creating it.')
     os.makedirs(vessel_ais_storage_loc)
 
+parquet_storage_loc = os.path.join(os.getcwd(), 'ais_parquet')
+parquet_row_group_size = 65536  # Rows per row group, smaller groups let vessel queries skip more of each file
+manifest_storage_loc = os.path.join(os.getcwd(), 'ais_manifest')
+geofence_buffer_ft = 2 * 5280  # How far around the project sections extract_vessel_ais(near_project=True) reaches
+
+# The columns kept from the NOAA daily files, everything else is dropped while the file is read
+ais_columns = ['mmsi', 'base_date_time', 'longitude', 'latitude', 'sog', 'cog', 'heading',
+               'vessel_name', 'status', 'draft', 'cargo']
+# The types the columns are stored as in the Parquet cache. sog stays float64 so the classifier's rolling means compare
+# with the speed thresholds exactly, see classify_loads.ais_query_dtypes
+ais_dtypes = {'mmsi': pl.Int32,
+              'base_date_time': pl.Datetime('ms'),
+              'longitude': pl.Float64,
+              'latitude': pl.Float64,
+              'sog': pl.Float64,
+              'cog': pl.Float32,
+              'heading': pl.Float32,
+              'vessel_name': pl.String,
+              'status': pl.Int16,
+              'draft': pl.Float32,
+              'cargo': pl.Int16}
+
+
+def scan_daily_ais(all_ais_fname: str) -> pl.LazyFrame:
+    """Lazily scan a daily NOAA AIS file, decompressing the zstd stream in chunks
+
+    Column names are lower-cased, older NOAA files use upper case names
+
+    all_ais_fname: The daily file with all vessel AIS data
+
+    returns: A polars LazyFrame over the file
+    """
+    lf = streaming_csv(all_ais_fname)
+    return lf.rename({c: c.lower() for c in lf.collect_schema().names()})
+
+
+def region_filter(region: shapely.Geometry) -> pl.Expr:
+    """Return a filter for the rows with positions in a region, in lat/lon
+
+    The box around the region is a plain comparison that polars pushes down into the scan, and only the rows inside
+    the box are tested against the region itself, a batch of rows at a time.
+    """
+    xmin, ymin, xmax, ymax = region.bounds
+    shapely.prepare(region)
+    lon = pl.col('longitude').cast(pl.Float64, strict=False)
+    lat = pl.col('latitude').cast(pl.Float64, strict=False)
+
+    def in_region(positions: pl.Series) -> pl.Series:
+        x = positions.struct.field('longitude').to_numpy()  # Nulls become NaN, which fail the box check
+        y = positions.struct.field('latitude').to_numpy()
+        inside = np.zeros(x.shape[0], dtype=bool)
+        in_box = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        inside[in_box] = shapely.intersects_xy(region, x[in_box], y[in_box])
+        return pl.Series(inside)
+
+    return (lon.is_between(xmin, xmax) & lat.is_between(ymin, ymax) &
+            pl.struct(lon.alias('longitude'), lat.alias('latitude')).map_batches(
+                in_region, return_dtype=pl.Boolean, is_elementwise=True))
+
+
+def read_daily_ais(all_ais_fname: str, mmsi_list: list[int] | None,
+                   columns: list[str] | None = None, manifest_date: str | None = None,
+                   region: shapely.Geometry | None = None) -> pl.DataFrame:
+    """Read the AIS data for the given vessels from a daily NOAA file
+
+    The mmsi and region filters and the column selection are pushed down into the scan, so rows for other vessels
+    are dropped chunk by chunk as the file is decompressed, and never built into a full frame.
+
+    all_ais_fname: The daily file with all vessel AIS data
+    mmsi_list: The vessels to keep, None to keep all vessels
+    columns: The columns to keep, defaults to ais_columns
+    manifest_date: Also write the manifest for this date from the same scan, see write_manifest
+    region: Only keep the positions in this region, in lat/lon, see region_filter
+
+    returns: A polars DataFrame with the filtered AIS data
+    """
+    if columns is None:
+        columns = ais_columns
+    with span('parse_filter', file=os.path.basename(all_ais_fname), source='zstd') as s:
+        lf = scan_daily_ais(all_ais_fname)
+        available = lf.collect_schema().names()
+        filtered = lf
+        if mmsi_list is not None:
+            filtered = filtered.filter(pl.col('mmsi').is_in(mmsi_list))
+        if region is not None:
+            filtered = filtered.filter(region_filter(region))
+        filtered = filtered.select([c for c in columns if c in available])
+        if manifest_date is None:
+            df = filtered.collect(engine='streaming')
+        else:
+            # Collected together, so polars can share one pass over the file between the two
+            df, manifest = pl.collect_all([filtered, manifest_query(lf)], engine='streaming')
+            write_manifest(manifest_date, manifest, parquet_offsets=False)
+        s.rows = df.shape[0]
+        s.bytes = os.path.getsize(all_ais_fname)
+    return df
+
+
+def get_manifest_fname(date: str) -> str:
+    """Return the manifest filename including path for the given date"""
+    return os.path.join(manifest_storage_loc, f'date={date}', 'manifest.parquet')
+
+
+def manifest_query(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Return a query for the manifest of a day of AIS data, one row per vessel in mmsi order
+
+    Each row has the mmsi, the number of rows, the first and last times, and the bounding box of the positions
+    """
+    schema = lf.collect_schema()
+    if schema['base_date_time'] == pl.String:
+        time_col = pl.col('base_date_time').str.to_datetime(time_unit='ms', strict=False)
+    else:
+        time_col = pl.col('base_date_time').cast(pl.Datetime('ms'))
+    return (lf.select(pl.col('mmsi').cast(pl.Int32, strict=False), time_col,
+                      pl.col('longitude').cast(pl.Float64, strict=False),
+                      pl.col('latitude').cast(pl.Float64, strict=False))
+            .group_by('mmsi')
+            .agg(pl.len().cast(pl.Int64).alias('rows'),
+                 pl.col('base_date_time').min().alias('first_time'),
+                 pl.col('base_date_time').max().alias('last_time'),
+                 pl.col('longitude').min().alias('min_longitude'),
+                 pl.col('longitude').max().alias('max_longitude'),
+                 pl.col('latitude').min().alias('min_latitude'),
+                 pl.col('latitude').max().alias('max_latitude'))
+            .sort('mmsi'))
+
+
+def write_manifest(date: str, manifest: pl.DataFrame, parquet_offsets: bool) -> pl.DataFrame:
+    """Write the manifest of a day, see manifest_query
+
+    parquet_offsets: The manifest was made from the Parquet cache, which is in the same mmsi order, so the offset
+                     of each vessel's first row in the file is stored in parquet_offset. Otherwise it is left null
+
+    returns: The manifest as written
+    """
+    if parquet_offsets:
+        offset = (pl.col('rows').cum_sum() - pl.col('rows')).cast(pl.Int64)
+    else:
+        offset = pl.lit(None, dtype=pl.Int64)
+    manifest = manifest.with_columns(offset.alias('parquet_offset'))
+    manifest_fname = get_manifest_fname(date)
+    os.makedirs(os.path.dirname(manifest_fname), exist_ok=True)
+    manifest.write_parquet(manifest_fname + '.tmp')
+    os.replace(manifest_fname + '.tmp', manifest_fname)
+    return manifest
+
+
+def build_manifest(date: str) -> pl.DataFrame:
+    """Write the manifest of a day from the Parquet cache if the day is cached, otherwise from the daily NOAA file
+
+    returns: The manifest
+    """
+    with span('index', date=date) as s:
+        if os.path.isfile(get_parquet_fname(date)):
+            manifest = write_manifest(date, manifest_query(pl.scan_parquet(get_parquet_fname(date),
+                                                                           hive_partitioning=False)).collect(),
+                                      parquet_offsets=True)
+        else:
+            manifest = write_manifest(date, manifest_query(scan_daily_ais(get_storage_fname(date))).collect(
+                engine='streaming'), parquet_offsets=False)
+        s.rows = manifest['rows'].sum()
+    return manifest
+
+
+def read_manifest(date: str) -> pl.DataFrame | None:
+    """Return the manifest of a day, None if it has not been built"""
+    if not os.path.isfile(get_manifest_fname(date)):
+        return None
+    return pl.read_parquet(get_manifest_fname(date), hive_partitioning=False)
+
+
+def manifest_vessels(manifest: pl.DataFrame, mmsi_list: list[int] | None,
+                     region: shapely.Geometry | None = None) -> pl.DataFrame:
+    """Return the manifest rows of the vessels asked for, with a region only those whose bounding box meets it"""
+    if mmsi_list is not None:
+        manifest = manifest.filter(pl.col('mmsi').is_in(mmsi_list))
+    if region is not None:
+        xmin, ymin, xmax, ymax = region.bounds
+        manifest = manifest.filter((pl.col('max_longitude') >= xmin) & (pl.col('min_longitude') <= xmax) &
+                                   (pl.col('max_latitude') >= ymin) & (pl.col('min_latitude') <= ymax))
+    return manifest
+
+
+def day_has_vessels(date: str, mmsi_list: list[int] | None, region: shapely.Geometry | None = None) -> bool | None:
+    """Return whether any of the vessels (in the region) are in a day's data, None if the day has no manifest yet"""
+    if mmsi_list is None and region is None:
+        return True
+    manifest = read_manifest(date)
+    if manifest is None:
+        return None
+    return manifest_vessels(manifest, mmsi_list, region).height > 0
+
+
+def vessel_days(mmsi_list: list[int] | None = None, start_date: str | None = None,
+                end_date: str | None = None) -> pl.DataFrame:
+    """Return the days each vessel was seen, from the manifests of the days read so far
+
+    mmsi_list: The vessels, None for all vessels
+    start_date: The first date, in ISO format ('2025-06-26'), None for the earliest manifest
+    end_date: The last date, None for the latest manifest
+
+    returns: One row per vessel and day with the date and the manifest columns, sorted by mmsi and date
+    """
+    manifest_fnames = sorted(glob(os.path.join(manifest_storage_loc, 'date=*', 'manifest.parquet')))
+    if not manifest_fnames:
+        return pl.DataFrame(schema={'mmsi': pl.Int32, 'date': pl.String})
+    lf = pl.scan_parquet(manifest_fnames, hive_partitioning=True,
+                         hive_schema={'date': pl.String})
+    if mmsi_list is not None:
+        lf = lf.filter(pl.col('mmsi').is_in(mmsi_list))
+    if start_date is not None:
+        lf = lf.filter(pl.col('date') >= start_date)
+    if end_date is not None:
+        lf = lf.filter(pl.col('date') <= end_date)
+    return lf.sort(['mmsi', 'date']).collect()
+
+
+def empty_day(columns: list[str] | None = None) -> pl.DataFrame:
+    """Return an empty frame with the columns of a day read, for days without the vessels"""
+    if columns is None:
+        columns = ais_columns
+    return pl.DataFrame(schema={c: ais_dtypes[c] for c in columns})
+
+
+def get_parquet_fname(date: str) -> str:
+    """Return the Parquet cache filename including path for the given date"""
+    return os.path.join(parquet_storage_loc, f'date={date}', 'ais.parquet')
+
+
+def convert_day_to_parquet(date: str) -> str:
+    """Convert a downloaded daily NOAA file into the typed Parquet cache
+
+    The rows are sorted by mmsi and time so each vessel sits in a few row groups, and the row group statistics let
+    later scans skip the rest. The sort holds the whole national day in memory, so the cache is opt-in, see read_day.
+    The file is written under a temporary name and renamed, so an interrupted conversion is redone on the next run.
+    The manifest of the day is built from the new file, see build_manifest.
+
+    date: A date in ISO format ('2025-06-26'), the daily file must already be downloaded
+
+    returns: The Parquet filename
+    """
+    parquet_fname = get_parquet_fname(date)
+    os.makedirs(os.path.dirname(parquet_fname), exist_ok=True)
+    lf = scan_daily_ais(get_storage_fname(date))
+    schema = lf.collect_schema()
+    casts = []
+    for c in ais_columns:
+        if c not in schema:
+            continue
+        if c == 'base_date_time' and schema[c] == pl.String:
+            casts.append(pl.col(c).str.to_datetime(time_unit='ms', strict=False))
+        else:
+            casts.append(pl.col(c).cast(ais_dtypes[c], strict=False))
+    lf = lf.select(casts).sort(['mmsi', 'base_date_time'])
+    with span('convert_parquet', date=date) as s:
+        s.bytes = os.path.getsize(get_storage_fname(date))
+        lf.sink_parquet(parquet_fname + '.tmp', compression='zstd', statistics=True,
+                        row_group_size=parquet_row_group_size)
+        os.replace(parquet_fname + '.tmp', parquet_fname)
+    build_manifest(date)
+    return parquet_fname
+
+
+def scan_parquet_days(dates: list[str], mmsi_list: list[int] | None,
+                      columns: list[str] | None = None, region: shapely.Geometry | None = None) -> pl.LazyFrame:
+    """Lazily scan the Parquet cache for the given days and vessels
+
+    Only the files for the requested dates are opened, and the mmsi filter is checked against the row group
+    statistics so row groups for other vessels are never read. Days not yet in the cache are left out, at least one
+    of the days must be cached.
+
+    dates: The dates to read, in ISO format ('2025-06-26')
+    mmsi_list: The vessels to keep, None to keep all vessels
+    columns: The columns to keep, defaults to ais_columns
+    region: Only keep the positions in this region, in lat/lon, see region_filter
+
+    returns: A polars LazyFrame with a date column from the partition name added
+    """
+    if columns is None:
+        columns = ais_columns
+    parquet_fnames = [get_parquet_fname(d) for d in dates if os.path.isfile(get_parquet_fname(d))]
+    lf = pl.scan_parquet(parquet_fnames, hive_partitioning=True)
+    available = lf.collect_schema().names()
+    if mmsi_list is not None:
+        lf = lf.filter(pl.col('mmsi').is_in(mmsi_list))
+    if region is not None:
+        lf = lf.filter(region_filter(region))
+    return lf.select([c for c in columns if c in available] + ['date'])
+
+
+def read_day(date: str, mmsi_list: list[int] | None, use_cache: bool = False,
+             region: shapely.Geometry | None = None) -> pl.DataFrame:
+    """Read the AIS data for the given vessels on one day
+
+    With use_cache the day is converted to the Parquet cache the first time, and read from the cache after that.
+    Otherwise the daily NOAA file is streamed directly, in bounded memory. Once the day has a manifest, a day without
+    any of the vessels is not read at all, and the vessels' rows are read from their offsets in the Parquet file.
+    With a region, only the vessels whose bounding box for the day meets it are read.
+
+    date: A date in ISO format ('2025-06-26'), the daily file must already be downloaded if it is not in the cache
+    mmsi_list: The vessels to keep, None to keep all vessels
+    use_cache: Read through the Parquet cache, the first read of each day sorts it in memory, see
+               convert_day_to_parquet
+    region: Only keep the positions in this region, in lat/lon, see region_filter
+
+    returns: A polars DataFrame with the filtered AIS data
+    """
+    manifest = read_manifest(date)
+    if manifest is not None and (mmsi_list is not None or region is not None):
+        manifest = manifest_vessels(manifest, mmsi_list, region)
+        if manifest.height == 0:
+            return empty_day()
+    if not use_cache:
+        return read_daily_ais(get_storage_fname(date), mmsi_list,
+                              manifest_date=date if manifest is None else None, region=region)
+    if not os.path.isfile(get_parquet_fname(date)):
+        convert_day_to_parquet(date)
+        return read_day(date, mmsi_list, use_cache, region)
+    if manifest is None or manifest['parquet_offset'].is_null().any():
+        build_manifest(date)  # Cached before manifests were kept, or indexed from the daily file
+        return read_day(date, mmsi_list, use_cache, region)
+    with span('parse_filter', date=date, source='parquet') as s:
+        if mmsi_list is None and region is None:
+            df = scan_parquet_days([date], mmsi_list).drop('date').collect()
+        else:
+            lf = pl.scan_parquet(get_parquet_fname(date), hive_partitioning=False)
+            lf = lf.select([c for c in ais_columns if c in lf.collect_schema().names()])
+            lf = pl.concat([lf.slice(offset, rows) for offset, rows in
+                            manifest.select(['parquet_offset', 'rows']).iter_rows()])
+            if region is not None:
+                lf = lf.filter(region_filter(region))
+            df = lf.collect()
+        s.rows = df.shape[0]
+    return df
+
+
+def read_days_pipelined(dates: list[str], mmsi_list: list[int] | None,
+                        download_workers: int = 4, parse_workers: int = 4,
+                        use_cache: bool = False, region: shapely.Geometry | None = None) -> list[pl.DataFrame]:
+    """Download and filter several days of AIS data at the same time
+
+    Missing days are downloaded by a bounded pool of threads sharing the get_data_from_noaa connection pool. As each
+    download finishes its file is handed to a process pool for decompression and filtering, so parsing overlaps the
+    remaining downloads. Days whose manifest shows none of the vessels are skipped.
+
+    dates: The dates to read, in ISO format ('2025-06-26')
+    mmsi_list: The vessels to keep, None to keep all vessels
+    download_workers: The maximum number of concurrent downloads
+    parse_workers: The number of processes parsing files
+    use_cache: Read through the Parquet cache, see read_day
+    region: Only keep the positions in this region, in lat/lon, see region_filter
+
+    returns: The filtered data for each day, in the same order as dates
+    """
+    parse_futures = {}
+    # polars is multithreaded, so the workers are spawned rather than forked
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+            ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn')) as parsers:
+        download_futures = {}
+        for this_date in dates:
+            if day_has_vessels(this_date, mmsi_list, region) is False:
+                continue
+            if (use_cache and os.path.isfile(get_parquet_fname(this_date))) or \
+                    os.path.isfile(get_storage_fname(this_date)):
+                parse_futures[this_date] = parsers.submit(read_day, this_date, mmsi_list, use_cache, region)
+            else:
+                download_futures[downloads.submit(download_ais_data, this_date)] = this_date
+        for fut in as_completed(download_futures):
+            this_date = download_futures[fut]
+            fut.result()
+            parse_futures[this_date] = parsers.submit(read_day, this_date, mmsi_list, use_cache, region)
+        df_list = []
+        for this_date in dates:
+            if this_date not in parse_futures:
+                print(f'Skipping {this_date}, the manifest has none of {mmsi_list}')
+                df_list.append(empty_day())
+                continue
+            df_list.append(parse_futures[this_date].result())
+            print(f'Filtered mmsi {mmsi_list} from {this_date}, '
+                  f'leaving {df_list[-1].shape} points of data')
+    return df_list
+
 
 def extract_vessel_ais(mmsi: int | list[int] | None,
-                       start_date: datetime | str, end_date: datetime | str | None = None) -> None:
+                       start_date: datetime | str, end_date: datetime | str | None = None,
+                       parse_workers: int = 1, download_workers: int = 4, use_cache: bool = False,
+                       near_project: bool = False, buffer_ft: float = geofence_buffer_ft) -> None:
     """Extract the AIS data for the given vessel and store to csv named for the date and vessel name
 
     mmsi: the mmsi number for the vessel
     start_date: the start date for the data extraction
     end_date: the end date for the data extraction
+    parse_workers: the number of processes parsing files, with more than one the days are downloaded and parsed
+                   concurrently by read_days_pipelined
+    download_workers: the maximum number of concurrent downloads in the pipelined mode
+    use_cache: read through the Parquet cache, converting days the first time they are read, see read_day
+    near_project: only keep the positions within buffer_ft of the project sections, see
+                  channel_def.ProjectGeometry.geofence. With mmsi None this is all the traffic near the project
+    buffer_ft: the distance around the project sections kept with near_project, in feet
     """
     if type(start_date) is str:
         start_date_dt = datetime.strptime(start_date, '%Y-%m-%d')
@@ -41,41 +453,54 @@ def extract_vessel_ais(mmsi: int | list[int] | None,
         mmsi_list = [mmsi]
         vessel_name = name_from_mmsi(mmsi).replace(' ', '_')
     elif mmsi is None:
+        mmsi_list = None
         vessel_name = 'All'
     else:
         vessel_name = 'multiple_vessels'
         mmsi_list = mmsi
 
+    if near_project:
+        region = get_project().geofence(buffer_ft)
+        vessel_name += '_near_project'
+    else:
+        region = None
     vessel_ais_fname = f'{vessel_name}_{start_date_dt.strftime("%Y-%m-%d")}{end_str}_ais.csv'
-    df_list = []
+    dates = [(start_date_dt + one_day * i).strftime('%Y-%m-%d') for i in range(num_days)]
 
     print(f'Extracting AIS data for vessels {mmsi_list} from {start_date} to {end_date}')
-    for i in range(num_days):
-        this_date = (start_date_dt + one_day * i).strftime('%Y-%m-%d')
-        all_ais_fname = get_storage_fname(this_date)
-
-        try:
-            df = pd.read_csv(all_ais_fname)
-            print(f'Read data from {all_ais_fname}')
-        except FileNotFoundError:
-            download_ais_data(this_date)
-            df = pd.read_csv(all_ais_fname)
-            print(f'Downloaded and read data from {all_ais_fname}')
-        df.columns = [c.lower() for c in df.columns]
-        if mmsi is None:
-            df_list.append(df)
-            print(f'Grabbed all data from {all_ais_fname}')
-        else:
-            df_list.append(df.query('mmsi in @mmsi_list'))
-            print(f'Filtered mmsi {mmsi_list} from {all_ais_fname}, leaving {df_list[-1].shape} points of data')
-    df_combined = pd.concat(df_list, ignore_index=True)
-    df_sorted = df_combined.sort_values(by="base_date_time", inplace=False)
-    df_sorted.to_csv(os.path.join(vessel_ais_storage_loc, vessel_ais_fname), index=False)
+    if parse_workers > 1:
+        df_list = read_days_pipelined(dates, mmsi_list, download_workers, parse_workers, use_cache, region)
+    else:
+        df_list = []
+        for this_date in dates:
+            all_ais_fname = get_storage_fname(this_date)
+
+            if day_has_vessels(this_date, mmsi_list, region) is False:
+                print(f'Skipping {this_date}, the manifest has none of {mmsi_list}')
+                df_list.append(empty_day())
+                continue
+            if use_cache and os.path.isfile(get_parquet_fname(this_date)):
+                print(f'Reading data from {get_parquet_fname(this_date)}')
+            elif os.path.isfile(all_ais_fname):
+                print(f'Reading data from {all_ais_fname}')
+            else:
+                download_ais_data(this_date)
+                print(f'Downloaded data to {all_ais_fname}')
+            df_list.append(read_day(this_date, mmsi_list, use_cache, region))
+            if mmsi is None:
+                print(f'Grabbed all data from {this_date}, {df_list[-1].shape} points of data')
+            else:
+                print(f'Filtered mmsi {mmsi_list} from {this_date}, '
+                      f'leaving {df_list[-1].shape} points of data')
+    df_combined = pl.concat(df_list, how='diagonal_relaxed')
+    df_sorted = df_combined.sort('base_date_time')
+    df_sorted.write_csv(os.path.join(vessel_ais_storage_loc, vessel_ais_fname))
 
 
 if __name__ == '__main__':
 
     extract_vessel_ais(list(mmsi_from_name.values()),
                        datetime.fromisoformat('2025-06-02'),
-                       datetime.fromisoformat('2025-06-04'))
+                       datetime.fromisoformat('2025-06-04'),
+                       parse_workers=4)
 
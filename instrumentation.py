@@ -0,0 +1,140 @@
+"""instrumentation.py - Timing spans for the pipeline stages
+
+Wrap a stage in span() to record how long it took, the rows and bytes it handled, and the peak memory of the process:
+
+    with span('db_write', file=fname) as s:
+        ...
+        s.rows = inserted
+
+Each span is written as one JSON line to metrics_fname when it ends, from every process and thread, so a night's
+run can be broken down by stage afterwards, see summarize. Spans only cost a clock read on entry and one short write
+on exit, so they are left on around the coarse steps (a file, a day, a query, a map update) and kept out of per-row
+loops. Set enabled to False, or the AIS_METRICS environment variable to 0, to turn them off.
+
+The stages recorded:
+download, verify_zstd, parse_filter, convert_parquet, index, db_write, query, locate, classify, rollup, map_render
+Some spans run inside others (verify_zstd in download, index in convert_parquet, locate in classify), so their times
+are not added up.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+import sys
+import threading
+import time
+from typing import Iterator
+
+try:
+    import resource  # Not available on Windows, peak memory is not recorded there
+except ImportError:
+    resource = None
+
+metrics_fname = os.path.join(os.getcwd(), 'pipeline_metrics.jsonl')
+enabled = os.environ.get('AIS_METRICS', '1') != '0'
+
+write_lock = threading.Lock()
+
+
+def peak_rss_bytes() -> int | None:
+    """Return the peak resident memory of this process in bytes, None if it is not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports kB
+
+
+class Span:
+    """One timed stage, set rows and bytes before the span ends to get the rates
+
+    stage: The stage name
+    rows: The number of rows handled, if known at the start
+    num_bytes: The number of bytes handled, if known at the start
+    fields: Anything else to record with the span, such as a file name or mmsi
+    """
+    def __init__(self, stage: str, rows: int | None = None, num_bytes: int | None = None, **fields):
+        self.stage = stage
+        self.fields = fields
+        self.rows = rows
+        self.bytes = num_bytes
+        self.start = time.perf_counter()
+        self.started = datetime.now(timezone.utc)
+
+    def record(self, error: BaseException | None = None) -> dict:
+        """Return the span as a dict, with the duration and rates up to now"""
+        seconds = time.perf_counter() - self.start
+        rec = {'stage': self.stage,
+               'start': self.started.isoformat(),
+               'seconds': seconds,
+               'rows': self.rows,
+               'bytes': self.bytes,
+               'rows_per_s': self.rows / seconds if self.rows is not None and seconds > 0 else None,
+               'bytes_per_s': self.bytes / seconds if self.bytes is not None and seconds > 0 else None,
+               'peak_rss_bytes': peak_rss_bytes(),
+               'pid': os.getpid(),
+               'thread': threading.current_thread().name}
+        if error is not None:
+            rec['error'] = f'{type(error).__name__}: {error}'
+        rec.update(self.fields)
+        return rec
+
+
+def write_record(rec: dict) -> None:
+    """Append a record to the metrics file"""
+    line = json.dumps(rec, default=str) + '\n'
+    with write_lock, open(metrics_fname, 'a') as f:
+        f.write(line)
+
+
+@contextmanager
+def span(stage: str, rows: int | None = None, num_bytes: int | None = None, **fields) -> Iterator[Span]:
+    """Time a stage of the pipeline, writing the span to metrics_fname when it ends, see Span"""
+    s = Span(stage, rows, num_bytes, **fields)
+    if not enabled:
+        yield s
+        return
+    try:
+        yield s
+    except BaseException as e:
+        write_record(s.record(e))
+        raise
+    write_record(s.record())
+
+
+def read_metrics(fname: str | None = None) -> list[dict]:
+    """Return the spans recorded in a metrics file"""
+    if fname is None:
+        fname = metrics_fname
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(fname: str | None = None) -> dict[str, dict]:
+    """Total the spans in a metrics file by stage
+
+    returns: For each stage the number of spans, total seconds, rows and bytes, the overall rates and the largest
+             peak memory
+    """
+    totals = {}
+    for rec in read_metrics(fname):
+        t = totals.setdefault(rec['stage'], {'spans': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0,
+                                             'errors': 0, 'peak_rss_bytes': None})
+        t['spans'] += 1
+        t['seconds'] += rec['seconds']
+        t['rows'] += rec['rows'] or 0
+        t['bytes'] += rec['bytes'] or 0
+        t['errors'] += 'error' in rec
+        if rec.get('peak_rss_bytes') is not None:
+            t['peak_rss_bytes'] = max(t['peak_rss_bytes'] or 0, rec['peak_rss_bytes'])
+    for t in totals.values():
+        t['rows_per_s'] = t['rows'] / t['seconds'] if t['rows'] and t['seconds'] > 0 else None
+        t['bytes_per_s'] = t['bytes'] / t['seconds'] if t['bytes'] and t['seconds'] > 0 else None
+    return totals
+
+
+if __name__ == '__main__':
+    for stage_name, stage_totals in sorted(summarize().items(), key=lambda kv: -kv[1]['seconds']):
+        rows_per_s = f'{stage_totals["rows_per_s"]:12.0f} rows/s' if stage_totals['rows_per_s'] else ' ' * 19
+        mb_per_s = f'{stage_totals["bytes_per_s"] / 2**20:9.1f} MB/s' if stage_totals['bytes_per_s'] else ''
+        print(f'{stage_name:>16} {stage_totals["spans"]:6} spans {stage_totals["seconds"]:10.2f} s '
+              f'{rows_per_s} {mb_per_s}')
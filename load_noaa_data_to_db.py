@@ -0,0 +1,162 @@
+"""Load NOAA daily AIS data for the dredges straight into the DB
+
+The NOAA columns are mapped onto ais_data:
+base_date_time => utc_timestamp_ms (the NOAA times are UTC)
+mmsi, longitude, latitude, sog, cog, heading, status, draft, cargo => the same names
+vessel_name => vessel_data, for vessels not already there
+
+Days are downloaded by a pool of threads and filtered to the vessels in worker processes, see
+get_vessel_ais_from_noaa.read_day, while this process writes each day as it is ready. Each vessel's rows for a day are
+recorded in uploaded_files under the name of the daily file and the mmsi, in the same transaction as the data, so
+days already loaded are skipped and an interrupted batch can be rerun.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+import sqlite3
+
+import polars as pl
+
+import ais_db
+from ais_db import ais_database, insert_uploaded_file
+from get_data_from_noaa import get_storage_fname, download_ais_data
+from get_vessel_ais_from_noaa import get_parquet_fname, read_day
+from vessel_mmsi import mmsi_from_name
+
+# The NOAA columns loaded into ais_data, base_date_time becomes utc_timestamp_ms
+noaa_db_columns = ['utc_timestamp_ms', 'mmsi', 'longitude', 'latitude', 'sog', 'cog', 'heading', 'status', 'draft',
+                   'cargo']
+
+
+def upload_name(date: str, mmsi: int | None) -> str:
+    """Return the name a vessel's data from a daily file is recorded under in uploaded_files, mmsi None for all vessels"""
+    return f'{os.path.basename(get_storage_fname(date))}:{"all" if mmsi is None else mmsi}'
+
+
+def day_loaded(conn: sqlite3.Connection, date: str, mmsi_list: list[int] | None) -> bool:
+    """Return True if the day has already been loaded for all the vessels"""
+    if ais_db.get_uploaded_file(conn, upload_name(date, None)) is not None:
+        return True
+    if mmsi_list is None:
+        return False
+    return all(ais_db.get_uploaded_file(conn, upload_name(date, m)) is not None for m in mmsi_list)
+
+
+def parse_noaa_day(date: str, mmsi_list: list[int] | None, use_cache: bool = False) -> pl.DataFrame:
+    """Read one day of NOAA data for the vessels and map it onto the ais_data columns
+
+    date: A date in ISO format ('2025-06-26'), the daily file must already be downloaded if it is not in the cache
+    mmsi_list: The vessels to keep, None to keep all vessels
+    use_cache: Read through the Parquet cache, see get_vessel_ais_from_noaa.read_day
+
+    returns: A polars DataFrame with the noaa_db_columns that were in the file, and vessel_name, sorted by mmsi and
+             time
+    """
+    df = read_day(date, mmsi_list, use_cache)
+    if df.schema['base_date_time'] == pl.String:
+        df = df.with_columns(pl.col('base_date_time').str.to_datetime(time_unit='ms', strict=False))
+    df = df.with_columns(pl.col('base_date_time').dt.epoch('ms').alias('utc_timestamp_ms'))
+    columns = [c for c in noaa_db_columns if c in df.columns]
+    if 'vessel_name' in df.columns:
+        columns.append('vessel_name')
+    return df.select(columns).drop_nulls(['mmsi', 'utc_timestamp_ms']).sort(['mmsi', 'utc_timestamp_ms'])
+
+
+def write_noaa_day(date: str, df: pl.DataFrame, mmsi_list: list[int] | None,
+                   ais_db_connection: sqlite3.Connection) -> int:
+    """Write one parsed day to the DB, one uploaded_files row and transaction per vessel
+
+    Vessels already loaded for the day are skipped, and the names of vessels new to vessel_data are added.
+
+    returns: The number of rows inserted
+    """
+    columns = [c for c in df.columns if c != 'vessel_name']
+    if 'vessel_name' in df.columns:
+        names = df.select(['mmsi', 'vessel_name']).drop_nulls().unique('mmsi')
+        ais_db_connection.executemany('INSERT OR IGNORE INTO vessel_data (mmsi, vessel_name) VALUES (?, ?)',
+                                      names.iter_rows())
+        ais_db_connection.commit()
+    inserted = 0
+    if mmsi_list is None:
+        groups = [(None, df)]
+    else:
+        groups = [(m, df.filter(pl.col('mmsi') == m)) for m in mmsi_list]
+    for mmsi, vessel_df in groups:
+        if ais_db.get_uploaded_file(ais_db_connection, upload_name(date, mmsi)) is not None:
+            continue
+        _, n = insert_uploaded_file(ais_db_connection, upload_name(date, mmsi),
+                                    vessel_df.select(columns).iter_rows(), columns)
+        inserted += n
+    return inserted
+
+
+def load_noaa_data_batch(dates: list[str], mmsi_list: list[int] | None, ais_db_connection: sqlite3.Connection,
+                         download_workers: int = 4, parse_workers: int = 4, use_cache: bool = False,
+                         max_pending: int | None = None) -> dict[str, int]:
+    """Load several days of NOAA data for the vessels to the DB
+
+    Missing days are downloaded by a pool of threads, and each day is parsed in a pool of worker processes as soon
+    as its file is available. This process writes each day as soon as it is parsed, while downloads continue. At most
+    max_pending days are being parsed or waiting to be written, so the parsed days held in memory do not grow with
+    the batch. Loads left incomplete by an earlier crash are removed first and days already loaded are skipped. The
+    secondary indexes are rebuilt once at the end.
+
+    dates: The dates to load, in ISO format ('2025-06-26')
+    mmsi_list: The vessels to load, None to load all vessels
+    ais_db_connection: Connection to the AIS database
+    download_workers: The maximum number of concurrent downloads
+    parse_workers: The number of parsing processes
+    use_cache: Read through the Parquet cache, see get_vessel_ais_from_noaa.read_day
+    max_pending: The most days submitted for parsing and not yet written, defaults to twice parse_workers
+
+    returns: The number of rows inserted for each day loaded
+    """
+    ais_db.remove_incomplete_uploads(ais_db_connection)
+    to_load = []
+    for this_date in dates:
+        if day_loaded(ais_db_connection, this_date, mmsi_list):
+            print(f'load_noaa_data_batch: {this_date} already loaded')
+        else:
+            to_load.append(this_date)
+
+    if max_pending is None:
+        max_pending = 2 * parse_workers
+    inserted = {}
+    # polars is multithreaded, so the workers are spawned rather than forked
+    with ais_db.bulk_loading(ais_db_connection), \
+            ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+            ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn')) as parsers:
+        ready = deque()  # Days with a file, waiting for a parser
+        download_futures = {}
+        parse_futures = {}
+        for this_date in to_load:
+            if (use_cache and os.path.isfile(get_parquet_fname(this_date))) or \
+                    os.path.isfile(get_storage_fname(this_date)):
+                ready.append(this_date)
+            else:
+                download_futures[downloads.submit(download_ais_data, this_date)] = this_date
+        while ready or download_futures or parse_futures:
+            while ready and len(parse_futures) < max_pending:
+                this_date = ready.popleft()
+                parse_futures[parsers.submit(parse_noaa_day, this_date, mmsi_list, use_cache)] = this_date
+            done, _ = wait([*download_futures, *parse_futures], return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut in download_futures:
+                    fut.result()
+                    ready.append(download_futures.pop(fut))
+                    continue
+                this_date = parse_futures.pop(fut)
+                df = fut.result()
+                inserted[this_date] = write_noaa_day(this_date, df, mmsi_list, ais_db_connection)
+                print(f'Loaded {inserted[this_date]} new rows of {df.shape[0]} for {this_date}')
+    return inserted
+
+
+if __name__ == '__main__':
+    connection = ais_db.connect(ais_database)
+    start_date = datetime.fromisoformat('2025-06-02')
+    num_days = 3
+    load_dates = [(start_date + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(num_days)]
+    load_noaa_data_batch(load_dates, list(mmsi_from_name.values()), connection)
@@ -9,92 +9,142 @@ SPEED  => sog
 HEADING  => heading
 COURSE  => cog
 timeStamp => utc_timestamp_ms
+
+load_port_data_batch parses the files in worker processes while a single writer inserts them, one transaction per
+file. A file is recorded in uploaded_files in the same transaction as its data, and loads that never completed are
+removed and redone, so the batch can be rerun safely after a crash.
 """
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timezone
 import glob
+import multiprocessing
 import os
 import sqlite3
 
 import pandas as pd
 
+import ais_db
+from ais_db import ais_database, insert_uploaded_file
+
 port_data_loc = os.path.join(os.getcwd(), 'AIS_RBWeeks_Magdalen')
-ais_database = os.path.join(os.getcwd(), 'Matsu_AIS.sqlite')
-
-AIS_DATA_TABLE_SQL = """create table ais_data(utc_timestamp_ms integer not null,
-                                              status           integer,
-                                              cargo            integer,
-                                              longitude        REAL,
-                                              latitude         REAL,
-                                              sog              REAL,
-                                              cog              REAL,
-                                              heading          REAL,
-                                              draft            REAL,
-                                              file_id          integer,
-                                              mmsi             integer not null
-                                             );"""
-
-UPLOADED_FILES_TABLE_SQL = """create table uploaded_files(filename    TEXT,
-                                                          upload_date TEXT,
-                                                          file_id     INTEGER not null
-                                                                      constraint uploaded_files_pk
-                                                                      primary key
-                                                         );"""
+
+port_columns = {"longitude": "longitude",
+                "latitude": "latitude",
+                "MMSI": "mmsi",
+                "SPEED": "sog",
+                "HEADING": "heading",
+                "COURSE": "cog",
+                "STATUS": "status",
+                "TIMESTAMP": "utc_timestamp_ms"}
+
+
+def parse_port_data(port_data_fname: str) -> tuple[pd.DataFrame, dict]:
+    """Read a file of data in Port Houston format, renaming the columns to the DB names
+
+    port_data_fname: The file name, in port_data_loc
+
+    returns: The data with the ais_data columns, and a summary dict with the number of rows, the first and last
+             timestamps and the vessels in the file
+    """
+    df = pd.read_csv(os.path.join(port_data_loc, port_data_fname), usecols=lambda c: c in port_columns)
+    df.rename(columns=port_columns, inplace=True)
+    df = df[[c for c in ais_db.ais_data_columns if c in df.columns]]
+    summary = {'rows': df.shape[0],
+               'start_ms': int(df.utc_timestamp_ms.min()) if df.shape[0] else None,
+               'end_ms': int(df.utc_timestamp_ms.max()) if df.shape[0] else None,
+               'mmsi': [int(m) for m in df.mmsi.unique()]}
+    return df, summary
+
+
+def write_port_data(port_data_fname: str, df: pd.DataFrame, ais_db_connection: sqlite3.Connection) -> int:
+    """Write parsed Port Houston data to the DB, with its uploaded_files row, in one transaction
+
+    returns: The number of rows inserted
+    """
+    _, inserted = insert_uploaded_file(ais_db_connection, port_data_fname,
+                                       df.itertuples(index=False, name=None), list(df.columns))
+    return inserted
+
+
+def print_summary(port_data_fname: str, summary: dict, ais_db_connection: sqlite3.Connection):
+    """Print the time span and vessels of a loaded file"""
+    if summary['rows'] == 0:
+        print(f'AIS data in {port_data_fname}: no rows')
+        return
+    start_date = datetime.fromtimestamp(summary['start_ms']/1000, timezone.utc)
+    end_date = datetime.fromtimestamp(summary['end_ms']/1000, timezone.utc)
+    print(f'AIS data in {port_data_fname}: {summary["rows"]} rows ({summary["inserted"]} new) '
+          f'Spanning {start_date} to {end_date}, including vessels:')
+    for mmsi in summary['mmsi']:
+        vessel_data = ais_db_connection.execute('SELECT * FROM vessel_data WHERE mmsi=?', (mmsi, )).fetchall()
+        print(vessel_data if vessel_data else [(mmsi, None)])
 
 
 def load_port_data_to_db(port_data_fname: str, ais_db_connection: sqlite3.Connection):
-    """Load a file of data in Port Houston format to the DB"""
-    ais_db_cursor = ais_db_connection.cursor()
-    ais_db_cursor.execute("SELECT * FROM uploaded_files WHERE filename=?", (port_data_fname,))
-    rows = ais_db_cursor.fetchall()
-    if len(rows) > 0:
-        print(f'load_port_data_to_db: file {port_data_fname} already loaded on {rows[0][1]}')
+    """Load a file of data in Port Houston format to the DB
+
+    The uploaded_files row and the data are committed in one transaction, points already in the DB are skipped"""
+    if (uploaded := ais_db.get_uploaded_file(ais_db_connection, port_data_fname)) is not None:
+        print(f'load_port_data_to_db: file {port_data_fname} already loaded on {uploaded[0]}')
         return
-    else:
-        ais_db_cursor.execute("INSERT INTO uploaded_files (filename, upload_date, file_id) VALUES (?, ?, ?)",
-                              (port_data_fname, datetime.now(), None))
-        ais_db_connection.commit()
-        ais_db_cursor.execute("SELECT last_insert_rowid()")
-        rows = ais_db_cursor.fetchall()
-        file_id = rows[0][0]
-
-    df = pd.read_csv(os.path.join(port_data_loc, port_data_fname))
-    df.rename(columns={"longitude": "longitude",
-                       "latitude": "latitude",
-                       "MMSI": "mmsi",
-                       "SPEED": "sog",
-                       "HEADING": "heading",
-                       "COURSE": "cog",
-                       "STATUS": "status",
-                       "TIMESTAMP": "utc_timestamp_ms"}, inplace=True)
-    df['file_id'] = file_id
-    df.to_sql(name='ais_data', con=ais_db_connection, if_exists='append', index=False)
-    ais_db_connection.commit()
+    df, _ = parse_port_data(port_data_fname)
+    write_port_data(port_data_fname, df, ais_db_connection)
+
+
+def load_port_data_batch(port_data_fnames: list[str], ais_db_connection: sqlite3.Connection,
+                         workers: int = 4, max_pending: int | None = None) -> dict[str, dict]:
+    """Load several files of data in Port Houston format to the DB
+
+    The files are parsed in a pool of worker processes, and this process writes each one as it is ready. A new file
+    is only submitted as one is written, so at most max_pending parsed files wait for the writer whatever the size of
+    the batch. Loads left incomplete by an earlier crash are removed first and files already loaded are skipped, so
+    rerunning a batch is safe. The secondary indexes are rebuilt once at the end.
+
+    port_data_fnames: The file names, in port_data_loc
+    ais_db_connection: Connection to the AIS database
+    workers: The number of parsing processes
+    max_pending: The most files submitted for parsing and not yet written, defaults to twice workers
+
+    returns: The summary of each file loaded, see parse_port_data, with the number of rows inserted added
+    """
+    ais_db.remove_incomplete_uploads(ais_db_connection)
+    to_load = []
+    for fname in port_data_fnames:
+        if (uploaded := ais_db.get_uploaded_file(ais_db_connection, fname)) is not None:
+            print(f'load_port_data_batch: file {fname} already loaded on {uploaded[0]}')
+        else:
+            to_load.append(fname)
+
+    if max_pending is None:
+        max_pending = 2 * workers
+    summaries = {}
+    with ais_db.bulk_loading(ais_db_connection), \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as parsers:
+        waiting = deque(to_load)
+        futures = {}
+        while waiting or futures:
+            while waiting and len(futures) < max_pending:
+                fname = waiting.popleft()
+                futures[parsers.submit(parse_port_data, fname)] = fname
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                fname = futures.pop(fut)
+                df, summary = fut.result()
+                print(f'------------ Loading ais data from {fname} --------------------')
+                summary['inserted'] = write_port_data(fname, df, ais_db_connection)
+                summaries[fname] = summary
+    return summaries
 
 
 if __name__ == '__main__':
-    connection = sqlite3.connect(ais_database)
-    cursor = connection.cursor()
+    connection = ais_db.connect(ais_database)
     if debug := True:  # Set to false once there is good data in the db
-        cursor.execute('DROP TABLE IF EXISTS ais_data')
-        cursor.execute('DROP TABLE IF EXISTS uploaded_files')
-        connection.commit()
-        cursor.execute(AIS_DATA_TABLE_SQL)
-        cursor.execute(UPLOADED_FILES_TABLE_SQL)
-        connection.commit()
-
-    for fname_full in sorted(glob.glob(os.path.join(port_data_loc, "*.csv"))):
-        fname = os.path.basename(fname_full)
-        print(f'------------ Loading ais data from {fname} --------------------')
-        load_port_data_to_db(fname, connection)
-        file_id = cursor.execute("SELECT file_id FROM uploaded_files WHERE filename=?",
-                                 (fname, )).fetchone()[0]
-        ais_df = pd.read_sql(f'SELECT * FROM ais_data WHERE file_id={file_id}', con=connection,)
-        start_date = datetime.fromtimestamp(ais_df.utc_timestamp_ms.min()/1000, timezone.utc)
-        end_date = datetime.fromtimestamp(ais_df.utc_timestamp_ms.max()/1000, timezone.utc)
-        mmsi_list = ais_df.mmsi.unique()
-
-        print(f'AIS data in {fname}: {ais_df.shape} Spanning {start_date} to {end_date}, including vessels:')
-        for mmsi in mmsi_list:
-            vessel_data = cursor.execute(f'SELECT * FROM vessel_data WHERE mmsi={mmsi}').fetchall()
-            print(vessel_data)
+        ais_db.clear_ais_data(connection)
+
+    fnames = [os.path.basename(f) for f in sorted(glob.glob(os.path.join(port_data_loc, "*.csv")))]
+    file_summaries = load_port_data_batch(fnames, connection)
+    for fname in fnames:
+        if fname in file_summaries:
+            print_summary(fname, file_summaries[fname], connection)
@@ -1,77 +1,73 @@
-"""Test drawing lines on maps using geopandas"""
+"""Dash dashboard of the dredge tracks and activity
+
+Nothing touches the DB at import, the app factory create_app builds the dashboard: the map of a vessel's track over
+the project sections, and a panel of the hours it spent on each activity per day or week, read from the stored rollups
+(see classify_loads.get_rollups). The vessels and date range come from a map_cache.DBMetadata refreshed in a
+background thread, each request thread reads through its own read-only connection, and the tracks are built in the
+map_cache track threads, see map_cache.submit_track.
+
+Development server, Dash's own:
+    python map_app.py
+Production, with a WSGI server and each worker process with its own connections and caches. On Linux and macOS use
+gunicorn with the create_server factory:
+    gunicorn -w 4 -b 0.0.0.0:8050 "map_app:create_server()"
+or on Windows, set production in __main__ to serve with waitress, see serve
+"""
 from datetime import datetime, timedelta
-import os
-import sqlite3
 
-from dash import Dash, dcc, html, Input, Output, callback
-import geopandas as gpd
-import numpy as np
+from dash import Dash, dcc, html, Input, Output
+import pandas as pd
 import plotly.graph_objects as go
-import shapely.geometry
-
-from channel_def import project_sections, colors, project_center
-from classify_loads import load_ais_data
-
-ais_database = os.path.join(os.getcwd(), 'Matsu_AIS.sqlite')
-conn = sqlite3.connect(ais_database)
-cur = conn.cursor()
-
-min_ts, max_ts = cur.execute('SELECT min(utc_timestamp_ms), max(utc_timestamp_ms) FROM ais_data').fetchall()[0]
-first_date = datetime.fromtimestamp(min_ts/1000)
-last_date = datetime.fromtimestamp(max_ts/1000)
-print(f'Data in DB from {first_date} to {last_date}')
-
-rows = cur.execute('SELECT distinct(mmsi) FROM ais_data').fetchall()
-mmsi_list = [x[0] for x in rows]
-vessel_names = []
-for m in mmsi_list:
-    vn = cur.execute('SELECT vessel_name FROM vessel_data WHERE mmsi = ?', (m, )).fetchall()[0][0]
-    vessel_names.append(vn)
-opts = [{'label': vn, 'value': vmmsi} for vn, vmmsi in zip(vessel_names, mmsi_list)]
-vessel_picker = dcc.Dropdown(options=opts,
-                             value=mmsi_list[0],
-                             id='vessel-picker'
-                             )
-
-date_picker = dcc.DatePickerRange(id='my-date-picker-range',
-                                  min_date_allowed=first_date,
-                                  max_date_allowed=last_date,
-                                  # initial_visible_month=date(2025, 6, 2),
-                                  start_date=first_date,
-                                  end_date=first_date + timedelta(days=2)
-                                  )
-map_graph = dcc.Graph(id='map-graph')
-
-
-def get_vessel_track(conn: sqlite3.Connection, vessel_mmsi: int,
-                     start_time: datetime, end_time: datetime) -> gpd.GeoDataFrame:
-    """Return a GeoDataFrame with the track for the given vessel over a timeframe"""
-    start_ts = start_time.timestamp()*1000
-    end_ts = end_time.timestamp()*1000
-    df = load_ais_data(conn, vessel_mmsi, start_ts, end_ts)
-    geo_inputs = {'name': ['dredge_track'],
-                  'coord_file': ["from_DB"],
-                  'geometry': [shapely.geometry.linestring.LineString(gpd.points_from_xy(df.longitude, df.latitude,
-                                                                                         crs="EPSG:4326"))],
-                  'color': ['gray'],
-                  'stations': [None],
-                  'sog': [df['sog']]
-                  }
-    gdf = gpd.GeoDataFrame(geo_inputs,
-                           geometry=geo_inputs['geometry'],
-                           crs="EPSG:4326")
-    return gdf
-
-
-@callback(Output('map-graph', 'figure'),
-          Input('vessel-picker', 'value'),
-          Input('my-date-picker-range', 'start_date'),
-          Input('my-date-picker-range', 'end_date'))
-def update_map(vessel_mmsi: int, start_date, end_date) -> go.Figure:
-    """Update the map widget after changes to vessel or dates"""
-
-    fig = go.Figure()
-    traces = dict()
+
+import ais_db
+from ais_db import ais_database
+import map_cache
+from channel_def import colors, get_project
+from classify_loads import get_rollups
+from instrumentation import span
+from track import activities
+
+track_timeout_s = 120  # Seconds a map update waits for its track
+default_port = 8050
+activity_colors = {'dig': 'green',
+                   'sail': 'gray',
+                   'disp': 'magenta',
+                   'delay': 'red'}
+
+
+def make_layout(metadata: map_cache.DBMetadata) -> html.Div:
+    """Build the page from the latest metadata, called on each page load"""
+    snapshot = metadata.snapshot()
+    if snapshot['first_ts'] is None:  # Nothing loaded yet
+        first_date = last_date = datetime.now()
+    else:
+        first_date = datetime.fromtimestamp(snapshot['first_ts']/1000)
+        last_date = datetime.fromtimestamp(snapshot['last_ts']/1000)
+    opts = [{'label': v['name'], 'value': v['mmsi']} for v in snapshot['vessels']]
+    vessel_picker = dcc.Dropdown(options=opts,
+                                 value=opts[0]['value'] if opts else None,
+                                 id='vessel-picker'
+                                 )
+
+    date_picker = dcc.DatePickerRange(id='my-date-picker-range',
+                                      min_date_allowed=first_date,
+                                      max_date_allowed=last_date,
+                                      # initial_visible_month=date(2025, 6, 2),
+                                      start_date=first_date,
+                                      end_date=first_date + timedelta(days=2)
+                                      )
+    map_graph = dcc.Graph(id='map-graph')
+    bucket_picker = dcc.RadioItems(options=[{'label': f'Hours per {b}', 'value': b} for b in ['day', 'week']],
+                                   value='day',
+                                   id='rollup-bucket',
+                                   inline=True
+                                   )
+    rollup_graph = dcc.Graph(id='rollup-graph')
+    return html.Div([map_graph, vessel_picker, date_picker, bucket_picker, rollup_graph])
+
+
+def date_range(start_date: str, end_date: str) -> tuple[datetime, datetime]:
+    """Return the start and end of the range picked, a single day if they are the same"""
     if start_date > end_date:
         start_dt, end_dt = datetime.fromisoformat(end_date), datetime.fromisoformat(start_date)
     elif start_date == end_date:
@@ -80,56 +76,130 @@ def update_map(vessel_mmsi: int, start_date, end_date) -> go.Figure:
     else:
         start_dt = datetime.fromisoformat(start_date)
         end_dt = datetime.fromisoformat(end_date)
-
-    project_sections['track'] = get_vessel_track(sqlite3.connect(ais_database),
-                                                 vessel_mmsi,
-                                                 start_dt,
-                                                 end_dt)
-    for feature_type in colors.keys():
-        geo_df = project_sections[feature_type]
-        for feature, name in zip(geo_df.geometry, geo_df.name):
-            lats = []
-            lons = []
-            names = []
-            if isinstance(feature, shapely.geometry.linestring.LineString):
-                linestrings = [feature]
-            elif isinstance(feature, shapely.geometry.multilinestring.MultiLineString):
-                linestrings = feature.geoms
-            else:
-                continue
-            for linestring in linestrings:
-                x, y = linestring.xy
-                lats = np.append(lats, y)
-                lons = np.append(lons, x)
-                names = np.append(names, [name]*len(y))
-                if feature_type == 'disable color scale':  # 'track':
-                    marker = {'color': geo_df['sog'],
-                              'colorscale': 'turbo'}
-                else:
-                    marker = None
-
-                traces[name] = s = go.Scattermap(mode="markers+lines",
-                                                 lat=lats,
-                                                 lon=lons,
-                                                 marker=marker,
-                                                 name=names[0],
-                                                 line=dict(color=colors[feature_type])
-                                                 )
-                fig.add_trace(s)
-    fig.update_layout(title_text='HSC Maintenance',
-                      showlegend=True,
-                      map={'style': 'satellite',
-                           'zoom': 10,
-                           'center': {'lat': project_center.geometry.y.iloc[0],
-                                      'lon': project_center.geometry.x.iloc[0]},
-                           },
-                      width=1000,
-                      height=1000,
-                      )
+    return start_dt, end_dt
+
+
+def update_rollup_panel(vessel_mmsi: int, start_date, end_date, bucket: str = 'day') -> go.Figure:
+    """Update the activity panel, the hours on each activity per day or week from the stored rollups"""
+    start_dt, end_dt = date_range(start_date, end_date)
+    with span('map_render', mmsi=vessel_mmsi, panel='rollups') as s:
+        rollups = get_rollups(map_cache.pool.reader(), vessel_mmsi, start_dt.timestamp()*1000,
+                              end_dt.timestamp()*1000 - 1, bucket=bucket)
+        rollups['bucket'] = pd.to_datetime(rollups['bucket_ms'], unit='ms', utc=True)
+        fig = go.Figure()
+        for activity in activities:
+            activity_rollups = rollups[rollups['activity'] == activity]
+            fig.add_trace(go.Bar(x=activity_rollups['bucket'],
+                                 y=activity_rollups['duration_s'] / 3600,
+                                 name=activity,
+                                 marker_color=activity_colors[activity]
+                                 ))
+        fig.update_layout(title_text=f'Hours per {bucket}',
+                          barmode='stack',
+                          yaxis_title='hours',
+                          width=1000,
+                          height=400,
+                          )
+        s.rows = rollups.shape[0]
     return fig
 
 
-app = Dash()
-app.layout = html.Div([map_graph, vessel_picker, date_picker])
+def update_map(vessel_mmsi: int, start_date, end_date, relayout_data=None) -> go.Figure:
+    """Update the map widget after changes to vessel, dates or zoom
+
+    The project features are drawn from traces built once, and the track is assembled from cached days in the
+    map_cache track threads while the figure is built, see map_cache
+    """
+    start_dt, end_dt = date_range(start_date, end_date)
+    zoom = 10
+    if isinstance(relayout_data, dict) and 'map.zoom' in relayout_data:
+        zoom = relayout_data['map.zoom']
+
+    with span('map_render', mmsi=vessel_mmsi, zoom=zoom) as s:
+        track_future = map_cache.submit_track(vessel_mmsi, start_dt.timestamp()*1000, end_dt.timestamp()*1000, zoom)
+        project = get_project()
+        fig = go.Figure(data=map_cache.static_traces(project.project_sections, colors))
+        track = track_future.result(timeout=track_timeout_s)
+        fig.add_trace(go.Scattermap(mode="markers+lines",
+                                    lat=track['lat'],
+                                    lon=track['lon'],
+                                    name='dredge_track',
+                                    line=dict(color=colors['track'])
+                                    ))
+        fig.update_layout(title_text='HSC Maintenance',
+                          showlegend=True,
+                          map={'style': 'satellite',
+                               'zoom': 10,
+                               'center': {'lat': project.project_center.geometry.y.iloc[0],
+                                          'lon': project.project_center.geometry.x.iloc[0]},
+                               },
+                          width=1000,
+                          height=1000,
+                          uirevision='map',  # Keep the user's pan and zoom when the figure is rebuilt
+                          )
+        s.rows = track['lon'].shape[0]
+    return fig
+
 
-app.run(debug=True, use_reloader=False)
+def create_app(db_path: str = ais_database, refresh_s: float = map_cache.metadata_refresh_s) -> Dash:
+    """Build the dashboard
+
+    db_path: The AIS database
+    refresh_s: Seconds between refreshes of the vessels and date range
+
+    returns: The Dash app, app.server is its WSGI application
+    """
+    # The pool's read-only connections cannot migrate, so an older database is brought up to date first by opening a
+    # writable connection, see ais_db.migrate
+    ais_db.connect(db_path).close()
+    map_cache.pool = map_cache.ConnectionPool(db_path)
+    metadata = map_cache.DBMetadata(map_cache.pool, refresh_s)
+    metadata.start()
+    snapshot = metadata.snapshot()
+    if snapshot['first_ts'] is not None:
+        print(f'Data in DB from {datetime.fromtimestamp(snapshot["first_ts"]/1000)} to '
+              f'{datetime.fromtimestamp(snapshot["last_ts"]/1000)}, {len(snapshot["vessels"])} vessels')
+
+    app = Dash(__name__)
+    app.layout = lambda: make_layout(metadata)
+    app.callback(Output('map-graph', 'figure'),
+                 Input('vessel-picker', 'value'),
+                 Input('my-date-picker-range', 'start_date'),
+                 Input('my-date-picker-range', 'end_date'),
+                 Input('map-graph', 'relayoutData'))(update_map)
+    app.callback(Output('rollup-graph', 'figure'),
+                 Input('vessel-picker', 'value'),
+                 Input('my-date-picker-range', 'start_date'),
+                 Input('my-date-picker-range', 'end_date'),
+                 Input('rollup-bucket', 'value'))(update_rollup_panel)
+
+    @app.server.route('/cache-stats')
+    def cache_stats():
+        """Report the map cache hit and miss counts as JSON"""
+        stats = map_cache.cache_stats()
+        stats['metadata_refreshed'] = str(metadata.snapshot()['refreshed'])
+        return stats
+
+    return app
+
+
+def create_server(db_path: str = ais_database):
+    """Return the Flask server of a new dashboard, for gunicorn and other WSGI servers"""
+    return create_app(db_path).server
+
+
+def serve(app: Dash, host: str = '0.0.0.0', port: int = default_port, threads: int = 8) -> None:
+    """Serve the dashboard with waitress, a production WSGI server that also runs on Windows
+
+    threads: The number of request threads
+    """
+    from waitress import serve as waitress_serve  # Only needed in production
+    waitress_serve(app.server, host=host, port=port, threads=threads)
+
+
+if __name__ == '__main__':
+    dash_app = create_app()
+    if production := False:
+        serve(dash_app)
+    else:
+        dash_app.run(debug=True, use_reloader=False)
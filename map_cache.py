@@ -0,0 +1,338 @@
+"""map_cache.py - Caches for the map_app callbacks
+
+* ConnectionPool hands each thread its own read-only connection, opened once, and serializes the few writes (the
+  track pyramids) through one writable connection
+* LRUCache holds the per-(mmsi, day, level) track chunks, so a range is assembled from days already read
+* DayCounts holds the number of points of each vessel day, so a map request does not count the range again to find
+  the days whose pyramids are out of date
+* static_traces builds the channel, dig and disposal traces once
+* DBMetadata holds the vessels and the date range in the DB, refreshed in a background thread so page loads never
+  scan the DB
+* submit_track runs the track queries in a small pool of threads, and requests for a track already being built share
+  the result
+
+The caches count hits and misses, see cache_stats.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+import sqlite3
+import threading
+from typing import Any, Callable
+
+import numpy as np
+import plotly.graph_objects as go
+import shapely
+
+import ais_db
+from track_lod import count_day_points, day_ms, get_track_lod, pyramid_status, update_pyramids
+
+max_track_chunks = 2048  # Day chunks held in the track cache
+track_workers = 4  # Threads building tracks, bounds the heavy queries running at once
+metadata_refresh_s = 300  # Seconds between refreshes of the vessels and date range
+
+
+class LRUCache:
+    """A thread-safe least recently used cache with hit and miss counts
+
+    max_entries: The number of entries kept, the least recently used entry is evicted beyond this
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Any, loader: Callable[[], Any]) -> Any:
+        """Return the value for key, calling loader to make it on a miss"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = loader()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        """Empty the cache, keeping the counts"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """Return the entry count, hits, misses, evictions and hit rate"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else None}
+
+
+class DayCounts:
+    """The number of source points of each vessel day, with hit and miss counts
+
+    The counts are kept until a file is loaded into or removed from the DB, see ais_db.data_version, and only the
+    days not already held are counted.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float) -> dict[int, int]:
+        """Return the number of source points of each whole UTC day in the range with data, see
+        track_lod.count_day_points"""
+        version = ais_db.data_version(conn)
+        first_ts, last_ts = conn.execute('SELECT min(utc_timestamp_ms), max(utc_timestamp_ms) FROM ais_data '
+                                         'WHERE mmsi=?', (mmsi, )).fetchone()
+        if first_ts is None:
+            return {}
+        # Only the days the vessel has data for, so a long range before or after its data holds no empty days
+        first_day = max(int(start_ts), first_ts) // day_ms * day_ms
+        last_day = min(int(end_ts), last_ts) // day_ms * day_ms
+        days = range(first_day, last_day + 1, day_ms)
+        with self.lock:
+            if version != self.version:
+                self.counts.clear()
+                self.version = version
+            known = {d: self.counts.get((mmsi, d)) for d in days}
+        missing = [d for d, n in known.items() if n is None]
+        if missing:
+            counted = count_day_points(conn, mmsi, missing[0], missing[-1])
+            known.update({d: counted.get(d, 0) for d in missing})
+        with self.lock:
+            if version == self.version:
+                self.counts.update({(mmsi, d): known[d] for d in missing})
+            self.hits += len(known) - len(missing)
+            self.misses += len(missing)
+        return {d: n for d, n in known.items() if n}
+
+    def clear(self) -> None:
+        """Forget the counts, keeping the hit and miss counts"""
+        with self.lock:
+            self.counts.clear()
+            self.version = None
+
+    def stats(self) -> dict:
+        """Return the day count, hits, misses and hit rate"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.counts),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else None}
+
+
+class ConnectionPool:
+    """Per-thread read-only connections to the AIS database, and one shared writable connection
+
+    db_path: The database file
+    """
+    def __init__(self, db_path: str = ais_db.ais_database):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.writer = None
+        self.opened = 0
+
+    def reader(self) -> sqlite3.Connection:
+        """Return this thread's read-only connection, opening it on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = ais_db.connect(self.db_path, read_only=True)
+            self.opened += 1
+        return conn
+
+    def write(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Call func with the writable connection, one caller at a time"""
+        with self.write_lock:
+            if self.writer is None:
+                self.writer = ais_db.connect(self.db_path, check_same_thread=False)
+            return func(self.writer)
+
+
+class DBMetadata:
+    """The vessels in the DB with their names and first and last timestamps, kept up to date by a background thread
+
+    Each vessel is found with an index seek, rather than a scan of ais_data, see refresh.
+
+    pool: The connections to read through
+    refresh_s: Seconds between refreshes
+    """
+    def __init__(self, pool: ConnectionPool, refresh_s: float = metadata_refresh_s):
+        self.pool = pool
+        self.refresh_s = refresh_s
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.vessels = []
+        self.refreshed = None
+
+    def refresh(self) -> None:
+        """Read the vessels and their time ranges from the DB"""
+        # Step through the distinct mmsi values in the primary key, then take each vessel's range from the same key
+        rows = self.pool.reader().execute(
+            """WITH RECURSIVE vessel(mmsi) AS (
+                   SELECT min(mmsi) FROM ais_data
+                   UNION ALL
+                   SELECT (SELECT min(mmsi) FROM ais_data WHERE mmsi > vessel.mmsi) FROM vessel
+                   WHERE vessel.mmsi IS NOT NULL)
+               SELECT vessel.mmsi, vessel_data.vessel_name,
+                      (SELECT min(utc_timestamp_ms) FROM ais_data WHERE mmsi = vessel.mmsi),
+                      (SELECT max(utc_timestamp_ms) FROM ais_data WHERE mmsi = vessel.mmsi)
+               FROM vessel LEFT JOIN vessel_data ON vessel_data.mmsi = vessel.mmsi
+               WHERE vessel.mmsi IS NOT NULL""").fetchall()
+        with self.lock:
+            self.vessels = [{'mmsi': mmsi, 'name': name if name is not None else str(mmsi),
+                             'first_ts': first_ts, 'last_ts': last_ts} for mmsi, name, first_ts, last_ts in rows]
+            self.refreshed = datetime.now()
+
+    def run(self) -> None:
+        """Refresh every refresh_s seconds until stopped"""
+        while not self.stop_event.wait(self.refresh_s):
+            try:
+                self.refresh()
+            except sqlite3.Error as e:
+                print(f'DBMetadata: refresh failed, keeping the old metadata ({e})')
+
+    def start(self) -> None:
+        """Read the metadata now, then keep refreshing it in a daemon thread"""
+        self.refresh()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='metadata-refresh', daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the refresh thread"""
+        self.stop_event.set()
+
+    def snapshot(self) -> dict:
+        """Return the vessels, the first and last timestamps over all of them, and when they were read"""
+        with self.lock:
+            vessels = list(self.vessels)
+            refreshed = self.refreshed
+        return {'vessels': vessels,
+                'first_ts': min([v['first_ts'] for v in vessels], default=None),
+                'last_ts': max([v['last_ts'] for v in vessels], default=None),
+                'refreshed': refreshed}
+
+
+pool = ConnectionPool()
+track_chunks = LRUCache(max_track_chunks)
+day_counts = DayCounts()
+track_executor = ThreadPoolExecutor(max_workers=track_workers, thread_name_prefix='track')
+tracks_in_flight: dict[tuple, Future] = {}
+tracks_in_flight_lock = threading.Lock()
+track_stats = {'submitted': 0, 'shared': 0}
+
+
+def get_track(vessel_mmsi: int, start_ts: float, end_ts: float, zoom: float = 10) -> dict[str, np.ndarray]:
+    """Return a vessel's track for the map through the pooled connections and the track chunk cache
+
+    See track_lod.get_track_lod for the level of detail.
+    """
+    day_points = day_counts.get(pool.reader(), vessel_mmsi, start_ts, end_ts)
+    day_points, stale = pyramid_status(pool.reader(), vessel_mmsi, start_ts, end_ts, day_points)
+    if stale:  # Only take the writer when a day has changed
+        day_points = pool.write(lambda conn: update_pyramids(conn, vessel_mmsi, start_ts, end_ts, day_points))
+    return get_track_lod(pool.reader(), vessel_mmsi, start_ts, end_ts, zoom,
+                         chunk_cache=track_chunks, day_points=day_points)
+
+
+def submit_track(vessel_mmsi: int, start_ts: float, end_ts: float, zoom: float = 10) -> Future:
+    """Build a vessel's track in the track threads, see get_track
+
+    A request for a track that is already being built gets the same future, so users looking at the same vessel and
+    range share one query.
+
+    returns: A future for the track
+    """
+    key = (vessel_mmsi, int(start_ts), int(end_ts), round(zoom, 1))
+    with tracks_in_flight_lock:
+        if (fut := tracks_in_flight.get(key)) is not None:
+            track_stats['shared'] += 1
+            return fut
+        fut = track_executor.submit(get_track, *key)
+        tracks_in_flight[key] = fut
+        track_stats['submitted'] += 1
+
+    def done(_: Future) -> None:
+        with tracks_in_flight_lock:
+            tracks_in_flight.pop(key, None)
+    fut.add_done_callback(done)
+    return fut
+
+
+def feature_trace(feature: shapely.Geometry, name: str, color: str) -> go.Scattermap | None:
+    """Return a map trace for a LineString or MultiLineString feature, None for other geometry
+
+    The parts of a MultiLineString are joined with a NaN between them to break the line
+    """
+    if isinstance(feature, shapely.geometry.linestring.LineString):
+        linestrings = [feature]
+    elif isinstance(feature, shapely.geometry.multilinestring.MultiLineString):
+        linestrings = feature.geoms
+    else:
+        return None
+    lats = []
+    lons = []
+    for linestring in linestrings:
+        x, y = linestring.xy
+        lats.extend([np.asarray(y), [np.nan]])
+        lons.extend([np.asarray(x), [np.nan]])
+    if not lats:
+        return None
+    return go.Scattermap(mode="markers+lines",
+                         lat=np.concatenate(lats[:-1]),
+                         lon=np.concatenate(lons[:-1]),
+                         name=name,
+                         line=dict(color=color)
+                         )
+
+
+static_trace_cache = {}
+static_trace_stats = {'hits': 0, 'misses': 0}
+
+
+def static_traces(project_sections: dict, colors: dict[str, str]) -> list[go.Scattermap]:
+    """Return the traces for the project features, built on the first call
+
+    project_sections: dict of geodataframes with name and geometry columns, keyed by feature type
+    colors: The color for each feature type, the keys are the feature types drawn
+    """
+    key = tuple(colors.keys())
+    if key in static_trace_cache:
+        static_trace_stats['hits'] += 1
+    else:
+        static_trace_stats['misses'] += 1
+        traces = []
+        for feature_type in colors.keys():
+            if feature_type not in project_sections:
+                continue
+            geo_df = project_sections[feature_type]
+            for feature, name in zip(geo_df.geometry, geo_df.name):
+                if (trace := feature_trace(feature, name, colors[feature_type])) is not None:
+                    traces.append(trace)
+        static_trace_cache[key] = traces
+    return static_trace_cache[key]
+
+
+def cache_stats() -> dict:
+    """Return the hit and miss counts of the map caches"""
+    return {'track_chunks': track_chunks.stats(),
+            'day_counts': day_counts.stats(),
+            'static_traces': dict(static_trace_stats),
+            'track_requests': dict(track_stats),
+            'connections_opened': pool.opened}
@@ -0,0 +1,66 @@
+"""projection.py - Conversions between lat/lon and the project coordinates
+
+The AIS data is in lat/lon (EPSG:4326) and the project coordinate files are in Texas South Central feet
+(EPSG:2278). Building a pyproj Transformer costs far more than using one, so each is built once per thread and reused,
+see get_transformer. The conversions work on NumPy arrays in one call, without building any geometry.
+
+The projected coordinates of each AIS point are stored in the easting and northing columns of ais_data when it is
+loaded, see ais_db.insert_ais_rows, so queries that need feet read them instead of reprojecting.
+"""
+from itertools import islice
+import threading
+from typing import Iterable, Iterator
+
+import numpy as np
+import pyproj
+
+latlon_crs = 4326
+project_crs = 2278  # The CRS of the channel_def coordinate files, US survey feet
+project_chunk_rows = 65536  # Rows converted at a time by project_rows
+
+transformers = threading.local()  # pyproj Transformers should not be shared between threads
+
+
+def get_transformer(from_crs: int = latlon_crs, to_crs: int = project_crs) -> pyproj.Transformer:
+    """Return a Transformer between two CRS in x, y (lon, lat) order, built once per thread"""
+    cache = transformers.__dict__.setdefault('cache', {})
+    key = (from_crs, to_crs)
+    if key not in cache:
+        cache[key] = pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+    return cache[key]
+
+
+def to_project(lon: np.ndarray, lat: np.ndarray, crs: int = project_crs) -> tuple[np.ndarray, np.ndarray]:
+    """Return the easting and northing of lat/lon points, NaN where the position is missing"""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    return get_transformer(latlon_crs, crs).transform(lon, lat)
+
+
+def to_latlon(easting: np.ndarray, northing: np.ndarray, crs: int = project_crs) -> tuple[np.ndarray, np.ndarray]:
+    """Return the longitude and latitude of projected points"""
+    easting = np.asarray(easting, dtype=np.float64)
+    northing = np.asarray(northing, dtype=np.float64)
+    return get_transformer(crs, latlon_crs).transform(easting, northing)
+
+
+def project_rows(rows: Iterable[tuple], lon_i: int, lat_i: int,
+                 chunk_rows: int = project_chunk_rows) -> Iterator[tuple]:
+    """Add the easting and northing to the end of each row, converting the positions a chunk of rows at a time
+
+    rows: Tuples with the longitude at lon_i and the latitude at lat_i, None for a missing position
+
+    returns: The rows with the easting and northing appended, None where the position is missing
+    """
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_rows)):
+        lon = np.array([r[lon_i] for r in chunk], dtype=np.float64)  # None becomes NaN
+        lat = np.array([r[lat_i] for r in chunk], dtype=np.float64)
+        easting, northing = to_project(lon, lat)
+        missing = ~(np.isfinite(easting) & np.isfinite(northing))
+        easting = easting.astype(object)
+        northing = northing.astype(object)
+        easting[missing] = None
+        northing[missing] = None
+        for r, e, n in zip(chunk, easting, northing):
+            yield *r, e, n
@@ -0,0 +1,104 @@
+"""section_locator.py - Find the project section each AIS point is in
+
+The section polygons are built and prepared once, and indexed in an STRtree. A coarse grid over the project marks
+the cells that touch any section, so points outside the project, or in empty cells, are rejected with array lookups
+before any geometry is built. The remaining points are tested against the tree in one vectorized query.
+
+Where sections overlap the point gets the type that comes last in sections_geo, as the old loop in set_location did.
+"""
+import math
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+
+def section_polygon(g: shapely.Geometry) -> shapely.Geometry:
+    """Return the polygon for a section geometry, closing the ring of a LineString outline"""
+    if isinstance(g, (shapely.Polygon, shapely.MultiPolygon)):
+        return g
+    return shapely.Polygon(g.coords)
+
+
+class SectionLocator:
+    """Locate points in the sections the dredge can enter
+
+    sections_geo: dict of geodataframes with sections the dredge can enter, all in the same CRS as the points
+    max_cells: The maximum number of cells in the rejection grid
+    """
+    def __init__(self, sections_geo: dict[str: gpd.GeoDataFrame], max_cells: int = 256 * 256):
+        self.sec_types = list(sections_geo.keys())
+        polygons = []
+        codes = []
+        for code, sec_type in enumerate(self.sec_types):
+            for g in sections_geo[sec_type].geometry:
+                polygons.append(section_polygon(g))
+                codes.append(code)
+        self.polygons = np.array(polygons, dtype=object)
+        self.codes = np.array(codes, dtype=np.int16)
+        shapely.prepare(self.polygons)
+        self.tree = shapely.STRtree(self.polygons)
+
+        # The rejection grid, occupied[iy, ix] is True if the cell touches any section
+        if len(polygons) == 0:
+            self.bounds = np.array([0.0, 0.0, 0.0, 0.0])
+            self.cell_size = 1.0
+            self.occupied = np.zeros((1, 1), dtype=bool)
+            return
+        self.bounds = shapely.total_bounds(self.polygons)
+        xmin, ymin, xmax, ymax = self.bounds
+        self.cell_size = max(math.sqrt((xmax - xmin) * (ymax - ymin) / max_cells), 1e-9)
+        nx = int((xmax - xmin) / self.cell_size) + 1
+        ny = int((ymax - ymin) / self.cell_size) + 1
+        ix, iy = np.meshgrid(np.arange(nx), np.arange(ny))
+        cells = shapely.box(xmin + ix.ravel() * self.cell_size, ymin + iy.ravel() * self.cell_size,
+                            xmin + (ix.ravel() + 1) * self.cell_size, ymin + (iy.ravel() + 1) * self.cell_size)
+        cell_idx, _ = self.tree.query(cells, predicate='intersects')
+        self.occupied = np.zeros(nx * ny, dtype=bool)
+        self.occupied[cell_idx] = True
+        self.occupied = self.occupied.reshape(ny, nx)
+
+    def candidates(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Return the indices of the points that fall in an occupied grid cell"""
+        xmin, ymin, xmax, ymax = self.bounds
+        in_box = np.flatnonzero((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+        ix = ((x[in_box] - xmin) / self.cell_size).astype(np.int64)
+        iy = ((y[in_box] - ymin) / self.cell_size).astype(np.int64)
+        return in_box[self.occupied[iy, ix]]
+
+    def locate_codes(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Return the index into sec_types of the section each point is in, -1 if it is not in any section
+
+        x: The point x coordinates (longitude)
+        y: The point y coordinates (latitude)
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        result = np.full(x.shape[0], -1, dtype=np.int16)
+        idx = self.candidates(x, y)
+        if idx.size == 0:
+            return result
+        point_i, polygon_i = self.tree.query(shapely.points(x[idx], y[idx]), predicate='intersects')
+        last_polygon = np.full(idx.size, -1, dtype=np.int64)
+        np.maximum.at(last_polygon, point_i, polygon_i)
+        hit = last_polygon >= 0
+        result[idx[hit]] = self.codes[last_polygon[hit]]
+        return result
+
+    def locate(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Return the section type each point is in, None if it is not in any section"""
+        names = np.array(self.sec_types + [None], dtype=object)
+        return names[self.locate_codes(x, y)]  # -1 picks the trailing None
+
+
+# Locators already built, keyed on the section types and geometries
+locator_cache: dict[tuple, SectionLocator] = {}
+
+
+def get_locator(sections_geo: dict[str: gpd.GeoDataFrame]) -> SectionLocator:
+    """Return a SectionLocator for the sections, reusing one already built for the same geometry"""
+    key = tuple((sec_type, tuple(shapely.to_wkb(sections_geo[sec_type].geometry.values)))
+                for sec_type in sections_geo.keys())
+    if key not in locator_cache:
+        locator_cache[key] = SectionLocator(sections_geo)
+    return locator_cache[key]
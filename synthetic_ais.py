@@ -0,0 +1,238 @@
+"""synthetic_ais.py - Generate synthetic AIS data for benchmarks
+
+simulate_dredge produces the track of a dredge working cycles through a project laid out as in default_layout: dig in
+the dig area, sail loaded to the disposal area, dump, and sail back, with occasional delays and gaps in reception.
+Positions are reported every report_s seconds, about the rate of a class A transponder underway. The layout is in
+EPSG:2278 feet, like the coordinate files in channel_def, and write_project writes it out as a project folder.
+
+The writers produce the formats the pipeline reads: Port Houston CSV files (load_port_data_to_db) and zstd compressed
+NOAA daily files (get_data_from_noaa, get_vessel_ais_from_noaa). Everything is seeded, so runs are reproducible.
+"""
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pyproj
+import zstandard
+
+knots_to_fps = 1.68781  # ft/s per knot
+day_ms = 24 * 60 * 60 * 1000
+
+# The project features in EPSG:2278 feet, boxes are (E min, N min, E max, N max)
+default_layout = {'dig': (3199000.0, 13799700.0, 3201000.0, 13800300.0),
+                  'disp': (3214250.0, 13811250.0, 3215750.0, 13812750.0),
+                  'cl': [(3196000.0, 13798000.0), (3200000.0, 13800000.0), (3215000.0, 13812000.0),
+                         (3220000.0, 13816000.0)]}
+
+# The cycle of a dredge, durations in minutes and speeds in knots as (low, high) ranges
+default_cycle = {'dig_min': (45, 75),
+                 'dig_kn': (0.8, 2.2),
+                 'sail_kn': (8.0, 10.5),
+                 'disp_min': (10, 20),
+                 'disp_kn': (0.5, 1.5),
+                 'delay_probability': 0.15,
+                 'delay_min': (20, 90),
+                 'gap_probability': 0.001,  # Chance per point of a gap in reception
+                 'gap_min': (5, 30)}
+
+to_latlon = pyproj.Transformer.from_crs(2278, 4326, always_xy=True)
+
+
+def box_center(box: tuple[float, float, float, float]) -> tuple[float, float]:
+    """Return the center of an (E min, N min, E max, N max) box"""
+    return (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+
+
+def write_project(folder: str, layout: dict | None = None) -> list[str]:
+    """Write a layout as coordinate files in the channel_def format
+
+    returns: The files written
+    """
+    if layout is None:
+        layout = default_layout
+    os.makedirs(folder, exist_ok=True)
+    fnames = []
+    for ftype in ['dig', 'disp']:
+        e0, n0, e1, n1 = layout[ftype]
+        fnames.append(os.path.join(folder, f'{ftype}_synthetic.csv'))
+        pd.DataFrame({'E': [e0, e1, e1, e0, e0], 'N': [n0, n0, n1, n1, n0]}).to_csv(fnames[-1], index=False)
+    cl = np.array(layout['cl'])
+    stations = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(cl, axis=0).T))])
+    fnames.append(os.path.join(folder, 'cl_synthetic.csv'))
+    pd.DataFrame({'Station': stations.round(), 'E': cl[:, 0], 'N': cl[:, 1]}).to_csv(fnames[-1], index=False)
+    return fnames
+
+
+def leg(e0: float, n0: float, e1: float, n1: float, speed_kn: float, report_s: float) -> tuple[np.ndarray, ...]:
+    """Return the E, N and elapsed seconds of the points on a straight leg at a constant speed"""
+    length = np.hypot(e1 - e0, n1 - n0)
+    duration = max(length / (speed_kn * knots_to_fps), report_s)
+    t = np.arange(0, duration, report_s)
+    frac = t / duration
+    return e0 + (e1 - e0) * frac, n0 + (n1 - n0) * frac, t
+
+
+def sweep(box: tuple[float, float, float, float], minutes: float, speed_kn: float,
+          report_s: float, rng: np.random.Generator) -> tuple[np.ndarray, ...]:
+    """Return the E, N and elapsed seconds of the points of a vessel sweeping back and forth across a box"""
+    e0, n0, e1, n1 = box
+    t = np.arange(0, minutes * 60, report_s)
+    width = e1 - e0
+    dist = t * speed_kn * knots_to_fps + rng.uniform(0, 2 * width)
+    phase = np.mod(dist, 2 * width)
+    e = e0 + np.where(phase < width, phase, 2 * width - phase)
+    n = n0 + (n1 - n0) * (0.5 + 0.4 * np.sin(dist / (2 * width) * np.pi / 3))
+    return e, n, t
+
+
+def simulate_dredge(mmsi: int, start_ms: int, days: float, layout: dict | None = None, cycle: dict | None = None,
+                    report_s: float = 10.0, seed: int = 0) -> pd.DataFrame:
+    """Simulate a dredge working cycles between the dig and disposal areas
+
+    mmsi: Vessel MMSI number
+    start_ms: The start time in UTC ms
+    days: The length of the track in days
+    layout: The project layout, see default_layout
+    cycle: The cycle durations and speeds, see default_cycle
+    report_s: The time between position reports in seconds
+    seed: The random seed
+
+    returns: A dataframe with the mmsi, utc_timestamp_ms, longitude, latitude, sog, cog, heading and status columns
+    """
+    if layout is None:
+        layout = default_layout
+    if cycle is None:
+        cycle = default_cycle
+    rng = np.random.default_rng(seed)
+    dig_e, dig_n = box_center(layout['dig'])
+    disp_e, disp_n = box_center(layout['disp'])
+    end_s = days * 24 * 3600
+    parts = []
+    elapsed = 0.0
+    while elapsed < end_s:
+        phases = []
+        if rng.random() < cycle['delay_probability']:
+            t = np.arange(0, rng.uniform(*cycle['delay_min']) * 60, report_s)
+            phases.append((np.full(t.shape, dig_e) + rng.normal(0, 5, t.shape),
+                           np.full(t.shape, dig_n) + rng.normal(0, 5, t.shape), t, rng.uniform(0, 0.3, t.shape)))
+        e, n, t = sweep(layout['dig'], rng.uniform(*cycle['dig_min']), rng.uniform(*cycle['dig_kn']), report_s, rng)
+        phases.append((e, n, t, None))
+        sail_kn = rng.uniform(*cycle['sail_kn'])
+        phases.append((*leg(e[-1], n[-1], disp_e, disp_n, sail_kn, report_s), None))
+        e, n, t = sweep(layout['disp'], rng.uniform(*cycle['disp_min']), rng.uniform(*cycle['disp_kn']), report_s, rng)
+        phases.append((e, n, t, None))
+        phases.append((*leg(e[-1], n[-1], dig_e, dig_n, rng.uniform(*cycle['sail_kn']), report_s), None))
+        for e, n, t, sog in phases:
+            if sog is None:
+                step = np.hypot(np.diff(e, append=e[-1]), np.diff(n, append=n[-1]))
+                sog = step / report_s / knots_to_fps
+            parts.append((e, n, elapsed + t, sog))
+            elapsed += t[-1] + report_s
+
+    e = np.concatenate([p[0] for p in parts])
+    n = np.concatenate([p[1] for p in parts])
+    t = np.concatenate([p[2] for p in parts])
+    sog = np.concatenate([p[3] for p in parts])
+    t = t + rng.normal(0, report_s / 10, t.shape)  # Jitter in the reporting times
+    keep = (t >= 0) & (t < end_s)
+    # Gaps in reception drop the points for a while
+    gap_starts = t[keep][rng.random(np.count_nonzero(keep)) < cycle['gap_probability']]
+    for gap_start in gap_starts:
+        keep &= ~((t >= gap_start) & (t < gap_start + rng.uniform(*cycle['gap_min']) * 60))
+    e, n, t, sog = e[keep], n[keep], t[keep], sog[keep]
+    order = np.argsort(t, kind='stable')
+    e, n, t, sog = e[order], n[order], t[order], sog[order]
+    cog = np.mod(np.degrees(np.arctan2(np.diff(e, append=e[-1:]), np.diff(n, append=n[-1:]))), 360)
+    lon, lat = to_latlon.transform(e, n)
+    ts = start_ms + np.round(t * 1000).astype(np.int64)
+    _, first = np.unique(ts, return_index=True)  # Reports in the same ms would collide in the DB
+    return pd.DataFrame({'mmsi': np.full(first.shape, mmsi, dtype=np.int64),
+                         'utc_timestamp_ms': ts[first],
+                         'longitude': lon[first],
+                         'latitude': lat[first],
+                         'sog': sog[first].round(1),
+                         'cog': cog[first].round(1),
+                         'heading': cog[first].round(0),
+                         'status': np.zeros(first.shape, dtype=np.int64)})
+
+
+def background_traffic(num_vessels: int, start_ms: int, days: float, layout: dict | None = None,
+                       report_s: float = 60.0, seed: int = 1) -> pd.DataFrame:
+    """Simulate other vessels wandering around the project, to fill the NOAA files the dredges are filtered from
+
+    returns: A dataframe with the same columns as simulate_dredge
+    """
+    if layout is None:
+        layout = default_layout
+    rng = np.random.default_rng(seed)
+    e_mid, n_mid = box_center(layout['dig'])
+    t = np.arange(0, days * 24 * 3600, report_s)
+    frames = []
+    for i in range(num_vessels):
+        step_e = rng.normal(0, 200, t.shape)
+        step_n = rng.normal(0, 200, t.shape)
+        e = e_mid + rng.uniform(-50000, 50000) + np.cumsum(step_e)
+        n = n_mid + rng.uniform(-50000, 50000) + np.cumsum(step_n)
+        lon, lat = to_latlon.transform(e, n)
+        sog = (np.hypot(step_e, step_n) / report_s / knots_to_fps).round(1)
+        cog = np.mod(np.degrees(np.arctan2(step_e, step_n)), 360).round(1)
+        frames.append(pd.DataFrame({'mmsi': np.full(t.shape, 338000000 + i, dtype=np.int64),
+                                    'utc_timestamp_ms': start_ms + (t * 1000).astype(np.int64) + i,
+                                    'longitude': lon,
+                                    'latitude': lat,
+                                    'sog': sog,
+                                    'cog': cog,
+                                    'heading': cog.round(0),
+                                    'status': np.zeros(t.shape, dtype=np.int64)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_port_data(df: pd.DataFrame, fname: str) -> None:
+    """Write AIS data in Port Houston format, see load_port_data_to_db"""
+    pd.DataFrame({'longitude': df['longitude'],
+                  'latitude': df['latitude'],
+                  'MMSI': df['mmsi'],
+                  'SPEED': df['sog'],
+                  'HEADING': df['heading'],
+                  'COURSE': df['cog'],
+                  'STATUS': df['status'],
+                  'TIMESTAMP': df['utc_timestamp_ms']}).to_csv(fname, index=False)
+
+
+def write_noaa_day(df: pd.DataFrame, fname: str, vessel_names: dict[int, str] | None = None) -> None:
+    """Write AIS data as a zstd compressed NOAA daily file
+
+    vessel_names: The name for each mmsi, others are named by their number
+    """
+    if vessel_names is None:
+        vessel_names = {}
+    noaa = pd.DataFrame({'mmsi': df['mmsi'],
+                         'base_date_time': pd.to_datetime(df['utc_timestamp_ms'], unit='ms').dt.strftime(
+                             '%Y-%m-%dT%H:%M:%S'),
+                         'longitude': df['longitude'].round(5),
+                         'latitude': df['latitude'].round(5),
+                         'sog': df['sog'],
+                         'cog': df['cog'],
+                         'heading': df['heading'],
+                         'vessel_name': [vessel_names.get(m, f'VESSEL {m}') for m in df['mmsi']],
+                         'imo': '',
+                         'call_sign': '',
+                         'vessel_type': 33,
+                         'status': df['status'],
+                         'length': 100,
+                         'width': 20,
+                         'draft': 5.0,
+                         'cargo': 33,
+                         'transceiver': 'A'})
+    buffer = io.StringIO()
+    noaa.to_csv(buffer, index=False)
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    with open(fname, 'wb') as f:
+        f.write(zstandard.ZstdCompressor(level=3).compress(buffer.getvalue().encode()))
+
+
+def split_days(df: pd.DataFrame) -> dict[int, pd.DataFrame]:
+    """Split AIS data by UTC day, keyed by the day start in UTC ms"""
+    day = df['utc_timestamp_ms'].to_numpy() // day_ms * day_ms
+    return {int(d): df[day == d] for d in np.unique(day)}
@@ -0,0 +1,37 @@
+"""Tests for the AIS database schema and migrations
+
+python -m pytest test_ais_db.py
+"""
+import sqlite3
+
+import ais_db
+
+
+def test_baseline_database_gets_projected_coordinates(tmp_path):
+    db_path = str(tmp_path / 'baseline.sqlite')
+    conn = sqlite3.connect(db_path)  # The original tables, with rows and user_version 0
+    for statement in ais_db.migrations[0]:
+        conn.execute(statement)
+    conn.executemany('INSERT INTO ais_data (utc_timestamp_ms, longitude, latitude, sog, file_id, mmsi) '
+                     'VALUES (?, -95.0, 29.7, 1.0, 1, 368349000)', [(i, ) for i in range(10)])
+    conn.commit()
+    conn.close()
+
+    conn = ais_db.connect(db_path)
+    assert ais_db.schema_version(conn) == len(ais_db.migrations)
+    assert conn.execute('SELECT count(easting), count(northing) FROM ais_data').fetchone() == (10, 10)
+    conn.close()
+
+
+def test_clear_ais_data_keeps_vessel_names(tmp_path):
+    conn = ais_db.connect(str(tmp_path / 'ais.sqlite'))
+    conn.execute("INSERT INTO vessel_data (mmsi, vessel_name) VALUES (338000001, 'KEPT BY HAND')")
+    ais_db.insert_uploaded_file(conn, 'port.csv', [(0, 368349000, -95.0, 29.7)],
+                                ['utc_timestamp_ms', 'mmsi', 'longitude', 'latitude'])
+    conn.execute("INSERT INTO loads (mmsi, start_ms, end_ms, complete) VALUES (368349000, 0, 1, 1)")
+    conn.commit()
+    ais_db.clear_ais_data(conn)
+    for table in ['ais_data', 'uploaded_files'] + ais_db.derived_tables:
+        assert conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0] == 0
+    assert conn.execute('SELECT vessel_name FROM vessel_data WHERE mmsi=338000001').fetchone() == ('KEPT BY HAND', )
+    conn.close()
@@ -0,0 +1,174 @@
+"""Tests for the point classification and load segmentation
+
+python -m pytest test_classify_loads.py
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import ais_db
+import channel_def
+import classify_loads
+import instrumentation
+import synthetic_ais
+from track import Track
+
+
+@pytest.fixture(autouse=True)
+def metrics_in_tmp(tmp_path, monkeypatch):
+    """Write the timing spans to the scratch folder, not the working tree"""
+    monkeypatch.setattr(instrumentation, 'metrics_fname', str(tmp_path / 'pipeline_metrics.jsonl'))
+
+
+@pytest.fixture
+def sections_geo() -> dict[str, gpd.GeoDataFrame]:
+    """A dig and a disposal box either side of the track's start"""
+    return {'dig': gpd.GeoDataFrame(geometry=[shapely.box(-95.02, 29.0, -95.01, 29.01)], crs='EPSG:4326'),
+            'disp': gpd.GeoDataFrame(geometry=[shapely.box(-94.99, 29.0, -94.98, 29.01)], crs='EPSG:4326')}
+
+
+def alternating_speed_frame() -> pd.DataFrame:
+    """An hour of points every 30 s alternating 0.4 and 0.6 kn, so the rolling speed sits on the delay threshold"""
+    n = 120
+    ts = 1748822400000 + np.arange(n, dtype=np.int64) * 30000
+    df = pd.DataFrame({'utc_timestamp_ms': ts,
+                       'mmsi': np.full(n, 368349000, dtype=np.int32),
+                       'longitude': np.linspace(-95.015, -94.985, n),
+                       'latitude': np.full(n, 29.005),
+                       'sog': np.where(np.arange(n) % 2 == 0, 0.4, 0.6)})
+    df.index = pd.DatetimeIndex(pd.to_datetime(ts, unit='ms', utc=True), name='date')
+    return df
+
+
+def test_track_classifies_as_dataframe(sections_geo):
+    df = alternating_speed_frame()
+    expected = classify_loads.classify_delays(df.copy())
+    expected = classify_loads.classify_cycle(classify_loads.set_location(expected, sections_geo))
+    track = classify_loads.classify_track(Track.from_frame(df), sections_geo)
+    assert (expected['activity'] == 'delay').sum() > df.shape[0] // 2
+    np.testing.assert_array_equal(track.activity_names(), expected['activity'].to_numpy())
+    np.testing.assert_array_equal(track.rolling_speed, expected['rolling_speed'].to_numpy())
+
+
+def test_rolling_mean_matches_pandas_on_long_track():
+    dredge = synthetic_ais.simulate_dredge(368349000, 1748822400000, 30, report_s=10.0)
+    ts, sog = dredge['utc_timestamp_ms'].to_numpy(), dredge['sog'].to_numpy()
+    window_ms = classify_loads.rule_windows_ms['delay']
+    rolling = classify_loads.rolling_mean(ts, sog, window_ms)
+    # pandas sums the speeds in whole deci-knots exactly, its float sums of knots drift across the thresholds too
+    segment = np.cumsum(classify_loads.segment_starts(ts))
+    deci_knots = pd.Series(np.round(sog * 10), index=pd.to_datetime(ts, unit='ms'))
+    expected = deci_knots.groupby(segment).transform(
+        lambda x: x.rolling(f'{window_ms}ms', center=True, closed='both').mean()).to_numpy()
+    assert ts.shape[0] > 200000
+    for threshold in [0.5, 2.5]:
+        np.testing.assert_array_equal(rolling <= threshold, expected <= threshold * 10)
+    # Starting partway through the track gives the same means once the window is all inside the part
+    start = ts.shape[0] // 2
+    part = classify_loads.rolling_mean(ts[start:], sog[start:], window_ms)
+    inside = ts[start:] >= ts[start] + window_ms
+    np.testing.assert_array_equal(part[inside], rolling[start:][inside])
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch) -> str:
+    """The synthetic project as the default project, returning its folder"""
+    # Spawned workers import channel_def in the working directory, so the project is written where they will find it
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(channel_def.projects, channel_def.default_project, str(tmp_path / channel_def.default_project))
+    monkeypatch.setattr(channel_def, 'geometry_cache_loc', str(tmp_path / 'geometry_cache'))
+    monkeypatch.setattr(channel_def, 'loaded_projects', {})
+    synthetic_ais.write_project(channel_def.projects[channel_def.default_project])
+    return channel_def.projects[channel_def.default_project]
+
+
+def dredge_db(db_path: str, mmsi: int, days: float):
+    """Return a connection to a new database with a synthetic dredge track"""
+    dredge = synthetic_ais.simulate_dredge(mmsi, 1748822400000, days, report_s=30.0)
+    conn = ais_db.connect(db_path)
+    columns = ['mmsi', 'utc_timestamp_ms', 'longitude', 'latitude', 'sog', 'cog', 'heading', 'status']
+    ais_db.insert_ais_rows(conn, dredge[columns].itertuples(index=False, name=None), columns)
+    conn.commit()
+    return conn
+
+
+def stored_classification(conn) -> pd.DataFrame:
+    """Return the stored classification in time order"""
+    return pd.read_sql('SELECT * FROM ais_classified ORDER BY mmsi, utc_timestamp_ms', conn)
+
+
+def test_fleet_chunks_match_single_pass(tmp_path, project):
+    mmsi = 368349000
+    db_path = str(tmp_path / 'ais.sqlite')
+    conn = dredge_db(db_path, mmsi, 5)
+    classify_loads.classify_fleet(conn, [mmsi], chunk_ms=6 * 60 * 60 * 1000, workers=2, db_path=db_path)
+    chunked = stored_classification(conn)
+    single = classify_loads.classify_range(conn, mmsi, channel_def.get_project().location_sections, -2**62, 2**62)
+    conn.close()
+    assert chunked.shape[0] == len(single) > 10000
+    np.testing.assert_array_equal(chunked['utc_timestamp_ms'].to_numpy(), single.utc_timestamp_ms)
+    np.testing.assert_array_equal(chunked['activity'].to_numpy(), single.activity_names())
+    np.testing.assert_array_equal(chunked['rolling_speed'].to_numpy(), single.rolling_speed)
+
+
+def test_fleet_reclassifies_loads_when_geometry_changes(tmp_path, project):
+    mmsi = 368349000
+    db_path = str(tmp_path / 'ais.sqlite')
+    conn = dredge_db(db_path, mmsi, 1)
+    classify_loads.classify_fleet(conn, [mmsi], workers=2, db_path=db_path)
+    classify_loads.update_loads(conn, mmsi)
+    assert classify_loads.get_loads(conn, mmsi, -2**62, 2**62)['dig_s'].sum() > 0
+
+    # Move the dig area away from the track, so no point is digging and no load starts
+    layout = dict(synthetic_ais.default_layout)
+    e0, n0, e1, n1 = layout['dig']
+    layout['dig'] = (e0 - 50000.0, n0 - 50000.0, e1 - 50000.0, n1 - 50000.0)
+    synthetic_ais.write_project(project, layout)
+    channel_def.loaded_projects.clear()
+    classify_loads.classify_fleet(conn, [mmsi], workers=2, db_path=db_path)
+    classify_loads.update_loads(conn, mmsi)
+    assert classify_loads.get_loads(conn, mmsi, -2**62, 2**62)['dig_s'].sum() == 0
+    conn.close()
+
+
+def test_incremental_chunks_match_single_pass(tmp_path, project):
+    mmsi = 368349000
+    conn = dredge_db(str(tmp_path / 'ais.sqlite'), mmsi, 3)
+    sections = channel_def.get_project().location_sections
+    classified = classify_loads.classify_incremental(conn, mmsi, sections, chunk_ms=6 * 60 * 60 * 1000)
+    chunked = stored_classification(conn)
+    single = classify_loads.classify_range(conn, mmsi, sections, -2**62, 2**62)
+    conn.close()
+    assert classified == chunked.shape[0] == len(single)
+    np.testing.assert_array_equal(chunked['activity'].to_numpy(), single.activity_names())
+    np.testing.assert_array_equal(chunked['rolling_speed'].to_numpy(), single.rolling_speed)
+
+
+@pytest.mark.parametrize('chunk_rows', [50, 777, 5000])
+def test_loads_do_not_depend_on_chunks(tmp_path, project, chunk_rows):
+    mmsi = 368349000
+    conn = dredge_db(str(tmp_path / 'ais.sqlite'), mmsi, 2)
+    classify_loads.classify_incremental(conn, mmsi, channel_def.get_project().location_sections)
+    whole = pd.concat(classify_loads.iter_loads(classify_loads.iter_classified_data(conn, mmsi, -2**62, 2**62,
+                                                                                    chunk_rows=10**9)))
+    chunked = pd.concat(classify_loads.iter_loads(classify_loads.iter_classified_data(conn, mmsi, -2**62, 2**62,
+                                                                                      chunk_rows=chunk_rows)))
+    conn.close()
+    assert whole.shape[0] > 5
+    pd.testing.assert_frame_equal(chunked.reset_index(drop=True), whole.reset_index(drop=True))
+
+
+def test_incremental_in_two_runs_matches_one(tmp_path, project):
+    mmsi = 368349000
+    sections = channel_def.get_project().location_sections
+    results = []
+    for split in [False, True]:
+        conn = dredge_db(str(tmp_path / f'ais_{split}.sqlite'), mmsi, 2)
+        if split:  # As if the second day arrived after the first was classified
+            classify_loads.classify_incremental(conn, mmsi, sections, end_ts=1748822400000 + synthetic_ais.day_ms)
+        classify_loads.classify_incremental(conn, mmsi, sections)
+        results.append(stored_classification(conn))
+        conn.close()
+    pd.testing.assert_frame_equal(results[1], results[0])
@@ -0,0 +1,163 @@
+"""Tests for the NOAA downloader against a local HTTP stand-in, see start_file_server
+
+python -m pytest test_get_data_from_noaa.py
+"""
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import importlib
+import os
+import threading
+
+import pytest
+import zstandard
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Serves files without logging each request"""
+    def log_message(self, format, *args):
+        pass
+
+
+def start_file_server(folder: str, handler: type[SimpleHTTPRequestHandler] = QuietHandler) -> ThreadingHTTPServer:
+    """Serve a folder over HTTP on a free local port, in a background thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=folder))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class RangeHandler(QuietHandler):
+    """Serves files with range requests, recording the ranges asked for"""
+    ranges = []
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def do_GET(self):
+        requested = self.headers.get('Range')
+        if requested is None:
+            return super().do_GET()
+        self.ranges.append(requested)
+        first, last = (int(v) for v in requested.removeprefix('bytes=').split('-'))
+        fname = self.translate_path(self.path)
+        with open(fname, 'rb') as f:
+            f.seek(first)
+            body = f.read(last - first + 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {first}-{first + len(body) - 1}/{os.path.getsize(fname)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class IgnoresRangeHandler(QuietHandler):
+    """Says it accepts range requests, then answers them with the whole file"""
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+
+@pytest.fixture
+def noaa(tmp_path, monkeypatch):
+    """The get_data_from_noaa module, imported in a scratch folder since it makes its data folder on import. Its
+    timing spans are written there too"""
+    monkeypatch.chdir(tmp_path)
+    import get_data_from_noaa
+    import instrumentation
+    monkeypatch.setattr(instrumentation, 'metrics_fname', str(tmp_path / 'pipeline_metrics.jsonl'))
+    return importlib.reload(get_data_from_noaa)
+
+
+@pytest.fixture
+def zst_data() -> bytes:
+    """A daily file's worth of csv in two zstd frames, with checksums so corruption is detected"""
+    lines = [f'{368349000 + i % 7},2025-06-02T00:{i // 60 % 60:02d}:{i % 60:02d},-95.{i:05d},29.{i:05d}\n'
+             for i in range(20000)]
+    cctx = zstandard.ZstdCompressor(write_checksum=True)
+    half = len(lines) // 2
+    return cctx.compress(''.join(lines[:half]).encode()) + cctx.compress(''.join(lines[half:]).encode())
+
+
+def serve(tmp_path, data: bytes, handler=QuietHandler):
+    """Serve data as 2025/ais-2025-06-02.csv.zst, returning the server and the file url"""
+    folder = tmp_path / 'server'
+    (folder / '2025').mkdir(parents=True)
+    (folder / '2025' / 'ais-2025-06-02.csv.zst').write_bytes(data)
+    server = start_file_server(str(folder), handler)
+    return server, f'http://127.0.0.1:{server.server_port}/2025/ais-2025-06-02.csv.zst'
+
+
+def test_resume_truncated_part(noaa, tmp_path, zst_data):
+    server, url = serve(tmp_path, zst_data, RangeHandler)
+    fname = str(tmp_path / 'ais.csv.zst')
+    have = len(zst_data) // 3
+    with open(fname + '.part', 'wb') as f:
+        f.write(zst_data[:have])
+    RangeHandler.ranges.clear()
+    try:
+        noaa.download_file(url, fname)
+    finally:
+        server.shutdown()
+    assert RangeHandler.ranges == [f'bytes={have}-{len(zst_data) - 1}']
+    with open(fname, 'rb') as f:
+        assert f.read() == zst_data
+    assert not os.path.exists(fname + '.part')
+
+
+@pytest.mark.parametrize('handler', [QuietHandler, IgnoresRangeHandler])
+def test_range_request_answered_with_whole_file(noaa, tmp_path, zst_data, handler):
+    server, url = serve(tmp_path, zst_data, handler)
+    fname = str(tmp_path / 'ais.csv.zst')
+    with open(fname + '.part', 'wb') as f:
+        f.write(zst_data[:len(zst_data) // 2])
+    try:
+        noaa.download_file(url, fname)
+    finally:
+        server.shutdown()
+    with open(fname, 'rb') as f:
+        assert f.read() == zst_data  # Written over the partial file, not appended to it
+    assert not os.path.exists(fname + '.part')
+
+
+def test_corrupt_zstd_frame(noaa, tmp_path, zst_data):
+    corrupt = bytearray(zst_data)
+    corrupt[len(corrupt) // 4] ^= 0xFF
+    server, url = serve(tmp_path, bytes(corrupt))
+    fname = str(tmp_path / 'ais.csv.zst')
+    try:
+        with pytest.raises(noaa.DownloadError):
+            noaa.download_file(url, fname)
+    finally:
+        server.shutdown()
+    assert not os.path.exists(fname)
+    assert not os.path.exists(fname + '.part')
+
+
+def test_verify_zstd(noaa, tmp_path, zst_data):
+    fname = tmp_path / 'ais.csv.zst'
+    fname.write_bytes(zst_data)
+    assert noaa.verify_zstd(str(fname))
+    fname.write_bytes(zst_data[:-10])  # Ends partway through the second frame
+    assert not noaa.verify_zstd(str(fname))
+    fname.write_bytes(b'')
+    assert not noaa.verify_zstd(str(fname))
+
+
+class MissingHandler(QuietHandler):
+    """Answers HEAD with the file and every GET with 404, counting the GETs"""
+    gets = 0
+
+    def do_GET(self):
+        MissingHandler.gets += 1
+        self.send_error(404)
+
+
+def test_not_found_is_not_retried(noaa, tmp_path, zst_data):
+    server, url = serve(tmp_path, zst_data, MissingHandler)
+    MissingHandler.gets = 0
+    try:
+        with pytest.raises(noaa.DownloadError):
+            noaa.download_file(url, str(tmp_path / 'ais.csv.zst'))
+    finally:
+        server.shutdown()
+    assert MissingHandler.gets == 1
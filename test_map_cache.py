@@ -0,0 +1,54 @@
+"""Tests for the map caches
+
+python -m pytest test_map_cache.py
+"""
+import numpy as np
+import pytest
+
+import ais_db
+import instrumentation
+import map_cache
+import synthetic_ais
+import track_lod
+
+
+@pytest.fixture(autouse=True)
+def metrics_in_tmp(tmp_path, monkeypatch):
+    """Write the timing spans to the scratch folder, not the working tree"""
+    monkeypatch.setattr(instrumentation, 'metrics_fname', str(tmp_path / 'pipeline_metrics.jsonl'))
+
+
+def load_days(conn, mmsi: int, start_ms: int, days: float, filename: str) -> None:
+    """Load a synthetic dredge track as one uploaded file"""
+    dredge = synthetic_ais.simulate_dredge(mmsi, start_ms, days, report_s=60.0)
+    columns = ['mmsi', 'utc_timestamp_ms', 'longitude', 'latitude', 'sog', 'cog', 'heading', 'status']
+    ais_db.insert_uploaded_file(conn, filename, dredge[columns].itertuples(index=False, name=None), columns)
+
+
+def test_day_counts_are_kept_until_a_file_is_loaded(tmp_path):
+    mmsi, start_ms = 368349000, 1748822400000
+    conn = ais_db.connect(str(tmp_path / 'ais.sqlite'))
+    load_days(conn, mmsi, start_ms, 3, 'first.csv')
+    counts = map_cache.DayCounts()
+    first = counts.get(conn, mmsi, -2**62, 2**62)
+    assert first == track_lod.count_day_points(conn, mmsi, -2**62, 2**62)
+    assert len(first) == 3 and counts.stats()['misses'] == 3
+
+    # The counts are read from the cache, and a range is cut from the same days
+    assert counts.get(conn, mmsi, -2**62, 2**62) == first
+    second_day = start_ms + synthetic_ais.day_ms
+    assert counts.get(conn, mmsi, second_day + 1, second_day + 2) == {second_day: first[second_day]}
+    assert counts.stats()['hits'] == 4 and counts.stats()['misses'] == 3
+
+    # A newly loaded file changes the data version, so the days are counted again
+    load_days(conn, mmsi, start_ms + 3 * synthetic_ais.day_ms, 1, 'second.csv')
+    after = counts.get(conn, mmsi, -2**62, 2**62)
+    assert after == track_lod.count_day_points(conn, mmsi, -2**62, 2**62)
+    assert len(after) == 4 and counts.stats()['misses'] == 7
+
+    # The counts let the pyramids be checked and built without counting again
+    day_points = track_lod.update_pyramids(conn, mmsi, -2**62, 2**62, after)
+    assert track_lod.pyramid_status(conn, mmsi, -2**62, 2**62, day_points)[1] == []
+    track = track_lod.get_track_lod(conn, mmsi, start_ms, start_ms + synthetic_ais.day_ms - 1, day_points=day_points)
+    assert track['ts'].shape[0] == after[start_ms] and np.all(np.diff(track['ts']) > 0)
+    conn.close()
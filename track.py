@@ -0,0 +1,205 @@
+"""track.py - Compact in-memory vessel tracks
+
+A Track holds AIS points as typed NumPy columns: int32 mmsi, int64 timestamps, float64 longitude, latitude and sog,
+float32 cog and heading, int8 codes for the section and activity, and the float64 rolling speed the classifier uses.
+sog stays float64 so its rolling means compare with the speed thresholds exactly as classify_delays does. No
+per-point Python objects are kept, so a season of data for several vessels takes tens of bytes per point. Shapely
+points, projected coordinates and DataFrames are only built when a caller asks for them, see points, xy, to_frame and
+to_geodataframe.
+
+load_track reads the DB straight into the columns, converting the section and activity names to codes in SQL. The
+classifier works on Tracks, see classify_loads.classify_track, and rollups are totalled from them.
+"""
+import sqlite3
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from channel_def import loc_types
+import projection
+from section_locator import get_locator
+
+# The activities classify_cycle and classify_delays assign, in the order of the columns in the loads table
+activities = ['dig', 'sail', 'disp', 'delay']
+# The categories of the section and activity codes, code -1 is no section or activity
+section_names = list(loc_types)
+activity_names = list(activities)
+
+# The numeric columns and their types, in the order load_track reads them
+track_dtypes = {'mmsi': np.int32,
+                'utc_timestamp_ms': np.int64,
+                'longitude': np.float64,
+                'latitude': np.float64,
+                'sog': np.float64,
+                'cog': np.float32,
+                'heading': np.float32,
+                'section': np.int8,
+                'activity': np.int8,
+                'rolling_speed': np.float64}
+load_chunk_rows = 262144  # Rows fetched from the DB at a time by load_track
+
+
+def category_codes(values, categories: list[str]) -> np.ndarray:
+    """Return the index into categories of each value, -1 for None, NaN or values not in categories"""
+    values = pd.Categorical(np.asarray(values, dtype=object), categories=categories)
+    return values.codes.astype(np.int8)
+
+
+class Track:
+    """AIS points for one or more vessels as typed columns, in mmsi and time order
+
+    columns: dict of arrays keyed by the names in track_dtypes, missing columns are filled with NaN or -1
+    """
+    def __init__(self, columns: dict[str, np.ndarray]):
+        n = len(columns['utc_timestamp_ms'])
+        for name, dtype in track_dtypes.items():
+            if name in columns and columns[name] is not None:
+                value = np.asarray(columns[name], dtype=dtype)
+            elif np.issubdtype(dtype, np.floating):
+                value = np.full(n, np.nan, dtype=dtype)
+            else:
+                value = np.full(n, -1, dtype=dtype)
+            setattr(self, name, value)
+
+    def __len__(self) -> int:
+        return self.utc_timestamp_ms.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the columns"""
+        return sum(getattr(self, name).nbytes for name in track_dtypes)
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """Return the columns as a dict of arrays"""
+        return {name: getattr(self, name) for name in track_dtypes}
+
+    def take(self, idx: np.ndarray | slice) -> 'Track':
+        """Return a Track with the points selected by an index array, boolean mask or slice"""
+        return Track({name: col[idx] for name, col in self.columns().items()})
+
+    def vessel(self, mmsi: int) -> 'Track':
+        """Return the points of one vessel"""
+        start, end = np.searchsorted(self.mmsi, [mmsi, mmsi + 1])
+        return self.take(slice(start, end))
+
+    def between(self, start_ts: float, end_ts: float) -> 'Track':
+        """Return the points between the start and end timestamps in UTC ms"""
+        return self.take((self.utc_timestamp_ms >= start_ts) & (self.utc_timestamp_ms <= end_ts))
+
+    def is_sorted(self) -> bool:
+        """Return True if the points are in mmsi and time order"""
+        d_mmsi = np.diff(self.mmsi)
+        return bool(np.all((d_mmsi > 0) | ((d_mmsi == 0) & (np.diff(self.utc_timestamp_ms) >= 0))))
+
+    def section_names(self) -> np.ndarray:
+        """Return the section of each point as names, None outside the sections"""
+        return np.array(section_names + [None], dtype=object)[self.section]
+
+    def activity_names(self) -> np.ndarray:
+        """Return the activity of each point as names, None if not classified"""
+        return np.array(activity_names + [None], dtype=object)[self.activity]
+
+    def locate(self, sections_geo: dict[str: gpd.GeoDataFrame]) -> 'Track':
+        """Set the section codes from the section geometry, see section_locator. Returns the track"""
+        locator = get_locator(sections_geo)
+        codes = locator.locate_codes(self.longitude, self.latitude)
+        # The locator codes index its own section types, map them onto section_names
+        to_ours = np.array([section_names.index(t) if t in section_names else -1 for t in locator.sec_types] + [-1],
+                           dtype=np.int8)
+        self.section = to_ours[codes]
+        return self
+
+    def points(self) -> np.ndarray:
+        """Return shapely points for the track, built on each call"""
+        return shapely.points(self.longitude, self.latitude)
+
+    def xy(self, epsg: int = projection.project_crs) -> tuple[np.ndarray, np.ndarray]:
+        """Return the coordinates of the points in another CRS, without building geometry, see projection"""
+        return projection.to_project(self.longitude, self.latitude, epsg)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Return the track as a DataFrame with a UTC date index, as load_ais_data does
+
+        section and activity are categorical columns
+        """
+        df = pd.DataFrame({name: col for name, col in self.columns().items() if name not in ('section', 'activity')})
+        df['section'] = pd.Categorical.from_codes(self.section, categories=section_names)
+        df['activity'] = pd.Categorical.from_codes(self.activity, categories=activity_names)
+        df.index = pd.DatetimeIndex(pd.to_datetime(self.utc_timestamp_ms, unit='ms', utc=True), name='date')
+        return df
+
+    def to_geodataframe(self) -> gpd.GeoDataFrame:
+        """Return the track as a GeoDataFrame in EPSG:4326, see to_frame"""
+        return gpd.GeoDataFrame(self.to_frame(), geometry=self.points(), crs='EPSG:4326')
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'Track':
+        """Make a Track from a DataFrame or GeoDataFrame such as load_ais_data or iter_classified_data return
+
+        The section and activity columns may hold names, or be missing. Points are sorted by mmsi and time.
+        """
+        columns = {name: df[name].to_numpy() for name in track_dtypes if name in df.columns}
+        if 'mmsi' not in columns:
+            columns['mmsi'] = np.zeros(df.shape[0], dtype=np.int32)
+        if 'section' in columns:
+            columns['section'] = category_codes(df['section'], section_names)
+        if 'activity' in columns:
+            columns['activity'] = category_codes(df['activity'], activity_names)
+        track = cls(columns)
+        if not track.is_sorted():
+            track = track.take(np.lexsort((track.utc_timestamp_ms, track.mmsi)))
+        return track
+
+    @classmethod
+    def concat(cls, tracks: list['Track']) -> 'Track':
+        """Join several tracks, sorted by mmsi and time"""
+        if not tracks:
+            return cls({'utc_timestamp_ms': np.zeros(0, dtype=np.int64)})
+        track = cls({name: np.concatenate([getattr(t, name) for t in tracks]) for name in track_dtypes})
+        if not track.is_sorted():
+            track = track.take(np.lexsort((track.utc_timestamp_ms, track.mmsi)))
+        return track
+
+
+def load_track(conn: sqlite3.Connection, mmsi: int | list[int], start_ts: float, end_ts: float,
+               classified: bool = True, only_classified: bool = False) -> Track:
+    """Load the AIS points of one or more vessels between the start and end timestamps into a Track
+
+    The rows are fetched in chunks into numeric arrays, so no per-point Python objects are kept.
+
+    conn: Connection to the AIS database
+    mmsi: Vessel MMSI number, or a list of them
+    start_ts: start timestamp in UTC ms
+    end_ts: end timestamp in UTC ms
+    classified: Include the stored section and activity, see classify_loads.classify_incremental. Points that
+                have not been classified get code -1
+    only_classified: Leave out the points that have not been classified, as classify_loads.iter_classified_data does
+
+    returns: The Track, in mmsi and time order
+    """
+    mmsi_list = [mmsi] if isinstance(mmsi, int) else list(mmsi)
+    section_sql = 'CASE c.section ' + ' '.join(f"WHEN '{s}' THEN {i}" for i, s in enumerate(section_names)) + \
+                  ' ELSE -1 END'
+    activity_sql = 'CASE c.activity ' + ' '.join(f"WHEN '{a}' THEN {i}" for i, a in enumerate(activity_names)) + \
+                   ' ELSE -1 END'
+    if classified or only_classified:
+        select = f'{section_sql}, {activity_sql}, c.rolling_speed'
+        join = f"{'' if only_classified else 'LEFT '}JOIN ais_classified c " \
+               f"ON a.mmsi=c.mmsi AND a.utc_timestamp_ms=c.utc_timestamp_ms"
+    else:
+        select = '-1, -1, NULL'
+        join = ''
+    qry = f"""SELECT a.mmsi, a.utc_timestamp_ms, a.longitude, a.latitude, a.sog, a.cog, a.heading, {select}
+              FROM ais_data a {join}
+              WHERE a.mmsi IN ({', '.join(['?'] * len(mmsi_list))}) AND a.utc_timestamp_ms>=? AND a.utc_timestamp_ms<=?
+              ORDER BY a.mmsi, a.utc_timestamp_ms;
+           """
+    cursor = conn.execute(qry, (*mmsi_list, start_ts, end_ts))
+    chunks = []
+    while rows := cursor.fetchmany(load_chunk_rows):
+        values = np.array(rows, dtype=np.float64)  # NULLs become NaN
+        chunks.append(Track({name: np.nan_to_num(values[:, i], nan=-1) if name in ('section', 'activity')
+                             else values[:, i] for i, name in enumerate(track_dtypes)}))
+    return Track.concat(chunks)
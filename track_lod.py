@@ -0,0 +1,172 @@
+"""track_lod.py - Level of detail for vessel tracks on the map
+
+Each vessel's track is simplified per UTC day with Douglas-Peucker at a series of tolerances, and the levels are
+stored in the track_pyramid table. A map request for a long range reads the coarsest level that still resolves at
+the map zoom and fits the point budget, and only short ranges are drawn at full resolution. A stored day is rebuilt
+when its number of source points has changed, so days still receiving data stay current. Callers can pass a cache
+of day chunks, such as map_cache.LRUCache, so repeated requests do not read the same days again.
+"""
+import sqlite3
+
+import numpy as np
+import shapely
+
+from classify_loads import load_ais_data
+
+day_ms = 24 * 60 * 60 * 1000
+# Douglas-Peucker tolerance in degrees for each pyramid level, level 0 is full resolution
+level_tolerances = [0.0, 0.00001, 0.00004, 0.00016, 0.00064, 0.00256]
+full_resolution_ms = day_ms  # Ranges up to this long are always drawn at full resolution
+max_track_points = 20000  # The point budget for one track on the map
+
+
+def simplify_indices(lon: np.ndarray, lat: np.ndarray, tolerance: float) -> np.ndarray:
+    """Return the indices of the points kept by a Douglas-Peucker simplification of the track
+
+    The point index is carried through the simplification as the z coordinate, which GEOS keeps for the vertices it
+    retains.
+    """
+    n = lon.shape[0]
+    if tolerance <= 0 or n < 3:
+        return np.arange(n)
+    line = shapely.linestrings(lon, lat, np.arange(n, dtype=np.float64))
+    simplified = shapely.simplify(line, tolerance, preserve_topology=False)
+    return shapely.get_coordinates(simplified, include_z=True)[:, 2].astype(np.int64)
+
+
+def build_day_pyramid(conn: sqlite3.Connection, mmsi: int, day_start_ms: int) -> None:
+    """Simplify one UTC day of a vessel's track at every level and store the levels in track_pyramid"""
+    df = load_ais_data(conn, mmsi, day_start_ms, day_start_ms + day_ms - 1, columns=['longitude', 'latitude', 'sog'])
+    ts = df['utc_timestamp_ms'].to_numpy(dtype=np.int64)
+    lon = df['longitude'].to_numpy(dtype=np.float64)
+    lat = df['latitude'].to_numpy(dtype=np.float64)
+    sog = df['sog'].to_numpy(dtype=np.float32)
+    rows = []
+    for level, tolerance in enumerate(level_tolerances):
+        keep = simplify_indices(lon, lat, tolerance)
+        rows.append((mmsi, day_start_ms, level, ts.shape[0], keep.shape[0],
+                     ts[keep].tobytes(), lon[keep].tobytes(), lat[keep].tobytes(), sog[keep].tobytes()))
+    conn.execute('DELETE FROM track_pyramid WHERE mmsi=? AND day_ms=?', (mmsi, day_start_ms))
+    conn.executemany('INSERT INTO track_pyramid (mmsi, day_ms, level, source_points, num_points, ts, lon, lat, sog) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+
+
+def count_day_points(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float) -> dict[int, int]:
+    """Return the number of source points of each whole UTC day in the range with data, keyed by the day start
+
+    Counts every point in the range, callers that ask repeatedly should cache the counts, see map_cache.DayCounts.
+    """
+    first_day = int(start_ts) // day_ms * day_ms
+    end_day = int(end_ts) // day_ms * day_ms + day_ms  # The whole last day, to compare with the stored day
+    return dict(conn.execute('SELECT utc_timestamp_ms / ? * ?, count(*) FROM ais_data '
+                             'WHERE mmsi=? AND utc_timestamp_ms>=? AND utc_timestamp_ms<? GROUP BY 1',
+                             (day_ms, day_ms, mmsi, first_day, end_day)).fetchall())
+
+
+def pyramid_status(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float,
+                   day_points: dict[int, int] | None = None) -> tuple[dict[int, int], list[int]]:
+    """Return the number of source points of each whole UTC day in the range with data, and the days whose stored
+    levels are missing or out of date
+
+    Only reads, so a caller can check on a read only connection before taking the write path.
+
+    day_points: The counts of the days in the range, if the caller already has them, see count_day_points
+    """
+    if day_points is None:
+        day_points = count_day_points(conn, mmsi, start_ts, end_ts)
+    first_day = int(start_ts) // day_ms * day_ms
+    end_day = int(end_ts) // day_ms * day_ms + day_ms
+    stored = dict(conn.execute('SELECT day_ms, source_points FROM track_pyramid '
+                               'WHERE mmsi=? AND level=0 AND day_ms>=? AND day_ms<?',
+                               (mmsi, first_day, end_day)).fetchall())
+    return day_points, [d for d, num_points in day_points.items() if stored.get(d) != num_points]
+
+
+def update_pyramids(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float,
+                    day_points: dict[int, int] | None = None) -> dict[int, int]:
+    """Build or rebuild the stored levels for the days in the range whose source data has changed
+
+    day_points: The counts of the days in the range, if the caller already has them, see count_day_points
+
+    returns: The number of source points for each whole day in the range with data, keyed by the day start in UTC ms
+    """
+    counts, stale = pyramid_status(conn, mmsi, start_ts, end_ts, day_points)
+    for day_start_ms in stale:
+        build_day_pyramid(conn, mmsi, day_start_ms)
+    return counts
+
+
+def empty_track() -> dict[str, np.ndarray]:
+    """Return a track with no points"""
+    return {'ts': np.zeros(0, np.int64), 'lon': np.zeros(0), 'lat': np.zeros(0), 'sog': np.zeros(0, np.float32)}
+
+
+def read_day_level(conn: sqlite3.Connection, mmsi: int, day_start_ms: int, level: int) -> dict[str, np.ndarray]:
+    """Return the stored points of one day at one level, as a dict of ts, lon, lat and sog arrays"""
+    row = conn.execute('SELECT ts, lon, lat, sog FROM track_pyramid WHERE mmsi=? AND day_ms=? AND level=?',
+                       (mmsi, day_start_ms, level)).fetchone()
+    if row is None:
+        return empty_track()
+    return {'ts': np.frombuffer(row[0], dtype=np.int64),
+            'lon': np.frombuffer(row[1], dtype=np.float64),
+            'lat': np.frombuffer(row[2], dtype=np.float64),
+            'sog': np.frombuffer(row[3], dtype=np.float32)}
+
+
+def zoom_tolerance(zoom: float) -> float:
+    """Return the size of a map pixel in degrees of longitude at the given zoom, for 256 pixel tiles"""
+    return 360 / (256 * 2 ** zoom)
+
+
+def get_track_lod(conn: sqlite3.Connection, mmsi: int, start_ts: float, end_ts: float, zoom: float = 10,
+                  max_points: int = max_track_points, chunk_cache=None,
+                  day_points: dict[int, int] | None = None) -> dict[str, np.ndarray]:
+    """Return a vessel's track over a time range at a level of detail suited to the range and map zoom
+
+    Ranges up to full_resolution_ms are returned at full resolution (level 0). Longer ranges use the coarsest stored
+    level whose tolerance is below a pixel at the zoom, or a coarser one if needed to stay within max_points. The
+    range is assembled from whole days, read through chunk_cache if one is given.
+
+    conn: Connection to the AIS database
+    mmsi: Vessel MMSI number
+    start_ts: start timestamp in UTC ms
+    end_ts: end timestamp in UTC ms
+    zoom: The map zoom level
+    max_points: The point budget for the track
+    chunk_cache: Optional cache with a get(key, loader) method, the keys include the day's source point count so
+                 chunks for days that have changed are not reused
+    day_points: The result of update_pyramids for the range, if the caller has already updated the pyramids.
+                Otherwise they are updated here, and conn must not be read only
+
+    returns: dict of arrays with the ts, lon, lat and sog of the points
+    """
+    if day_points is None:
+        day_points = update_pyramids(conn, mmsi, start_ts, end_ts)
+    first_day = int(start_ts) // day_ms * day_ms
+    level = 0
+    if end_ts - start_ts > full_resolution_ms:
+        level_points = conn.execute('SELECT level, sum(num_points) FROM track_pyramid '
+                                    'WHERE mmsi=? AND day_ms>=? AND day_ms<=? GROUP BY level ORDER BY level',
+                                    (mmsi, first_day, end_ts)).fetchall()
+        # Start from the coarsest level that is still finer than a pixel, and coarsen until the track fits the budget
+        pixel = zoom_tolerance(zoom)
+        level = max([lvl for lvl, _ in level_points if level_tolerances[lvl] <= pixel], default=0)
+        for lvl, num_points in level_points:
+            if lvl >= level:
+                level = lvl
+                if num_points <= max_points:
+                    break
+
+    chunks = []
+    for day_start_ms in sorted(day_points.keys()):
+        if chunk_cache is None:
+            chunks.append(read_day_level(conn, mmsi, day_start_ms, level))
+        else:
+            chunks.append(chunk_cache.get((mmsi, day_start_ms, level, day_points[day_start_ms]),
+                                          lambda d=day_start_ms: read_day_level(conn, mmsi, d, level)))
+    if not chunks:
+        chunks = [empty_track()]
+    track = {k: np.concatenate([c[k] for c in chunks]) for k in ['ts', 'lon', 'lat', 'sog']}
+    in_range = (track['ts'] >= start_ts) & (track['ts'] <= end_ts)
+    return {k: v[in_range] for k, v in track.items()}